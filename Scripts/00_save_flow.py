@@ -1,6 +1,8 @@
-import os, json, requests
+import os, json
 from dotenv import load_dotenv
 
+from supabase_client import get_client
+
 load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -48,21 +50,7 @@ payload = [{
     }
 }]
 
-headers = {
-    "apikey": SERVICE_KEY,
-    "Authorization": f"Bearer {SERVICE_KEY}",
-    "Content-Type": "application/json",
-    "Prefer": "return=representation"
-}
-
-url = f"{SUPABASE_URL}/rest/v1/messages"
-resp = requests.post(url, headers=headers, json=payload, timeout=60)
-
-print("Status:", resp.status_code)
-print(resp.text)
-
-resp.raise_for_status()
-data = resp.json()
+data = get_client().insert("messages", payload)
 print("✅ Inserted message id:", data[0]["id"])
 
 
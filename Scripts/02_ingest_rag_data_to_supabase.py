@@ -1,16 +1,24 @@
 import os
 import glob
+import time
+import uuid
+import queue
+import hashlib
+import threading
 import requests
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 from docx import Document
 from openpyxl import load_workbook
 
-import httpx
-from openai import OpenAI
-
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from embedding_cache import embed_with_cache, get_cache
+from embedding_client import AsyncEmbeddingClient
+from message_embedding import to_pgvector
+from dedup import PartitionedDedup, SignatureStore, minhash_signature, EXACT_ONLY_KINDS, DEDUP_VERSION
+from chunking import chunk_text, chunk_docx, CHUNKER_VERSION
+import connector_index
+from supabase_client import get_client, is_retryable
 
 load_dotenv()
 
@@ -21,89 +29,246 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not all([SUPABASE_URL, SERVICE_KEY, OPENAI_API_KEY]):
     raise SystemExit("Missing env vars: SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, OPENAI_API_KEY")
 
-# Corporate SSL workaround (OpenAI uses httpx)
-http_client = httpx.Client(verify=False, timeout=60.0)
-client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
-
-headers = {
-    "apikey": SERVICE_KEY,
-    "Authorization": f"Bearer {SERVICE_KEY}",
-    "Content-Type": "application/json",
-    "Prefer": "return=representation",
-}
+# Pooled keep-alive Supabase session shared by every stage (see supabase_client.py)
+db = get_client()
 
 RAG_FOLDER = "RAG Data"
 
+# Bulk writes: rows per request and retries per failed batch
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", "100"))
+WRITE_MAX_RETRIES = int(os.getenv("WRITE_MAX_RETRIES", "3"))
+
+# Pipeline sizing: parse processes, concurrent embedding requests, and bounded queues
+# between stages (a full queue blocks the stage upstream of it = backpressure)
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_BATCH_SIZE = 64
+EMBED_QUEUE_SIZE = int(os.getenv("EMBED_QUEUE_SIZE", str(EMBED_CONCURRENCY * 2)))
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "8"))
+
+# ANN index kept in shape by maintain_knowledge_chunk_index() after each run (hnsw | ivfflat).
+# Quantization = what the index stores (none | halfvec | reduced | binary); the table keeps
+# the full-precision vector for re-ranking either way.
+VECTOR_INDEX_METHOD = os.getenv("VECTOR_INDEX_METHOD", "hnsw")
+VECTOR_INDEX_MIN_ROWS = int(os.getenv("VECTOR_INDEX_MIN_ROWS", "10000"))
+VECTOR_INDEX_QUANTIZATION = os.getenv("VECTOR_INDEX_QUANTIZATION", "halfvec")
+VECTOR_INDEX_REDUCED_DIMS = int(os.getenv("VECTOR_INDEX_REDUCED_DIMS", "512"))
+
+# Retrieval partitions: every chunk carries doc_type / sheet_name / tenant columns that the
+# search RPCs filter on. doc_type = first rule whose keyword is in the file name.
+DOC_TYPE_RULES = [
+    ("connectors", ("connector",)),
+    ("governance", ("governance", "policy", "policies", "dlp")),
+]
+DEFAULT_DOC_TYPE = "general"
+TENANT_ID = os.getenv("TENANT_ID") or None   # unset = shared knowledge
+
 
 # ---------------------------
 # Supabase REST helpers
 # ---------------------------
-def supabase_post(url: str, payload):
-    r = requests.post(url, headers=headers, json=payload, timeout=60, verify=False)
-    r.raise_for_status()
-    return r.json()
-
-def supabase_get(url: str, params=None):
-    r = requests.get(url, headers=headers, params=params, timeout=60, verify=False)
-    r.raise_for_status()
-    return r.json()
-
 def delete_rows(table: str, where: dict):
     """
     where is a dict of query params like:
       {"document_id": "eq.<uuid>"}
       {"id": "eq.<uuid>"}
     """
-    url = f"{SUPABASE_URL}/rest/v1/{table}"
-    r = requests.delete(url, headers=headers, params=where, timeout=60, verify=False)
-    r.raise_for_status()
+    db.delete(table, where)
 
 def insert_row(table: str, row: dict) -> dict:
-    url = f"{SUPABASE_URL}/rest/v1/{table}"
-    return supabase_post(url, [row])[0]
+    return db.insert(table, [row])[0]
+
+def rpc(fn_name: str, payload: dict):
+    return db.rpc(fn_name, payload)
+
+def write_in_batches(items: list, send, label: str, batch_size: int = INSERT_BATCH_SIZE):
+    """
+    Calls send(batch) for consecutive slices of items, retrying transient failures
+    with exponential backoff. A batch that still fails is reported and skipped so the
+    remaining batches are written.
+
+    Returns a list of failures: [{"start": int, "end": int, "error": str}]
+    """
+    failures = []
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        for attempt in range(WRITE_MAX_RETRIES + 1):
+            try:
+                send(batch)
+                break
+            except Exception as e:
+                if attempt < WRITE_MAX_RETRIES and is_retryable(e):
+                    time.sleep(0.5 * 2 ** attempt)
+                    continue
+                end = start + len(batch)
+                print(f"⚠️ {label}: batch rows {start}-{end - 1} failed: {e}")
+                failures.append({"start": start, "end": end, "error": str(e)})
+                break
+    return failures
+
+def insert_rows(table: str, rows: list, batch_size: int = INSERT_BATCH_SIZE):
+    """
+    Bulk insert: one POST per batch of rows instead of one per row.
+    Rows get client-side ids and duplicates are ignored, so retrying a batch whose
+    response was lost never inserts it twice.
+    """
+    rows = [{"id": str(uuid.uuid4()), **row} for row in rows]
 
-def find_document_by_source(source_path: str):
-    url = f"{SUPABASE_URL}/rest/v1/knowledge_documents"
-    rows = supabase_get(url, params={"source": f"eq.{source_path}"})
-    return rows[0] if rows else None
+    def send(batch):
+        # write_in_batches owns the retries (and reports batches that still fail)
+        db.bulk_insert(table, batch, timeout=120, retries=0)
+
+    return write_in_batches(rows, send, f"insert into {table}", batch_size)
+
+def update_rows(table: str, where: dict, values: dict):
+    db.update(table, where, values)
+
+def fetch_documents_by_source() -> dict:
+    """One round trip for all known documents: {source: {id, source, metadata}}."""
+    rows = db.select("knowledge_documents", {"select": "id,source,metadata"})
+    return {r["source"]: r for r in rows}
+
+def fetch_canonical_chunks(page_size: int = 1000):
+    """
+    Yields {id, content_hash, dedup_key, filename, kind, chunk_index, doc_type, tenant} for
+    every embedded chunk, paging by id (keyset) so large tables don't pay for OFFSET scans.
+    """
+    yield from db.select_pages("knowledge_chunks", {
+        "select": "id,chunk_index,doc_type,tenant,content_hash:metadata->>content_hash,"
+                  "dedup_key:metadata->>dedup_key,filename:metadata->>filename,kind:metadata->>kind",
+        "embedding": "not.is.null",
+    }, page_size=page_size)
+
+def partition_filter(doc_type: str, tenant) -> dict:
+    return {"doc_type": f"eq.{doc_type}", "tenant": f"eq.{tenant}" if tenant else "is.null"}
+
+def fetch_duplicates_of(content_hashes: list, doc_type: str, tenant) -> list:
+    """Chunks in one partition stored as duplicates of any of the given canonical content hashes."""
+    out = []
+    for i in range(0, len(content_hashes), 100):
+        part = ",".join(content_hashes[i:i + 100])
+        out.extend(db.select("knowledge_chunks", {
+            "select": "id,document_id",
+            "metadata->duplicate_of->>content_hash": f"in.({part})",
+            **partition_filter(doc_type, tenant),
+        }))
+    return out
+
+def seed_dedup(dedup: PartitionedDedup, store: SignatureStore):
+    """
+    Loads every stored canonical chunk into its partition's dedup index, with its MinHash
+    signature so near-duplicates are found across runs. Signatures missing from the local
+    store (first run, another machine) are rebuilt from the chunk text once and saved.
+    Row chunks (EXACT_ONLY_KINDS) are seeded for exact matching only.
+    """
+    rows = [r for r in fetch_canonical_chunks() if r.get("content_hash") and r.get("dedup_key")]
+    prose = [r for r in rows if r.get("kind") not in EXACT_ONLY_KINDS]
+    signatures = store.get_many([r["content_hash"] for r in prose])
+    missing = [r for r in prose if r["content_hash"] not in signatures]
+    rebuilt = {}
+    for i in range(0, len(missing), 100):
+        ids = ",".join(r["id"] for r in missing[i:i + 100])
+        for row in db.select("knowledge_chunks", {"select": "id,content,content_hash:metadata->>content_hash",
+                                                  "id": f"in.({ids})"}):
+            rebuilt[row["content_hash"]] = minhash_signature(row["content"] or "")
+    if rebuilt:
+        store.put_many(rebuilt)
+        signatures.update(rebuilt)
+    for row in rows:
+        dedup.partition(row.get("doc_type") or DEFAULT_DOC_TYPE, row.get("tenant")).add_existing(
+            row["content_hash"], row["dedup_key"],
+            {"filename": row.get("filename"), "chunk_index": row.get("chunk_index")},
+            signatures.get(row["content_hash"]) if row.get("kind") not in EXACT_ONLY_KINDS else None)
+
+def fetch_document_chunks(doc_id: str, page_size: int = 1000) -> list:
+    """
+    Returns [{id, chunk_index, content_hash, duplicate_of, kind, duplicate_similarity}] for
+    every chunk of a document (duplicate_of: the canonical's content hash, None for a
+    canonical chunk), ordered by chunk_index. Pages by id (keyset) because PostgREST caps a single response.
+    """
+    rows = list(db.select_pages("knowledge_chunks", {
+        "select": "id,chunk_index,content_hash:metadata->>content_hash,"
+                  "duplicate_of:metadata->duplicate_of->>content_hash,kind:metadata->>kind,"
+                  "duplicate_similarity:metadata->duplicate_of->>similarity",
+        "document_id": f"eq.{doc_id}",
+    }, page_size=page_size))
+    rows.sort(key=lambda r: r["chunk_index"])
+    return rows
 
 
 # ---------------------------
-# Chunking + Embeddings
+# Embeddings
 # ---------------------------
-def chunk_text(text: str, chunk_size: int = 900, overlap: int = 120):
-    text = (text or "").strip()
-    if not text:
-        return []
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(len(text), start + chunk_size)
-        chunks.append(text[start:end])
-        if end == len(text):
-            break
-        start = max(0, end - overlap)
-    return chunks
+_embedder = None
+_embedder_lock = threading.Lock()
+
+def get_embedder() -> AsyncEmbeddingClient:
+    """Rate-limited, retrying embeddings client; created on first use (not in parse workers)."""
+    global _embedder
+    with _embedder_lock:   # several embed threads ask for it at once
+        if _embedder is None:
+            _embedder = AsyncEmbeddingClient(api_key=OPENAI_API_KEY)
+        return _embedder
 
 def embed_texts(texts):
-    emb = client.embeddings.create(model="text-embedding-3-small", input=texts)
-    return [d.embedding for d in emb.data]
+    return embed_with_cache(get_embedder(), texts)
 
-def to_pgvector(vec):
-    return "[" + ",".join(str(x) for x in vec) + "]"
+
+# ---------------------------
+# Content hashes (incremental re-ingestion)
+# ---------------------------
+def hash_file(path: str) -> str:
+    """
+    sha256 of the file bytes plus the chunker and dedup versions (a new chunker or dedup
+    policy invalidates old chunks).
+    """
+    h = hashlib.sha256(f"chunker:{CHUNKER_VERSION}\ndedup:{DEDUP_VERSION}\n".encode("utf-8"))
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def doc_type_for(path: str) -> str:
+    name = os.path.basename(path).lower()
+    for doc_type, keywords in DOC_TYPE_RULES:
+        if any(k in name for k in keywords):
+            return doc_type
+    return DEFAULT_DOC_TYPE
+
+
+# ---------------------------
+# Structured connector index (agent fast path for connector lookups)
+# ---------------------------
+def refresh_connector_index(paths: list, file_hashes: dict):
+    """Rebuild .cache/connector_index.json when its source workbook changed (or it is missing)."""
+    current = connector_index.load_index()
+    for path in paths:
+        if os.path.splitext(path)[1].lower() != ".xlsx":
+            continue
+        if current.get("source") == os.path.basename(path) and current.get("content_hash") == file_hashes[path]:
+            return
+        try:
+            index = connector_index.build_from_workbook(path, content_hash=file_hashes[path])
+        except Exception as e:
+            print(f"⚠️ {os.path.basename(path)}: connector index not built: {e}")
+            continue
+        if index:
+            connector_index.save_index(index)
+            print(f"Connector index: {len(index['records'])} connectors from {os.path.basename(path)} "
+                  f"→ {connector_index.INDEX_PATH}")
+            return
 
 
 # ---------------------------
 # File readers
 # ---------------------------
-def read_docx_as_text(path: str) -> str:
-    doc = Document(path)
-    parts = []
-    for p in doc.paragraphs:
-        t = (p.text or "").strip()
-        if t:
-            parts.append(t)
-    return "\n".join(parts)
+def read_docx_as_chunks(path: str) -> list:
+    """Heading-aware text chunks plus one chunk per table row (see chunking.py)."""
+    return chunk_docx(Document(path))
 
 def read_text_file(path: str) -> str:
     with open(path, "r", encoding="utf-8", errors="ignore") as f:
@@ -113,47 +278,61 @@ def read_xlsx_as_row_chunks(path: str):
     """
     IMPORTANT:
     Excel is chunked by ROW so retrieval works well for specific connector names like "SharePoint".
-    """
-    wb = load_workbook(path, data_only=True)
-    row_chunks = []
 
-    for sheet in wb.worksheets:
-        rows = list(sheet.iter_rows(values_only=True))
-        if not rows:
-            continue
-
-        header = [str(c).strip() for c in rows[0] if c is not None]
-        header = header if header else []
-
-        for r in rows[1:]:
-            cells = [("" if c is None else str(c).strip()) for c in r]
-            if not any(cells):
+    Streams rows (read-only workbook, one row in memory at a time) and yields one chunk
+    per row, so memory stays flat however large the workbook is.
+    Yields {"content": str, "metadata": {"sheet": str, "kind": "row"}}.
+    """
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for sheet in wb.worksheets:
+            rows = sheet.iter_rows(values_only=True)
+            first = next(rows, None)
+            if first is None:
                 continue
 
-            if header and len(header) <= len(cells):
-                pairs = []
-                for i, h in enumerate(header):
-                    v = cells[i] if i < len(cells) else ""
-                    if h and v:
-                        pairs.append(f"{h}: {v}")
-                chunk = " | ".join(pairs) if pairs else " | ".join([c for c in cells if c])
-            else:
-                chunk = " | ".join([c for c in cells if c])
-
-            chunk = f"[Sheet: {sheet.title}] {chunk}"
-            row_chunks.append(chunk)
-
-    return row_chunks
+            header = [str(c).strip() for c in first if c is not None]
+            header = header if header else []
+
+            for r in rows:
+                cells = [("" if c is None else str(c).strip()) for c in r]
+                if not any(cells):
+                    continue
+
+                if header and len(header) <= len(cells):
+                    pairs = []
+                    for i, h in enumerate(header):
+                        v = cells[i] if i < len(cells) else ""
+                        if h and v:
+                            pairs.append(f"{h}: {v}")
+                    chunk = " | ".join(pairs) if pairs else " | ".join([c for c in cells if c])
+                else:
+                    chunk = " | ".join([c for c in cells if c])
+
+                yield {
+                    "content": f"[Sheet: {sheet.title}] {chunk}",
+                    "metadata": {"sheet": sheet.title, "kind": "row"},
+                }
+    finally:
+        wb.close()
+
+def iter_file_chunks(path: str):
+    """Yields the non-empty {content, metadata} chunks of a file; .xlsx is streamed row by row."""
+    ext = os.path.splitext(path)[1].lower()
+    chunks = read_xlsx_as_row_chunks(path) if ext == ".xlsx" else load_file_chunks(path)
+    for c in chunks:
+        content = (c["content"] or "").strip()
+        if content:
+            yield {"content": content, "metadata": c["metadata"]}
 
 def load_file_chunks(path: str):
     ext = os.path.splitext(path)[1].lower()
 
     if ext == ".docx":
-        text = read_docx_as_text(path)
-        return chunk_text(text)
+        return read_docx_as_chunks(path)
 
     if ext == ".xlsx":
-        return read_xlsx_as_row_chunks(path)
+        return list(read_xlsx_as_row_chunks(path))
 
     if ext in [".txt", ".md"]:
         text = read_text_file(path)
@@ -161,6 +340,327 @@ def load_file_chunks(path: str):
 
     raise ValueError(f"Unsupported file type: {ext}")
 
+def is_streamed(path: str) -> bool:
+    """Files read incrementally by the planner instead of parsed whole in a worker process."""
+    return os.path.splitext(path)[1].lower() == ".xlsx"
+
+def parse_file(path: str):
+    """Parse stage (runs in a worker process): returns (path, chunks)."""
+    return path, list(iter_file_chunks(path))
+
+
+# ---------------------------
+# Pipeline plumbing
+# ---------------------------
+class StageQueue:
+    """Bounded queue that records depth on every put, for backpressure metrics."""
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.q = queue.Queue(maxsize=maxsize)
+        self.maxsize = maxsize
+        self.samples = 0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.blocked_s = 0.0
+
+    def put(self, item):
+        t0 = time.perf_counter()
+        self.q.put(item)
+        self.blocked_s += time.perf_counter() - t0
+        depth = self.q.qsize()
+        self.samples += 1
+        self.depth_sum += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    def get(self):
+        return self.q.get()
+
+    def task_done(self):
+        self.q.task_done()
+
+    def join(self):
+        """Blocks until every item put so far has been processed."""
+        self.q.join()
+
+    def report(self) -> str:
+        avg = self.depth_sum / self.samples if self.samples else 0
+        return (f"{self.name}: avg depth {avg:.1f}/{self.maxsize}, max {self.depth_max}, "
+                f"producer blocked {self.blocked_s:.1f}s")
+
+
+class StageTimer:
+    """Accumulates busy time per stage; the slowest stage bounds total wall time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = {}
+        self.items = {}
+
+    def add(self, stage: str, seconds: float, items: int = 1):
+        with self.lock:
+            self.busy[stage] = self.busy.get(stage, 0.0) + seconds
+            self.items[stage] = self.items.get(stage, 0) + items
+
+    def report(self) -> list:
+        return [f"{stage}: {self.busy[stage]:.1f}s busy, {self.items[stage]} items"
+                for stage in self.busy]
+
+
+class DocumentJob:
+    """
+    Per-file state shared by the planner, embed and write stages. A document is finalised
+    once planning has finished AND every embed batch it produced has been written;
+    whichever of the two happens last triggers it.
+    """
+
+    def __init__(self, path: str, doc_id: str, file_hash: str, doc_metadata: dict):
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.doc_id = doc_id
+        self.file_hash = file_hash
+        self.doc_metadata = doc_metadata
+        self.total_chunks = 0
+        self.embedded = 0
+        self.duplicates = 0
+        self.stale = 0
+        self.failures = []
+        self.lock = threading.Lock()
+        self.pending_batches = 0
+        self.planned = False
+
+    def add_batch(self):
+        with self.lock:
+            self.pending_batches += 1
+
+    def batch_done(self) -> bool:
+        """Returns True if this was the last outstanding batch of a fully planned document."""
+        with self.lock:
+            self.pending_batches -= 1
+            return self.planned and self.pending_batches == 0
+
+    def planning_done(self) -> bool:
+        """Returns True if no batches are outstanding (the caller must finalise)."""
+        with self.lock:
+            self.planned = True
+            return self.pending_batches == 0
+
+
+def renumber_chunks(moved: list) -> list:
+    return write_in_batches(
+        [{"id": row_id, "chunk_index": new_index} for row_id, new_index in moved],
+        lambda batch: rpc("renumber_knowledge_chunks", {"updates": batch}),
+        "renumber knowledge_chunks",
+        batch_size=1000,
+    )
+
+
+def plan_document(path: str, chunks, file_hash: str, existing, embed_q, write_q,
+                  dedup_parts: PartitionedDedup, deleted_hashes: set) -> DocumentJob:
+    """
+    Diff the chunks against what is stored (by content hash) while they are produced:
+    unchanged chunks are re-numbered if they moved, new text is checked against the dedup
+    index and either sent to the embed stage (canonical) or written without an embedding
+    (duplicate), and stored chunks that no longer occur are deleted at the end.
+    `chunks` may be a generator; it is consumed once, so a full embed queue pauses reading.
+
+    Dedup is scoped to the document's partition (doc_type, tenant); deleted_hashes collects
+    (doc_type, tenant, content_hash) of canonical chunks that left a partition.
+
+    Returns the DocumentJob; job.total_chunks is the number of chunks seen.
+    """
+    filename = os.path.basename(path)
+    doc_metadata = {"folder": RAG_FOLDER, "type": os.path.splitext(filename)[1].lower(),
+                    "doc_type": doc_type_for(path), "tenant": TENANT_ID}
+    partition = (doc_metadata["doc_type"], TENANT_ID)
+    dedup = dedup_parts.partition(*partition)
+
+    if existing:
+        doc_id = existing["id"]
+        old_meta = existing.get("metadata") or {}
+        old_chunks = fetch_document_chunks(doc_id)
+        old_partition = (old_meta.get("doc_type") or DEFAULT_DOC_TYPE, old_meta.get("tenant"))
+        if old_partition != partition:
+            # Chunks kept as they are must land in the same partition as the new ones.
+            # Canonicals move along (their old partition's duplicates are re-planned, see
+            # main()); this document's duplicates would point across partitions, so they are
+            # dropped and their text is deduplicated again below, in the new partition.
+            update_rows("knowledge_chunks", {"document_id": f"eq.{doc_id}"},
+                        {"doc_type": doc_metadata["doc_type"], "tenant": TENANT_ID})
+            old_dedup = dedup_parts.partition(*old_partition)
+            dup_ids = []
+            for row in old_chunks:
+                if row.get("duplicate_of") is not None:
+                    dup_ids.append(row["id"])
+                elif row.get("content_hash"):
+                    dedup_parts.move(row["content_hash"], old_dedup, dedup)
+                    deleted_hashes.add((*old_partition, row["content_hash"]))
+            for i in range(0, len(dup_ids), 100):
+                delete_rows("knowledge_chunks", {"id": f"in.({','.join(dup_ids[i:i + 100])})"})
+            old_chunks = [row for row in old_chunks if row.get("duplicate_of") is None]
+    else:
+        # content_hash is only written once all chunks are stored, so an interrupted
+        # run is never mistaken for an unchanged file next time.
+        doc_row = insert_row("knowledge_documents", {
+            "title": filename,
+            "source": path,
+            "metadata": doc_metadata
+        })
+        doc_id = doc_row["id"]
+        old_chunks = []
+
+    job = DocumentJob(path, doc_id, file_hash, doc_metadata)
+
+    # Match new chunks to stored ones by content hash; only unmatched text gets embedded.
+    # Rows stored as near-duplicates before row chunks became exact-only are not reused:
+    # they are dropped and their text is stored again as a canonical, embedded chunk.
+    stored_by_hash, requeued_ids = {}, []
+    for row in old_chunks:
+        if (row.get("kind") in EXACT_ONLY_KINDS and row.get("duplicate_of") is not None
+                and float(row.get("duplicate_similarity") or 1.0) < 1.0):
+            requeued_ids.append(row["id"])
+            continue
+        stored_by_hash.setdefault(row.get("content_hash"), []).append(row)
+    del old_chunks
+    for rows in stored_by_hash.values():
+        rows.sort(key=lambda r: r.get("duplicate_of") is not None)   # keep canonical copies first
+
+    batch = []      # (chunk_index, content, content_hash, extra metadata) to embed
+    dups = []       # same shape, written without an embedding
+    moved = []      # (row_id, new chunk_index)
+    for i, item in enumerate(chunks):
+        job.total_chunks += 1
+        chunk = item["content"]
+        h = hash_text(chunk)
+        candidates = stored_by_hash.get(h)
+        if candidates:
+            row = candidates.pop(0)
+            if row["chunk_index"] != i:
+                moved.append((row["id"], i))
+                if len(moved) >= 1000:
+                    job.failures += renumber_chunks(moved)
+                    moved = []
+            continue
+
+        key, signature, canonical = dedup.find(chunk, near=item["metadata"].get("kind") not in EXACT_ONLY_KINDS)
+        if canonical:
+            dups.append((i, chunk, h, {**item["metadata"], "dedup_key": key, "duplicate_of": canonical}))
+            if len(dups) >= INSERT_BATCH_SIZE:
+                job.duplicates += len(dups)
+                job.add_batch()
+                write_q.put((job, dups, None, None))
+                dups = []
+            continue
+
+        dedup.add(h, key, signature, {"filename": filename, "chunk_index": i})
+        batch.append((i, chunk, h, {**item["metadata"], "dedup_key": key}))
+        if len(batch) >= EMBED_BATCH_SIZE:
+            job.embedded += len(batch)
+            job.add_batch()
+            embed_q.put((job, batch))
+            batch = []
+
+    if batch:
+        job.embedded += len(batch)
+        job.add_batch()
+        embed_q.put((job, batch))
+    if dups:
+        job.duplicates += len(dups)
+        job.add_batch()
+        write_q.put((job, dups, None, None))
+    job.failures += renumber_chunks(moved)
+
+    # Drop chunks whose text no longer exists. If one was a canonical copy, the dedup index
+    # forgets it and its duplicates are re-embedded after this pass (see main()). A stale
+    # duplicate shares its canonical's content hash (exact copies), so it must not touch
+    # the index: the canonical elsewhere is still live.
+    stale_ids = [row["id"] for rows in stored_by_hash.values() for row in rows] + requeued_ids
+    for h, rows in stored_by_hash.items():
+        if h and any(row.get("duplicate_of") is None for row in rows):
+            dedup.remove(h)
+            deleted_hashes.add((*partition, h))
+    job.stale = len(stale_ids)
+    for i in range(0, len(stale_ids), 100):
+        ids = ",".join(stale_ids[i:i + 100])
+        delete_rows("knowledge_chunks", {"id": f"in.({ids})"})
+
+    if job.planning_done():
+        # Nothing left in flight: let the writer finalise it in order with other work.
+        write_q.put((job, None, None, None))
+    return job
+
+
+def finish_document(job: DocumentJob, failed_files: list):
+    if job.failures:
+        # Leave the document hash untouched so the next run retries this file.
+        failed_rows = sum(f["end"] - f["start"] for f in job.failures)
+        print(f"❌ {job.filename}: {len(job.failures)} batch(es) / {failed_rows} rows failed; will retry next run.")
+        failed_files.append(job.filename)
+        return
+
+    update_rows("knowledge_documents", {"id": f"eq.{job.doc_id}"}, {
+        "title": job.filename,
+        "metadata": {**job.doc_metadata, "content_hash": job.file_hash}
+    })
+
+    kept = job.total_chunks - job.embedded - job.duplicates
+    print(f"✅ Ingested {job.filename}: {job.total_chunks} chunks "
+          f"({job.embedded} embedded, {job.duplicates} duplicates, {kept} unchanged, {job.stale} removed)")
+
+
+def embed_worker(embed_q: StageQueue, write_q: StageQueue, timer: StageTimer):
+    """Embed stage: turns (job, items) batches into (job, items, embeddings)."""
+    while True:
+        task = embed_q.get()
+        if task is None:
+            return
+        job, items = task
+        t0 = time.perf_counter()
+        try:
+            embeddings = embed_texts([chunk for _, chunk, _, _ in items])
+            write_q.put((job, items, embeddings, None))
+        except Exception as e:
+            write_q.put((job, items, None, e))
+        timer.add("embed", time.perf_counter() - t0, len(items))
+        embed_q.task_done()
+
+
+def write_worker(write_q: StageQueue, timer: StageTimer, failed_files: list):
+    """Write stage: bulk-inserts embedded batches and finalises a document after its last batch."""
+    while True:
+        task = write_q.get()
+        if task is None:
+            return
+        job, items, embeddings, error = task
+        if items is None:
+            finish_document(job, failed_files)
+            write_q.task_done()
+            continue
+        t0 = time.perf_counter()
+        if error is not None:
+            print(f"⚠️ {job.filename}: embedding batch failed: {error}")
+            job.failures.append({"start": items[0][0], "end": items[-1][0] + 1, "error": str(error)})
+        else:
+            # embeddings is None for duplicate batches: they are stored but never searched
+            vectors = embeddings if embeddings is not None else [None] * len(items)
+            job.failures += insert_rows("knowledge_chunks", [
+                {
+                    "document_id": job.doc_id,
+                    "chunk_index": i,
+                    "content": chunk,
+                    "embedding": to_pgvector(emb) if emb is not None else None,
+                    "doc_type": job.doc_metadata["doc_type"],
+                    "sheet_name": extra.get("sheet"),
+                    "tenant": TENANT_ID,
+                    "metadata": {"filename": job.filename, "content_hash": h, **extra}
+                }
+                for (i, chunk, h, extra), emb in zip(items, vectors)
+            ])
+        if job.batch_done():
+            finish_document(job, failed_files)
+        timer.add("write", time.perf_counter() - t0, len(items))
+        write_q.task_done()
+
 
 # ---------------------------
 # Main ingestion
@@ -187,52 +687,154 @@ def main():
 
     print(f"=== Ingesting knowledge files from: {RAG_FOLDER}/ ===")
     print(f"Found {len(paths)} files.")
+    started = time.perf_counter()
 
+    documents = fetch_documents_by_source()
+    file_hashes = {}
+    changed = []
     for path in paths:
-        filename = os.path.basename(path)
-        print(f"\n--- {filename} ---")
-
-        # Overwrite behavior per file: delete old + re-ingest
-        existing = find_document_by_source(path)
-        if existing:
-            print("Found existing document in Supabase → cleaning old chunks...")
-            delete_rows("knowledge_chunks", {"document_id": f"eq.{existing['id']}"})
-            delete_rows("knowledge_documents", {"id": f"eq.{existing['id']}"})
-
-        # Insert document row
-        doc_row = insert_row("knowledge_documents", {
-            "title": filename,
-            "source": path,
-            "metadata": {"folder": RAG_FOLDER, "type": os.path.splitext(filename)[1].lower()}
-        })
-        doc_id = doc_row["id"]
-
-        # Load chunks
-        chunks = load_file_chunks(path)
-        chunks = [c.strip() for c in chunks if (c or "").strip()]
-        if not chunks:
-            print("⚠️ No usable content found. Skipping.")
-            continue
-
-        # Embed in batches
-        all_embeddings = []
-        batch_size = 64
-        for i in range(0, len(chunks), batch_size):
-            batch = chunks[i:i + batch_size]
-            all_embeddings.extend(embed_texts(batch))
-
-        # Insert chunks
-        for i, (chunk, emb) in enumerate(zip(chunks, all_embeddings)):
-            insert_row("knowledge_chunks", {
-                "document_id": doc_id,
-                "chunk_index": i,
-                "content": chunk,
-                "embedding": to_pgvector(emb),
-                "metadata": {"filename": filename}
-            })
-
-        print(f"✅ Ingested {filename}: {len(chunks)} chunks")
-
+        file_hashes[path] = hash_file(path)
+        existing = documents.get(path)
+        meta = (existing or {}).get("metadata") or {}
+        if existing and meta.get("content_hash") == file_hashes[path]:
+            if meta.get("doc_type") == doc_type_for(path) and meta.get("tenant") == TENANT_ID:
+                print(f"{os.path.basename(path)}: unchanged since last ingestion (content hash match) → skipping.")
+                continue
+            # same text, new partition: re-planned so its chunks are moved and deduplicated
+            # in the new partition (no re-embedding: every chunk matches by content hash)
+            print(f"{os.path.basename(path)}: moving to doc_type={doc_type_for(path)}, tenant={TENANT_ID}.")
+        changed.append(path)
+    skipped = len(paths) - len(changed)
+    refresh_connector_index(paths, file_hashes)
+
+    # parse (process pool) → embed (thread pool, bounded) → write (single writer)
+    timer = StageTimer()
+    failed_files = []
+    embed_q = StageQueue("embed queue", EMBED_QUEUE_SIZE)
+    write_q = StageQueue("write queue", WRITE_QUEUE_SIZE)
+
+    embedders = [threading.Thread(target=embed_worker, args=(embed_q, write_q, timer), daemon=True)
+                 for _ in range(EMBED_CONCURRENCY)]
+    writer = threading.Thread(target=write_worker, args=(write_q, timer, failed_files), daemon=True)
+    for t in embedders + [writer]:
+        t.start()
+
+    # Exact- and near-duplicate detection also covers chunks stored by earlier runs.
+    dedup = PartitionedDedup()
+    signature_store = SignatureStore()
+    deleted_hashes = set()
+    if changed:
+        seed_dedup(dedup, signature_store)
+
+    doc_jobs = {}
+
+    def plan(path, chunks, existing=None):
+        t0 = time.perf_counter()
+        try:
+            existing = existing or documents.get(path)
+            job = plan_document(path, chunks, file_hashes[path], existing, embed_q, write_q,
+                                dedup, deleted_hashes)
+        except Exception as e:
+            print(f"❌ {os.path.basename(path)}: ingestion failed: {e}")
+            failed_files.append(os.path.basename(path))
+            return
+        finally:
+            timer.add("parse + plan (main thread)", time.perf_counter() - t0)
+        doc_jobs[job.doc_id] = job
+        if not job.total_chunks:
+            print(f"⚠️ {os.path.basename(path)}: no usable content found.")
+
+    with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+        futures = {pool.submit(parse_file, path): path for path in changed if not is_streamed(path)}
+
+        # Spreadsheets stream straight from the reader into the embed queue while the
+        # pool parses the other documents.
+        for path in changed:
+            if is_streamed(path):
+                plan(path, iter_file_chunks(path))
+
+        t_wait = time.perf_counter()
+        for fut in as_completed(futures):
+            timer.add("parse (waiting on workers)", time.perf_counter() - t_wait)
+            path = futures[fut]
+            try:
+                _, chunks = fut.result()
+            except Exception as e:
+                print(f"❌ {os.path.basename(path)}: parse failed: {e}")
+                failed_files.append(os.path.basename(path))
+            else:
+                plan(path, chunks)
+            t_wait = time.perf_counter()
+
+    # Duplicates whose canonical chunk was deleted this run would become unsearchable:
+    # drop them and re-plan their documents so they get embedded (or re-deduplicated).
+    embed_q.join()
+    write_q.join()
+    orphaned = {}
+    for doc_type, tenant, h in deleted_hashes:
+        if h not in dedup.partition(doc_type, tenant):
+            orphaned.setdefault((doc_type, tenant), []).append(h)
+    orphans = [o for (doc_type, tenant), hashes in orphaned.items()
+               for o in fetch_duplicates_of(hashes, doc_type, tenant)]
+    if orphans:
+        # the document record as now stored: re-planning must not see a partition change
+        known = {d["id"]: d for d in documents.values()}
+        known.update({doc_id: {"id": doc_id, "source": job.path, "metadata": job.doc_metadata}
+                      for doc_id, job in doc_jobs.items()})
+        for i in range(0, len(orphans), 100):
+            ids = ",".join(o["id"] for o in orphans[i:i + 100])
+            delete_rows("knowledge_chunks", {"id": f"in.({ids})"})
+        print(f"\nRe-planning {len({o['document_id'] for o in orphans})} document(s) "
+              f"with {len(orphans)} orphaned duplicate chunk(s)...")
+        for doc_id in {o["document_id"] for o in orphans}:
+            doc = known.get(doc_id)
+            path = doc["source"] if doc else None
+            if path in file_hashes:
+                plan(path, iter_file_chunks(path), existing=doc)
+            else:
+                print(f"⚠️ Source for document {doc_id} is no longer in '{RAG_FOLDER}'; skipped.")
+
+    for _ in embedders:
+        embed_q.put(None)
+    for t in embedders:
+        t.join()
+    write_q.put(None)
+    writer.join()
+    signature_store.put_many(dedup.new_signatures())
+
+    # Size / rebuild the vector index (and doc_type partitions) for the new row counts and
+    # refresh planner stats.
+    if changed:
+        t0 = time.perf_counter()
+        try:
+            # an index build can take minutes on a large corpus: longer timeout than rpc()
+            result = db.rpc("maintain_knowledge_chunk_index", {
+                "method": VECTOR_INDEX_METHOD, "min_rows": VECTOR_INDEX_MIN_ROWS,
+                "quantization": VECTOR_INDEX_QUANTIZATION, "reduced_dims": VECTOR_INDEX_REDUCED_DIMS,
+            }, timeout=1800)
+            timer.add("vector index maintenance", time.perf_counter() - t0)
+            print(f"\nVector index: {result}")
+        except requests.RequestException as e:
+            print(f"\n⚠️ Vector index maintenance failed (search still works, maybe slower): {e}")
+
+    print("\n=== Pipeline metrics ===")
+    for line in timer.report():
+        print(f"  {line}")
+    print(f"  {embed_q.report()}")
+    print(f"  {write_q.report()}")
+    print(f"  wall time: {time.perf_counter() - started:.1f}s")
+    print(f"  {get_cache().stats_line()}")
+    if _embedder is not None:
+        print(f"  {_embedder.stats_line()}")
+    print(f"  Dedup: {dedup.exact_hits} exact + {dedup.near_hits} near-duplicate chunks not embedded")
+    print(f"  {db.stats_line()}")
+    for line in db.report():
+        print(f"    {line}")
+
+    if skipped:
+        print(f"\nSkipped {skipped} unchanged file(s).")
+    if failed_files:
+        raise SystemExit(f"\n❌ Partial failure, re-run to retry: {', '.join(failed_files)}")
     print("\n🎉 Done. Knowledge base is ready for RAG.")
 
 if __name__ == "__main__":
@@ -2,17 +2,14 @@ import os
 import re
 import csv
 import time
-import warnings
 from typing import List, Dict, Any
 
 from dotenv import load_dotenv
-import requests
 import httpx
 from openai import OpenAI
 
-# Hide SSL warning spam (because you're using verify=False)
-from urllib3.exceptions import InsecureRequestWarning
-warnings.simplefilter("ignore", InsecureRequestWarning)
+from embedding_cache import embed_one, get_cache
+from supabase_client import get_client
 
 load_dotenv()
 
@@ -27,11 +24,8 @@ if not all([SUPABASE_URL, SERVICE_KEY, OPENAI_API_KEY]):
 http_client = httpx.Client(verify=False, timeout=60.0)
 client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
 
-headers = {
-    "apikey": SERVICE_KEY,
-    "Authorization": f"Bearer {SERVICE_KEY}",
-    "Content-Type": "application/json"
-}
+# Pooled keep-alive Supabase session (see supabase_client.py)
+db = get_client()
 
 # Paths (match your repo)
 GOLDEN_MD_PATH = os.path.join("docs", "day8_golden_questions.md")
@@ -40,18 +34,28 @@ OUTPUT_CSV_PATH = os.path.join("Supabase DB", "day8_rag_results.csv")
 # Day 8 canonical categories (what your dashboard should use)
 EXPECTED_SECTIONS = ["factual", "inferential", "procedural", "out_of_scope", "adversarial"]
 
+# Vector index recall/latency knob (HNSW ef_search); pick it with 06_vector_index_benchmark.py
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH", "40"))
+
+# Retrieval backend: "supabase" (RPC over the network) or "local" (mmap snapshot, see local_index.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "supabase").lower()
+
 # -----------------------------
 # Supabase + Embeddings
 # -----------------------------
 def rpc(fn_name: str, payload: Dict[str, Any]) -> Any:
-    url = f"{SUPABASE_URL}/rest/v1/rpc/{fn_name}"
-    r = requests.post(url, headers=headers, json=payload, verify=False, timeout=60)
-    r.raise_for_status()
-    return r.json()
+    # only read-only retrieval RPCs here: safe to retry
+    return db.rpc(fn_name, payload, retries=db.max_retries)
+
+def search_rpc(fn_name: str, payload: dict):
+    """Retrieval RPCs go to the local snapshot when RETRIEVAL_BACKEND=local."""
+    if RETRIEVAL_BACKEND == "local":
+        from local_index import get_local_index   # numpy only needed in local mode
+        return get_local_index().rpc(fn_name, payload)
+    return rpc(fn_name, payload)
 
 def embed(text: str) -> List[float]:
-    emb = client.embeddings.create(model="text-embedding-3-small", input=[text])
-    return emb.data[0].embedding
+    return embed_one(client, text)
 
 # -----------------------------
 # Parsing Golden Questions
@@ -145,9 +149,10 @@ def parse_questions_from_md(md_path: str) -> List[Dict[str, Any]]:
 # -----------------------------
 def run_retrieval(question: str, k: int = 5) -> List[Dict[str, Any]]:
     q_emb = embed(question)
-    results = rpc("search_knowledge_chunks", {
+    results = search_rpc("search_knowledge_chunks", {
         "query_embedding": q_emb,
-        "match_count": k
+        "match_count": k,
+        "ef_search": VECTOR_EF_SEARCH,
     })
     return results
 
@@ -252,6 +257,14 @@ def main():
     print(f"Saved results CSV: {OUTPUT_CSV_PATH}")
     print(f"Retrieval pass rate: {pass_count}/{total} = {round(pass_count/total*100, 1)}%")
     print(f"Total runtime: {elapsed}s")
+    print(get_cache().stats_line())
+    if RETRIEVAL_BACKEND == "local":
+        from local_index import get_local_index
+        print(get_local_index().stats_line())
+    else:
+        print(db.stats_line())
+        for line in db.report():
+            print(f"  {line}")
     print("\nNext step: Refresh your Streamlit dashboard — the charts should now work correctly.")
 
 if __name__ == "__main__":
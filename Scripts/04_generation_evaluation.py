@@ -2,15 +2,13 @@ import os
 import re
 import csv
 import json
-import time
-import warnings
 from dotenv import load_dotenv
-import requests
 import httpx
 from openai import OpenAI
 
-from urllib3.exceptions import InsecureRequestWarning
-warnings.simplefilter("ignore", InsecureRequestWarning)
+from embedding_cache import embed_one, get_cache
+from supabase_client import get_client
+from streaming_chat import stream_chat
 
 load_dotenv()
 
@@ -21,33 +19,42 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 http_client = httpx.Client(verify=False, timeout=60.0)
 client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
 
-headers = {
-    "apikey": SERVICE_KEY,
-    "Authorization": f"Bearer {SERVICE_KEY}",
-    "Content-Type": "application/json"
-}
+# Pooled keep-alive Supabase session (see supabase_client.py)
+db = get_client()
 
 GOLDEN_PATH = os.path.join("docs", "day8_golden_questions.md")
 OUTPUT_PATH = os.path.join("Supabase DB", "day8_generation_eval.csv")
 
+# Vector index recall/latency knob (HNSW ef_search); pick it with 06_vector_index_benchmark.py
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH", "40"))
+
+# Retrieval backend: "supabase" (RPC over the network) or "local" (mmap snapshot, see local_index.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "supabase").lower()
+
 
 def rpc(fn_name, payload):
-    url = f"{SUPABASE_URL}/rest/v1/rpc/{fn_name}"
-    r = requests.post(url, headers=headers, json=payload, verify=False)
-    r.raise_for_status()
-    return r.json()
+    # only read-only retrieval RPCs here: safe to retry
+    return db.rpc(fn_name, payload, retries=db.max_retries)
+
+
+def search_rpc(fn_name: str, payload: dict):
+    """Retrieval RPCs go to the local snapshot when RETRIEVAL_BACKEND=local."""
+    if RETRIEVAL_BACKEND == "local":
+        from local_index import get_local_index   # numpy only needed in local mode
+        return get_local_index().rpc(fn_name, payload)
+    return rpc(fn_name, payload)
 
 
 def embed(text):
-    emb = client.embeddings.create(model="text-embedding-3-small", input=[text])
-    return emb.data[0].embedding
+    return embed_one(client, text)
 
 
 def retrieve_context(question):
     q_emb = embed(question)
-    results = rpc("search_knowledge_chunks", {
+    results = search_rpc("search_knowledge_chunks", {
         "query_embedding": q_emb,
-        "match_count": 5
+        "match_count": 5,
+        "ef_search": VECTOR_EF_SEARCH,
     })
     context = "\n".join([r["content"] for r in results])
     return context
@@ -66,11 +73,9 @@ Question:
 If answer is not in context, say:
 "I cannot find this in the available documents."
 """
-    resp = client.chat.completions.create(
-        model="gpt-5-nano",
-        messages=[{"role": "user", "content": prompt}]
-    )
-    return resp.choices[0].message.content
+    # streamed like the agent, so time-to-first-token is measured the same way
+    gen = stream_chat(client, "gpt-5-nano", [{"role": "user", "content": prompt}])
+    return gen["text"], gen["ttft_ms"], gen["total_ms"]
 
 
 def grade_answer(question, answer, context):
@@ -139,7 +144,7 @@ def main():
 
     for q in questions:
         context = retrieve_context(q)
-        answer = generate_answer(q, context)
+        answer, ttft_ms, total_ms = generate_answer(q, context)
         scores = grade_answer(q, answer, context)
 
         row = {
@@ -148,6 +153,8 @@ def main():
             "relevance": scores.get("Relevance"),
             "completeness": scores.get("Completeness"),
             "safety": scores.get("Safety"),
+            "ttft_ms": ttft_ms,
+            "generation_ms": total_ms,
             "answer_preview": answer[:200]
         }
 
@@ -160,6 +167,19 @@ def main():
         writer.writerows(rows)
 
     print("Saved:", OUTPUT_PATH)
+    ttfts = sorted(r["ttft_ms"] for r in rows if r["ttft_ms"] is not None)
+    if ttfts:
+        totals = sorted(r["generation_ms"] for r in rows)
+        print(f"Generation: median time-to-first-token {ttfts[len(ttfts) // 2]:.0f} ms, "
+              f"median total {totals[len(totals) // 2]:.0f} ms")
+    print(get_cache().stats_line())
+    if RETRIEVAL_BACKEND == "local":
+        from local_index import get_local_index
+        print(get_local_index().stats_line())
+    else:
+        print(db.stats_line())
+        for line in db.report():
+            print(f"  {line}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+"""
+Long-running worker that embeds new messages within seconds of insert.
+
+Inserting into public.messages enqueues a job (trigger) and sends NOTIFY on the
+'message_embedding_jobs' channel; see "Supabase DB/Message Embedding Queue.sql".
+This worker:
+- waits for a notification (LISTEN, when DATABASE_URL is set and psycopg is installed),
+  or falls back to polling the small job table (never the messages table);
+- claims a batch with FOR UPDATE SKIP LOCKED, so several workers can run side by side;
+- embeds the batch in one go (shared cache + rate-limited client) and writes all vectors
+  back with one RPC call.
+
+Run:  python 05_embedding_queue_worker.py          (Ctrl+C to stop)
+"""
+import os
+import time
+import requests
+from dotenv import load_dotenv
+
+from embedding_cache import get_cache
+from embedding_client import AsyncEmbeddingClient
+from message_embedding import embed_messages
+from secret_patterns import contains_secret
+from supabase_client import get_client
+
+try:
+    import psycopg
+except ImportError:     # optional: without it we poll the job table
+    psycopg = None
+
+load_dotenv()
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+DATABASE_URL = os.getenv("DATABASE_URL")   # direct Postgres connection string, only for LISTEN
+
+if not all([SUPABASE_URL, SERVICE_KEY, OPENAI_API_KEY]):
+    raise SystemExit("Missing env vars: SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, OPENAI_API_KEY")
+
+CHANNEL = "message_embedding_jobs"
+BATCH_SIZE = int(os.getenv("QUEUE_BATCH_SIZE", "64"))
+BATCH_WAIT_S = float(os.getenv("QUEUE_BATCH_WAIT_S", "0.2"))     # gather a burst into one batch
+POLL_INTERVAL_S = float(os.getenv("QUEUE_POLL_INTERVAL_S", "2"))  # fallback / safety-net poll
+VISIBILITY_TIMEOUT = os.getenv("QUEUE_VISIBILITY_TIMEOUT", "5 minutes")
+MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "5"))
+
+# Pooled keep-alive Supabase session: the worker polls for hours over the same connections
+db = get_client()
+
+def skip_reason(content: str):
+    if not (content or "").strip():
+        return "empty"
+    if contains_secret(content):
+        return "secret detected"
+    return None
+
+def rpc(fn: str, payload: dict):
+    return db.rpc(fn, payload)
+
+def claim_jobs() -> list:
+    return rpc("claim_message_embedding_jobs", {
+        "batch_size": BATCH_SIZE,
+        "visibility_timeout": VISIBILITY_TIMEOUT,
+        "max_attempts": MAX_ATTEMPTS,
+    }) or []
+
+def process(jobs: list, embedder) -> int:
+    results, todo = [], []
+    for job in jobs:
+        reason = skip_reason(job.get("content"))
+        if reason:
+            print(f"⚠️ Not embedding ({reason}): {job['message_id']}")
+            results.append({"id": job["message_id"], "embedding": None, "status": "skipped"})
+        else:
+            todo.append(job)
+
+    try:
+        # long messages (flow exports) are segmented and pooled, not skipped
+        records = embed_messages(embedder, [j["content"] for j in todo])
+    except Exception as e:
+        # leave the jobs for a retry (claim_message_embedding_jobs stops after MAX_ATTEMPTS)
+        print(f"❌ Embedding failed for {len(todo)} messages: {e}")
+        rpc("fail_message_embedding_jobs", {
+            "message_ids": [j["message_id"] for j in todo],
+            "error": str(e)[:500],
+        })
+        todo, records = [], []
+
+    results += [{"id": j["message_id"], **r} for j, r in zip(todo, records)]
+    if results:
+        rpc("complete_message_embedding_jobs", {"results": results})
+    return len(todo)
+
+def drain(embedder) -> int:
+    """Claim and process batches until the queue is empty."""
+    done = 0
+    while True:
+        jobs = claim_jobs()
+        if not jobs:
+            return done
+        t0 = time.time()
+        n = process(jobs, embedder)
+        done += n
+        print(f"Embedded {n}/{len(jobs)} messages in {time.time() - t0:.2f}s")
+        if len(jobs) < BATCH_SIZE:
+            return done
+
+def open_listener():
+    if not (DATABASE_URL and psycopg):
+        return None
+    conn = psycopg.connect(DATABASE_URL, autocommit=True)
+    conn.execute(f"LISTEN {CHANNEL}")
+    return conn
+
+def wait_for_jobs(conn) -> None:
+    """Blocks until a notification arrives (or POLL_INTERVAL_S passes without one)."""
+    if conn is None:
+        time.sleep(POLL_INTERVAL_S)
+        return
+    # a quiet channel still falls through to the safety-net poll (psycopg >= 3.2)
+    for _ in conn.notifies(timeout=POLL_INTERVAL_S, stop_after=1):
+        time.sleep(BATCH_WAIT_S)   # let the rest of a burst arrive before claiming
+
+def main():
+    embedder = AsyncEmbeddingClient(api_key=OPENAI_API_KEY)
+    conn = open_listener()
+    mode = f"LISTEN {CHANNEL}" if conn else f"polling every {POLL_INTERVAL_S}s"
+    print(f"✅ Embedding queue worker started ({mode}, batch {BATCH_SIZE}). Ctrl+C to stop.")
+
+    total = 0
+    try:
+        while True:
+            # drain first: catches jobs enqueued while the worker was down
+            try:
+                total += drain(embedder)
+            except requests.RequestException as e:
+                # claimed jobs become visible again after VISIBILITY_TIMEOUT
+                print(f"❌ Supabase call failed, retrying: {e}")
+                time.sleep(POLL_INTERVAL_S)
+            wait_for_jobs(conn)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if conn is not None:
+            conn.close()
+    print(f"Stopped. {total} messages embedded.")
+    print(get_cache().stats_line())
+    print(embedder.stats_line())
+    print(db.stats_line())
+    for line in db.report():
+        print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Recall vs latency of the knowledge_chunks vector index, measured against exact search.
+
+Runs benchmark_vector_search() in the database (see "Supabase DB/Document RAG Tables &
+Vector Search.sql"): queries blend two random stored chunks (so no query is in the index,
+and both source chunks are left out of every top-k), exact full-precision top-k is
+the ground truth, and every ef_search (HNSW) / probes (IVFFlat) setting is timed and
+scored through the real search path (compact index candidates + full-precision re-rank).
+Prints the table with the index size, writes it to CSV and recommends the cheapest
+setting that reaches the target recall -- pass that as ef_search / probes to the search RPCs.
+
+Compare quantization modes by rebuilding in between:
+  python 06_vector_index_benchmark.py --maintain --quantization none
+  python 06_vector_index_benchmark.py --maintain --quantization halfvec
+  python 06_vector_index_benchmark.py --maintain --quantization binary
+"""
+import os
+import csv
+import argparse
+from dotenv import load_dotenv
+
+from supabase_client import get_client
+
+load_dotenv()
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+
+if not all([SUPABASE_URL, SERVICE_KEY]):
+    raise SystemExit("Missing env vars: SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY")
+
+db = get_client()
+
+OUTPUT_CSV_PATH = os.path.join("Supabase DB", "vector_index_benchmark.csv")
+
+
+def rpc(fn_name: str, payload: dict):
+    # benchmarks and index builds run long: generous timeout
+    return db.rpc(fn_name, payload, timeout=1800)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs latency of the vector index against exact search.")
+    parser.add_argument("--samples", type=int, default=50, help="number of query vectors")
+    parser.add_argument("--k", type=int, default=10, help="top-k for recall@k")
+    parser.add_argument("--settings", default="10,20,40,80,160,320",
+                        help="ef_search (hnsw) or probes (ivfflat) values to try")
+    parser.add_argument("--target-recall", type=float, default=0.99)
+    parser.add_argument("--maintain", action="store_true",
+                        help="run maintain_knowledge_chunk_index first")
+    parser.add_argument("--method", default=os.getenv("VECTOR_INDEX_METHOD", "hnsw"),
+                        help="index method for --maintain (hnsw | ivfflat)")
+    parser.add_argument("--quantization", default=os.getenv("VECTOR_INDEX_QUANTIZATION", "halfvec"),
+                        help="index quantization for --maintain (none | halfvec | reduced | binary)")
+    parser.add_argument("--reduced-dims", type=int, default=512, help="dimensions kept by 'reduced'")
+    parser.add_argument("--rerank-factor", type=int, default=None,
+                        help="candidates per result (default: per quantization, see vector_index_config)")
+    parser.add_argument("--min-rows", type=int, default=int(os.getenv("VECTOR_INDEX_MIN_ROWS", "10000")),
+                        help="below this many chunks --maintain drops the ANN index (0 forces one)")
+    args = parser.parse_args()
+
+    if args.maintain:
+        print("Index maintenance:", rpc("maintain_knowledge_chunk_index", {
+            "method": args.method,
+            "min_rows": args.min_rows,
+            "quantization": args.quantization,
+            "reduced_dims": args.reduced_dims,
+        }))
+
+    rows = rpc("benchmark_vector_search", {
+        "sample_size": args.samples,
+        "k": args.k,
+        "settings": [int(s) for s in args.settings.split(",") if s.strip()],
+        "rerank_factor": args.rerank_factor,
+    })
+    if not rows:
+        raise SystemExit("No embedded chunks to benchmark. Run 02_ingest_rag_data_to_supabase.py first.")
+
+    print(f"\n=== Vector search: recall@{args.k} vs latency ({args.samples} queries) ===")
+    print(f"{'method':<16} {'setting':>8} {'recall':>8} {'avg ms':>8} {'p95 ms':>8} {'index MB':>9}")
+    for r in rows:
+        setting = "-" if r["setting"] is None else r["setting"]
+        print(f"{r['method']:<16} {setting:>8} {float(r['recall']):>8.4f} "
+              f"{float(r['avg_ms']):>8.2f} {float(r['p95_ms']):>8.2f} {float(r['index_mb']):>9.1f}")
+
+    with open(OUTPUT_CSV_PATH, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["method", "setting", "recall", "avg_ms", "p95_ms", "index_mb"])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"\nSaved: {OUTPUT_CSV_PATH}")
+
+    ann = [r for r in rows if r["method"] != "exact"]
+    if not ann:
+        print("No ANN index (below min_rows): exact search is in use, recall is 1.0.")
+        return
+    good = [r for r in ann if float(r["recall"]) >= args.target_recall]
+    if good:
+        best = min(good, key=lambda r: float(r["avg_ms"]))
+        param = "ef_search" if best["method"].startswith("hnsw") else "probes"
+        print(f"✅ Recommended: {param}={best['setting']} "
+              f"(recall {float(best['recall']):.4f}, avg {float(best['avg_ms']):.2f} ms)")
+    else:
+        print(f"⚠️ No setting reached recall {args.target_recall}; try larger values "
+              f"or rebuild the index with bigger parameters.")
+
+
+if __name__ == "__main__":
+    main()
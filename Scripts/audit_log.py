@@ -0,0 +1,301 @@
+"""
+Write-behind audit log for agent sessions and messages.
+
+log(table, row) only puts the row on an in-memory queue and returns; one background
+writer thread flushes the queue in batched bulk inserts (one POST per table per batch),
+so answers never wait on logging I/O.
+
+Guarantees:
+- At-least-once: every row gets a client-side id and is inserted with
+  resolution=ignore-duplicates, so a retried batch never creates duplicates. Rows that
+  cannot be written (Supabase unreachable after retries) are appended to a local journal
+  file (.cache/audit_journal.jsonl, fsynced) and replayed later, also after a restart.
+- Ordering: rows are written in the order they were logged (one writer, FIFO), and
+  timestamps are taken client-side at log() time, so a session row precedes its messages
+  and messages keep their order inside a session. While the journal is non-empty, new
+  rows are appended behind it instead of being sent, so nothing overtakes journaled rows.
+- Rows Supabase rejects outright (4xx other than 408/425/429) cannot succeed on retry;
+  they go to .cache/audit_dead_letter.jsonl with the error instead of blocking the log.
+
+close() (also registered with atexit) drains the queue before the process exits. Once
+closing, inserts use a short timeout and no retries, so an outage journals the remaining
+rows quickly; whatever the writer has not reached when close() times out is journaled
+from the closing thread, so no queued row is lost.
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import threading
+from datetime import datetime, timezone
+
+import requests
+
+from supabase_client import SupabaseClient, RETRYABLE_STATUS
+
+JOURNAL_PATH = os.getenv("AUDIT_JOURNAL_PATH", os.path.join(".cache", "audit_journal.jsonl"))
+DEAD_LETTER_PATH = os.getenv("AUDIT_DEAD_LETTER_PATH", os.path.join(".cache", "audit_dead_letter.jsonl"))
+BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "50"))
+FLUSH_INTERVAL_S = float(os.getenv("AUDIT_FLUSH_INTERVAL_S", "0.2"))
+REPLAY_INTERVAL_S = float(os.getenv("AUDIT_REPLAY_INTERVAL_S", "10"))
+MAX_RETRIES = 2
+SHUTDOWN_INSERT_TIMEOUT_S = 3
+
+# client-side timestamp column per table (keeps order across batched inserts)
+TIMESTAMP_COLUMNS = {"sessions": "started_at", "messages": "created_at"}
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+
+class AuditLog:
+    def __init__(self, db: SupabaseClient, journal_path: str = JOURNAL_PATH,
+                 dead_letter_path: str = DEAD_LETTER_PATH):
+        self.db = db
+        self.journal_path = journal_path
+        self.dead_letter_path = dead_letter_path
+        self.queue = queue.Queue()
+        self.stats = {"logged": 0, "written": 0, "journaled": 0, "replayed": 0, "dead_letter": 0}
+        self._journal_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._last_replay = 0.0
+        self._closed = False
+        self._journal_warned = False
+        self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # --- producer side (request path) ---
+    def log(self, table: str, row: dict) -> str:
+        """Queues one row; returns its id right away (usable as a foreign key at once)."""
+        row = {"id": str(uuid.uuid4()), **row}
+        ts_col = TIMESTAMP_COLUMNS.get(table)
+        if ts_col and ts_col not in row:
+            row[ts_col] = now_iso()
+        self._count("logged")
+        self.queue.put((table, row))
+        return row["id"]
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Blocks until everything logged so far was written or journaled."""
+        done = threading.Event()
+        self.queue.put(("__flush__", done))
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 10.0):
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self._journal_rest()
+
+    def _journal_rest(self):
+        """close() timed out (Supabase slow or down): journals the rows still queued for replay."""
+        items = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                continue
+            if item[0] == "__flush__":
+                item[1].set()
+                continue
+            items.append(item)
+        if items:
+            self._append(self.journal_path, items)
+            self._count("journaled", len(items))
+            print(f"⚠️ Audit log: shutdown timed out, journaled {len(items)} queued row(s) to {self.journal_path}")
+
+    def stats_line(self) -> str:
+        s = self.stats
+        return (f"Audit log: {s['written']} written, {s['journaled']} journaled, "
+                f"{s['replayed']} replayed, {s['dead_letter']} dead-lettered, {self.queue.qsize()} queued")
+
+    # --- writer thread ---
+    def _run(self):
+        self._replay()
+        while True:
+            batch, waiters, stop = self._next_batch()
+            if batch:
+                if self._journal_pending():
+                    self._append(self.journal_path, batch)    # keep order behind the journal
+                    self._count("journaled", len(batch))
+                else:
+                    self._write_or_journal(batch)
+            if time.monotonic() - self._last_replay >= REPLAY_INTERVAL_S or stop:
+                self._replay()
+            for w in waiters:
+                w.set()
+            if stop:
+                return
+
+    def _next_batch(self):
+        """Up to BATCH_SIZE rows: waits for the first, then collects for FLUSH_INTERVAL_S."""
+        batch, waiters = [], []
+        try:
+            item = self.queue.get(timeout=REPLAY_INTERVAL_S)
+        except queue.Empty:
+            return batch, waiters, False
+        deadline = time.monotonic() + FLUSH_INTERVAL_S
+        while True:
+            if item is None:
+                return batch, waiters, True
+            if item[0] == "__flush__":
+                waiters.append(item[1])
+                return batch, waiters, False
+            batch.append(item)
+            if len(batch) >= BATCH_SIZE:
+                return batch, waiters, False
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return batch, waiters, False
+
+    def _write_or_journal(self, batch: list) -> bool:
+        """Writes the batch in order; on failure journals it (and the rest). True if all written."""
+        for n, group in self._groups(batch):
+            try:
+                self._insert(group[0][0], [row for _, row in group])
+                self._count("written", len(group))
+            except requests.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status is not None and status not in RETRYABLE_STATUS:
+                    handled = self._isolate_rejected(group, e)
+                    if handled == len(group):
+                        continue
+                    self._spill(batch[n + handled:], e)
+                    return False
+                self._spill(batch[n:], e)
+                return False
+            except requests.RequestException as e:
+                self._spill(batch[n:], e)
+                return False
+        return True
+
+    @staticmethod
+    def _groups(batch: list):
+        """Consecutive rows of the same table: (start offset, [(table, row), ...])."""
+        start = 0
+        for i in range(1, len(batch) + 1):
+            if i == len(batch) or batch[i][0] != batch[start][0]:
+                yield start, batch[start:i]
+                start = i
+
+    def _insert(self, table: str, rows: list):
+        # rows carry their ids: ignore-duplicates makes the retries safe
+        if self._closed:
+            self.db.bulk_insert(table, rows, timeout=SHUTDOWN_INSERT_TIMEOUT_S, retries=0)
+        else:
+            self.db.bulk_insert(table, rows, timeout=30, retries=MAX_RETRIES)
+
+    def _count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    # --- journal ---
+    def _journal_pending(self) -> bool:
+        return os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > 0
+
+    def _append(self, path: str, items: list, error: str = None):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self._journal_lock, open(path, "a", encoding="utf-8") as f:
+            for table, row in items:
+                record = {"table": table, "row": row}
+                if error:
+                    record["error"] = error
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _spill(self, items: list, error: Exception):
+        self._append(self.journal_path, items)
+        self._count("journaled", len(items))
+        if not self._journal_warned:
+            print(f"⚠️ Audit log: Supabase write failed, journaling to {self.journal_path}: {error}")
+            self._journal_warned = True
+
+    def _isolate_rejected(self, group: list, error: Exception) -> int:
+        """
+        A rejected batch: writes its rows one by one so only the bad rows are dead-lettered.
+        Returns how many rows were handled; fewer than len(group) means Supabase became
+        unreachable and the rest must be journaled.
+        """
+        if len(group) == 1:
+            self._dead_letter(group, error)
+            return 1
+        for n, item in enumerate(group):
+            try:
+                self._insert(item[0], [item[1]])
+                self._count("written")
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code in RETRYABLE_STATUS:
+                    return n
+                self._dead_letter([item], e)
+            except requests.RequestException:
+                return n
+        return len(group)
+
+    def _dead_letter(self, items: list, error: Exception):
+        self._append(self.dead_letter_path, items, error=str(error))
+        self._count("dead_letter", len(items))
+        print(f"⚠️ Audit log: {len(items)} row(s) rejected by Supabase, kept in {self.dead_letter_path}: {error}")
+
+    def _replay(self):
+        """Re-sends the journal in order; keeps it (from the first failure on) if Supabase is still down."""
+        self._last_replay = time.monotonic()
+        if not self._journal_pending():
+            return
+        with self._journal_lock, open(self.journal_path, "r", encoding="utf-8") as f:
+            items = [(r["table"], r["row"]) for r in map(json.loads, filter(str.strip, f))]
+            read_upto = f.tell()
+        pending = items
+        while pending:
+            chunk, pending = pending[:BATCH_SIZE], pending[BATCH_SIZE:]
+            sent = self._replay_chunk(chunk)
+            self._count("replayed", sent)
+            if sent < len(chunk):
+                pending = chunk[sent:] + pending
+                break
+        tmp = self.journal_path + ".tmp"
+        with self._journal_lock:
+            # rows journaled while replaying (e.g. by close()) stay behind the unsent ones
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                f.seek(read_upto)
+                appended = f.read()
+            with open(tmp, "w", encoding="utf-8") as f:
+                for table, row in pending:
+                    f.write(json.dumps({"table": table, "row": row}) + "\n")
+                f.write(appended)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.journal_path)
+        if not pending and not appended:
+            self._journal_warned = False
+            print(f"✅ Audit log: journal replayed ({len(items)} row(s))")
+
+    def _replay_chunk(self, chunk: list) -> int:
+        """Number of leading rows of chunk that are now written (or dead-lettered)."""
+        done = 0
+        for _, group in self._groups(chunk):
+            try:
+                self._insert(group[0][0], [row for _, row in group])
+            except requests.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status is None or status in RETRYABLE_STATUS:
+                    return done
+                handled = self._isolate_rejected(group, e)
+                if handled < len(group):
+                    return done + handled
+            except requests.RequestException:
+                return done
+            done += len(group)
+        return done
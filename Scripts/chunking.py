@@ -0,0 +1,193 @@
+"""
+Token-aware, structure-aware chunking for RAG ingestion.
+
+Text is split into blocks (headings, paragraphs, table rows), paragraphs into sentences,
+and sentences are packed into chunks up to a token budget without cutting words or
+sentences. Each chunk carries the heading path it sits under, and table rows become one
+chunk each (same "Header: value | ..." format as the Excel row chunks).
+
+Chunks are dicts: {"content": str, "metadata": {"headings": [...], "kind": "text" | "table_row"}}
+"""
+import re
+import math
+
+# Bump when chunk boundaries change so ingestion re-processes unchanged files once.
+CHUNKER_VERSION = "2"
+CHUNK_MAX_TOKENS = 400
+CHARS_PER_TOKEN = 4     # same rough estimate the dashboard uses
+
+_SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+(?=[\"'(\[]?[A-Z0-9])")
+_MD_HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+_DOCX_HEADING = re.compile(r"^heading\s*(\d+)$", re.IGNORECASE)
+
+
+def approx_tokens(text: str) -> int:
+    if not text:
+        return 0
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def split_sentences(paragraph: str) -> list:
+    return [s for s in _SENTENCE_END.split(paragraph.strip()) if s]
+
+
+def _split_long(sentence: str, max_tokens: int) -> list:
+    """A single sentence over budget is cut on word boundaries."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    parts, current, size = [], [], 0
+    for word in sentence.split():
+        if current and size + len(word) + 1 > max_chars:
+            parts.append(" ".join(current))
+            current, size = [], 0
+        current.append(word)
+        size += len(word) + 1
+    if current:
+        parts.append(" ".join(current))
+    return parts
+
+
+def push_heading(stack: list, level: int, text: str) -> list:
+    """stack: [(level, text), ...]; a heading closes every open heading at its level or deeper."""
+    return [h for h in stack if h[0] < level] + [(level, text)]
+
+
+def heading_path(stack: list) -> list:
+    return [text for _, text in stack]
+
+
+def section_prefix(headings: list) -> str:
+    return f"[Section: {' > '.join(headings)}]\n" if headings else ""
+
+
+def pack_blocks(blocks, max_tokens: int = CHUNK_MAX_TOKENS) -> list:
+    """
+    blocks: iterable of (kind, text, headings) where kind is "paragraph" or "table_row".
+    Paragraphs under the same heading path are packed sentence by sentence; a heading
+    change or a table row always starts a new chunk.
+    """
+    chunks = []
+    current, current_tokens, current_headings = [], 0, None
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            body = " ".join(current)
+            chunks.append({
+                "content": section_prefix(current_headings) + body,
+                "metadata": {"headings": list(current_headings or []), "kind": "text"},
+            })
+        current, current_tokens = [], 0
+
+    for kind, text, headings in blocks:
+        text = (text or "").strip()
+        if not text:
+            continue
+
+        if kind == "table_row":
+            flush()
+            chunks.append({
+                "content": section_prefix(headings) + text,
+                "metadata": {"headings": list(headings), "kind": "table_row"},
+            })
+            continue
+
+        if headings != current_headings:
+            flush()
+            current_headings = list(headings)
+
+        budget = max_tokens - approx_tokens(section_prefix(current_headings))
+        for sentence in split_sentences(text):
+            pieces = [sentence] if approx_tokens(sentence) <= budget else _split_long(sentence, budget)
+            for piece in pieces:
+                t = approx_tokens(piece) + 1
+                if current and current_tokens + t > budget:
+                    flush()
+                current.append(piece)
+                current_tokens += t
+
+    flush()
+    return chunks
+
+
+def table_row_texts(rows: list) -> list:
+    """rows: list of cell-string lists; the first non-empty row is the header."""
+    out = []
+    header = None
+    for cells in rows:
+        cells = [(c or "").strip() for c in cells]
+        if not any(cells):
+            continue
+        if header is None:
+            header = cells
+            continue
+        pairs = [f"{h}: {v}" for h, v in zip(header, cells) if h and v]
+        out.append(" | ".join(pairs) if pairs else " | ".join(c for c in cells if c))
+    return out
+
+
+def docx_blocks(doc):
+    """
+    Walks a python-docx Document body in order and yields (kind, text, headings).
+    Headings ("Title", "Heading N") maintain the heading path; tables yield one row each.
+    """
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+
+    stack = []
+    for child in doc.element.body.iterchildren():
+        tag = child.tag.rsplit("}", 1)[-1]
+
+        if tag == "p":
+            p = Paragraph(child, doc)
+            text = (p.text or "").strip()
+            if not text:
+                continue
+            style = (p.style.name if p.style is not None else "") or ""
+            m = _DOCX_HEADING.match(style)
+            if m or style.lower() == "title":
+                stack = push_heading(stack, int(m.group(1)) if m else 0, text)
+                continue
+            yield ("paragraph", text, heading_path(stack))
+
+        elif tag == "tbl":
+            table = Table(child, doc)
+            rows = []
+            for row in table.rows:
+                cells, seen = [], set()
+                for cell in row.cells:
+                    # horizontally merged cells repeat the same underlying <w:tc>; keep one
+                    if cell._tc in seen:
+                        continue
+                    seen.add(cell._tc)
+                    cells.append(cell.text or "")
+                rows.append(cells)
+            for text in table_row_texts(rows):
+                yield ("table_row", text, heading_path(stack))
+
+
+def text_blocks(text: str):
+    """Plain text / markdown: blank lines separate paragraphs, '#' lines are headings."""
+    stack = []
+    paragraph = []
+    for line in (text or "").splitlines():
+        m = _MD_HEADING.match(line.strip())
+        if m:
+            if paragraph:
+                yield ("paragraph", " ".join(paragraph), heading_path(stack))
+                paragraph = []
+            stack = push_heading(stack, len(m.group(1)), m.group(2).strip())
+        elif line.strip():
+            paragraph.append(line.strip())
+        elif paragraph:
+            yield ("paragraph", " ".join(paragraph), heading_path(stack))
+            paragraph = []
+    if paragraph:
+        yield ("paragraph", " ".join(paragraph), heading_path(stack))
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_MAX_TOKENS) -> list:
+    return pack_blocks(text_blocks(text), max_tokens)
+
+
+def chunk_docx(doc, max_tokens: int = CHUNK_MAX_TOKENS) -> list:
+    return pack_blocks(docx_blocks(doc), max_tokens)
@@ -0,0 +1,292 @@
+"""
+Structured lookup index for the Approved Connectors sheet.
+
+Ingestion (02_ingest_rag_data_to_supabase.py) builds it from any workbook with a
+"Connector Name" column and saves it to .cache/connector_index.json: one record per row
+(all columns, sheet, row number) plus normalised name keys -> record.
+
+The agent answers simple entity-lookup governance questions from it directly
+("Is SharePoint connector allowed?", "Is ARB review required for GitHub?",
+"What type of connector is Office 365 Users?", "Who is the publisher of X?"),
+citing the row, with no embedding or chat call. Anything else -> None (normal RAG path):
+blocked / negated wording ("Is X blocked?", "Is X not allowed?") and questions scoped to an
+environment, DLP policy or tenant, which the sheet alone cannot answer.
+
+IndexCache keeps the index in memory for a long-running process and reloads it when the
+index file or the source workbook changes.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import difflib
+import threading
+
+INDEX_PATH = os.getenv("CONNECTOR_INDEX_PATH", os.path.join(".cache", "connector_index.json"))
+NAME_COLUMN = "Connector Name"
+FUZZY_CUTOFF = 0.88
+
+_GENERIC = {"connector", "connectors", "the", "a", "an"}
+
+# question attribute -> pattern; checked in this order
+_ATTRIBUTES = [
+    ("arb", re.compile(r"\barb\b", re.IGNORECASE)),
+    ("publisher", re.compile(r"\bpublisher\b|\bwho (publishes|makes|provides|owns)\b", re.IGNORECASE)),
+    ("type", re.compile(r"\bwhat (type|kind)\b|\bis .+ (premium|standard)\b", re.IGNORECASE)),
+    ("allowed", re.compile(r"\b(allowed|approved|permitted|can i use|may i use)\b", re.IGNORECASE)),
+]
+# the sheet only lists approved connectors: "not on it" does not mean blocked, so blocked /
+# negated questions go to retrieval, as do questions scoped to an environment or policy
+_NEGATED = re.compile(r"\b(block(ed|s)?|not|never|no longer|forbidden|prohibited|disallowed|denied|"
+                      r"banned|restricted)\b|n't\b", re.IGNORECASE)
+_SCOPED = re.compile(r"\b(environments?|envs?|default|sandbox|dev|test|dlp|polic(y|ies)|tenants?|"
+                     r"data groups?|business data|non-business)\b", re.IGNORECASE)
+# questions that need reasoning over documents, not a single row
+MAX_QUESTION_WORDS = 16
+_COMPLEX = re.compile(r"\b(how|why|steps?|if|production|deploy\w*|imply|implies|should|process)\b", re.IGNORECASE)
+
+
+def normalise_name(text: str) -> str:
+    words = re.findall(r"[a-z0-9]+", (text or "").lower())
+    return " ".join(w for w in words if w not in _GENERIC)
+
+
+def name_aliases(name: str) -> list:
+    """Full name, name without (...) / [...] qualifiers, and both without spaces."""
+    full = normalise_name(name)
+    short = normalise_name(re.sub(r"[\(\[].*?[\)\]]", " ", name or ""))
+    out = []
+    for key in (full, short, full.replace(" ", ""), short.replace(" ", "")):
+        if key and key not in out:
+            out.append(key)
+    return out
+
+
+def build_from_workbook(path: str, content_hash: str = None) -> dict:
+    """Index of every sheet with a Connector Name column; {} when the workbook has none."""
+    from openpyxl import load_workbook
+
+    records = []
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            header = None
+            for row_number, row in enumerate(ws.iter_rows(values_only=True), start=1):
+                cells = ["" if v is None else str(v).strip() for v in row]
+                if header is None:
+                    if NAME_COLUMN in cells:
+                        header = cells
+                    continue
+                fields = {h: v for h, v in zip(header, cells) if h}
+                if fields.get(NAME_COLUMN):
+                    records.append({"fields": fields, "sheet": ws.title, "row": row_number})
+    finally:
+        wb.close()
+    if not records:
+        return {}
+
+    # full names win; a shortened alias is only kept if it points to a single row
+    keys, alias_owner = {}, {}
+    for i, rec in enumerate(records):
+        aliases = name_aliases(rec["fields"][NAME_COLUMN])
+        keys.setdefault(aliases[0], i)
+        for alias in aliases[1:]:
+            alias_owner.setdefault(alias, set()).add(i)
+    ambiguous = []
+    for alias, owners in alias_owner.items():
+        if alias in keys:
+            continue
+        if len(owners) == 1:
+            keys[alias] = next(iter(owners))
+        else:
+            ambiguous.append(alias)
+
+    return {
+        "source": os.path.basename(path),
+        "source_path": os.path.abspath(path),
+        "source_mtime": os.path.getmtime(path),
+        "source_sha256": workbook_hash(path),
+        "content_hash": content_hash,
+        "built_at": time.time(),
+        "records": records,
+        "keys": keys,
+        "ambiguous": ambiguous,   # e.g. "excel online": (Business) and (OneDrive) rows
+    }
+
+
+def workbook_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _mtime(path: str):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def save_index(index: dict, path: str = INDEX_PATH):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def load_index(path: str = INDEX_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class IndexCache:
+    """
+    The index of a long-running process (agent REPL / HTTP service). get() reloads it when
+    ingestion rewrote the index file, and rebuilds it when the source workbook was edited
+    since (mtime changed and the bytes really differ), so policy answers never go stale.
+    """
+
+    def __init__(self, path: str = INDEX_PATH):
+        self.path = path
+        self.index = {}
+        self._index_mtime = None
+        self._failed_mtime = None
+        self._lock = threading.Lock()
+
+    def get(self) -> dict:
+        with self._lock:
+            self._refresh()
+            return self.index
+
+    def _refresh(self):
+        mtime = _mtime(self.path)
+        if mtime != self._index_mtime:
+            try:
+                self.index = load_index(self.path)
+            except (OSError, ValueError):
+                self.index = {}
+            self._index_mtime = mtime
+
+        source = self.index.get("source_path")
+        source_mtime = _mtime(source) if source else None
+        if source_mtime is None or source_mtime in (self.index.get("source_mtime"), self._failed_mtime):
+            return
+        try:
+            if workbook_hash(source) == self.index.get("source_sha256"):
+                rebuilt = {**self.index, "source_mtime": source_mtime}   # touched, not changed
+            else:
+                # content_hash=None: the next ingestion run rebuilds it with its own file hash
+                rebuilt = build_from_workbook(source)
+        except Exception as e:   # e.g. the workbook is being saved right now: retry on next change
+            print(f"⚠️ Connector index not refreshed from {os.path.basename(source)}: {e}")
+            self._failed_mtime = source_mtime
+            return
+        self.index = rebuilt
+        if rebuilt:
+            save_index(rebuilt, self.path)
+        self._index_mtime = _mtime(self.path)
+
+
+def find_connector(index: dict, question: str):
+    """(record, matched key, similarity) for the connector named in the question, or None."""
+    keys = index.get("keys") or {}
+    if not keys:
+        return None
+    q = normalise_name(question)
+    padded = f" {q} "
+    compact = q.replace(" ", "")
+
+    def mentioned(k):
+        return f" {k} " in padded or (" " not in k and len(k) >= 6 and k in compact)
+
+    # exact: longest key appearing as whole words (or inside the space-less question);
+    # a longer name shared by several rows means the question is ambiguous -> no answer
+    exact = [k for k in keys if mentioned(k)]
+    if exact:
+        best = max(exact, key=len)
+        if any(len(a) > len(best) and mentioned(a) for a in index.get("ambiguous", [])):
+            return None
+        return index["records"][keys[best]], best, 1.0
+
+    # fuzzy: word n-grams of the question against every key
+    words = q.split()
+    best = None
+    for n in range(1, 5):
+        for i in range(len(words) - n + 1):
+            gram = " ".join(words[i:i + n])
+            for key in difflib.get_close_matches(gram, keys, n=1, cutoff=FUZZY_CUTOFF):
+                ratio = difflib.SequenceMatcher(None, gram, key).ratio()
+                if best is None or ratio > best[2]:
+                    best = (index["records"][keys[key]], key, ratio)
+    return best
+
+
+def question_attribute(question: str):
+    q = question or ""
+    if _COMPLEX.search(q) or _NEGATED.search(q) or len(q.split()) > MAX_QUESTION_WORDS:
+        return None
+    # a connector name may contain words like "(Business)": only the rest of the question counts
+    if _SCOPED.search(re.sub(r"[\(\[].*?[\)\]]", " ", q)):
+        return None
+    for name, pattern in _ATTRIBUTES:
+        if pattern.search(q):
+            return name
+    return None
+
+
+def answer_lookup(index: dict, question: str):
+    """
+    Returns {"answer", "citation", "attribute", "connector", "match_score"} for a simple
+    connector question the sheet answers on its own, else None.
+    """
+    attribute = question_attribute(question)
+    if not attribute:
+        return None
+    match = find_connector(index, question)
+    if not match:
+        return None
+    record, _, similarity = match
+    f = record["fields"]
+    name = f[NAME_COLUMN].strip()
+    arb = (f.get("ARB Review Required") or "").strip()
+    ctype = (f.get("Connector Type") or "").strip()
+    publisher = (f.get("Publisher") or "").strip()
+    pre_allowed = (f.get("Pre Allowed Connectors") or "").strip()
+
+    if attribute == "arb":
+        if arb.lower() == "yes":
+            answer = f"Yes. ARB review is required for the {name} connector."
+        elif arb.lower() == "no":
+            answer = f"No. ARB review is not required for the {name} connector."
+        else:
+            return None
+    elif attribute == "publisher":
+        if not publisher:
+            return None
+        answer = f"The {name} connector is published by {publisher}."
+    elif attribute == "type":
+        if not ctype:
+            return None
+        answer = f"{name} is a {ctype} connector."
+    else:
+        answer = f"Yes. {name} is on the approved / allowed connectors list"
+        answer += f" ({pre_allowed.lower()})." if pre_allowed else "."
+        if arb.lower() == "yes":
+            answer += " ARB review is required before using it."
+
+    details = ", ".join(f"{k}: {v}" for k, v in f.items() if v and k not in ("Path", "Item Type"))
+    citation = f"{index.get('source', 'Approved Connectors')} (sheet '{record['sheet']}', row {record['row']})"
+    return {
+        "answer": f"Answer: {answer}\nEvidence: {details}\nSource: {citation}",
+        "citation": citation,
+        "attribute": attribute,
+        "connector": name,
+        "match_score": round(similarity, 3),
+    }
@@ -0,0 +1,252 @@
+"""
+Duplicate / near-duplicate chunk detection for ingestion.
+
+- Exact duplicates: sha256 of the normalised text (lowercase, collapsed whitespace).
+- Near duplicates: one-permutation MinHash over word 3-shingles, bucketed with LSH bands.
+  Candidates from the buckets are confirmed with the signature's Jaccard estimate.
+
+Only the first (canonical) copy of a chunk is embedded; later copies point back to it.
+Spreadsheet and table rows (EXACT_ONLY_KINDS) are deduplicated exactly only: rows of one
+sheet repeat the same column labels, so their shingles overlap far more than their
+values do, and distinct rows (two different connectors) would pass as near-duplicates.
+
+Dedup is scoped per retrieval partition (doc_type, tenant), see PartitionedDedup: a
+duplicate always points to a canonical that the same filtered search can reach.
+Signatures of stored canonicals are kept in a local SQLite file (SignatureStore), so
+near-duplicates are also found across runs; missing ones are rebuilt from chunk content.
+"""
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+SIGNATURE_PATH = os.getenv("DEDUP_SIGNATURE_PATH", os.path.join(".cache", "dedup_signatures.sqlite"))
+NEAR_DUP_THRESHOLD = 0.9
+EXACT_ONLY_KINDS = frozenset({"row", "table_row"})   # chunk metadata "kind"
+# Bump when dedup decisions change, so ingestion re-plans unchanged files once.
+DEDUP_VERSION = "2"
+NUM_BINS = 64
+BANDS = 16
+SHINGLE_SIZE = 3
+
+_EMPTY = (1 << 64) - 1
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def normalise(text: str) -> str:
+    return " ".join((text or "").lower().split())
+
+
+def dedup_key(text: str) -> str:
+    return hashlib.sha256(normalise(text).encode("utf-8")).hexdigest()
+
+
+def _hash64(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def minhash_signature(text: str, num_bins: int = NUM_BINS) -> tuple:
+    """
+    One-permutation MinHash: each shingle is hashed once and goes to bin (hash % num_bins);
+    a bin keeps its minimum. O(#shingles) instead of O(#shingles * #permutations).
+    """
+    words = _WORD.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        shingles = {" ".join(words)} if words else set()
+    else:
+        shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+    sig = [_EMPTY] * num_bins
+    for sh in shingles:
+        h = _hash64(sh)
+        b = h % num_bins
+        v = h // num_bins
+        if v < sig[b]:
+            sig[b] = v
+    return tuple(sig)
+
+
+def estimate_jaccard(a: tuple, b: tuple) -> float:
+    same = 0
+    used = 0
+    for x, y in zip(a, b):
+        if x == _EMPTY and y == _EMPTY:
+            continue
+        used += 1
+        if x == y:
+            same += 1
+    return same / used if used else 0.0
+
+
+class DedupIndex:
+    """
+    In-memory index of canonical chunks for one ingestion run.
+
+    Canonical chunks are identified by their content_hash (sha256 of the stored text);
+    duplicates reference that hash so the pointer survives re-numbering.
+    """
+
+    def __init__(self, threshold: float = NEAR_DUP_THRESHOLD, bands: int = BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows_per_band = NUM_BINS // bands
+        self.by_key = {}          # dedup_key -> location
+        self.buckets = {}         # (band, band values) -> set(content_hash)
+        self.signatures = {}      # content_hash -> signature (near-dup only)
+        self.locations = {}       # content_hash -> location
+        self.key_of = {}          # content_hash -> dedup_key
+        self.new_signatures = {}  # content_hash -> signature, added this run
+        self.exact_hits = 0
+        self.near_hits = 0
+
+    def _bands(self, sig: tuple):
+        r = self.rows_per_band
+        for b in range(self.bands):
+            yield (b, sig[b * r:(b + 1) * r])
+
+    def add_existing(self, content_hash: str, key: str, location: dict, signature: tuple = None):
+        """Seed with an already-stored canonical chunk (near matching too when its signature is known)."""
+        self._index(content_hash, key, signature, location)
+
+    def find(self, text: str, near: bool = True):
+        """
+        Returns (key, signature, match). match is None for a new canonical chunk, otherwise
+        {"content_hash", "filename", "chunk_index", "similarity"} of the canonical copy.
+        near=False: exact duplicates only (signature None, so the chunk never becomes a
+        near-duplicate candidate either).
+        """
+        key = dedup_key(text)
+        hit = self.by_key.get(key)
+        if hit:
+            self.exact_hits += 1
+            return key, None, {**hit, "similarity": 1.0}
+        if not near:
+            return key, None, None
+
+        sig = minhash_signature(text)
+        candidates = set()
+        for band in self._bands(sig):
+            candidates.update(self.buckets.get(band, ()))
+        best, best_sim = None, 0.0
+        for h in candidates:
+            sim = estimate_jaccard(sig, self.signatures[h])
+            if sim > best_sim:
+                best, best_sim = h, sim
+        if best is not None and best_sim >= self.threshold:
+            self.near_hits += 1
+            return key, sig, {**self.locations[best], "similarity": round(best_sim, 3)}
+        return key, sig, None
+
+    def add(self, content_hash: str, key: str, signature: tuple, location: dict):
+        """A new canonical chunk of this run; its signature is kept for SignatureStore."""
+        if signature is not None:
+            self.new_signatures[content_hash] = signature
+        self._index(content_hash, key, signature, location)
+
+    def _index(self, content_hash: str, key: str, signature: tuple, location: dict):
+        loc = {**location, "content_hash": content_hash}
+        self.by_key.setdefault(key, loc)
+        self.locations[content_hash] = loc
+        self.key_of[content_hash] = key
+        if signature is not None:
+            self.signatures[content_hash] = signature
+            for band in self._bands(signature):
+                self.buckets.setdefault(band, set()).add(content_hash)
+
+    def remove(self, content_hash: str):
+        """
+        Forget a canonical chunk (e.g. it was deleted as stale, or moved to another partition).
+        Returns (key, signature, location) of the removed entry, or None.
+        """
+        loc = self.locations.pop(content_hash, None)
+        if loc is None:
+            return None
+        key = self.key_of.pop(content_hash, None)
+        if key is not None and self.by_key.get(key, {}).get("content_hash") == content_hash:
+            del self.by_key[key]
+        sig = self.signatures.pop(content_hash, None)
+        if sig is not None:
+            for band in self._bands(sig):
+                self.buckets.get(band, set()).discard(content_hash)
+        return key, sig, {k: v for k, v in loc.items() if k != "content_hash"}
+
+    def __contains__(self, content_hash: str) -> bool:
+        return content_hash in self.locations
+
+
+class PartitionedDedup:
+    """One DedupIndex per retrieval partition (doc_type, tenant)."""
+
+    def __init__(self, threshold: float = NEAR_DUP_THRESHOLD):
+        self.threshold = threshold
+        self.parts = {}
+
+    def partition(self, doc_type: str, tenant) -> DedupIndex:
+        key = (doc_type, tenant or None)
+        if key not in self.parts:
+            self.parts[key] = DedupIndex(self.threshold)
+        return self.parts[key]
+
+    def move(self, content_hash: str, src: DedupIndex, dst: DedupIndex):
+        """A canonical chunk changed partition (its document was retagged)."""
+        entry = src.remove(content_hash)
+        if entry is not None:
+            key, sig, loc = entry
+            dst.add_existing(content_hash, key, loc, sig)
+
+    def new_signatures(self) -> dict:
+        out = {}
+        for part in self.parts.values():
+            out.update(part.new_signatures)
+        return out
+
+    @property
+    def exact_hits(self) -> int:
+        return sum(p.exact_hits for p in self.parts.values())
+
+    @property
+    def near_hits(self) -> int:
+        return sum(p.near_hits for p in self.parts.values())
+
+
+class SignatureStore:
+    """MinHash signatures by content hash in a local SQLite file (packed uint64 blobs)."""
+
+    def __init__(self, path: str = SIGNATURE_PATH):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("create table if not exists signatures (key text primary key, sig blob not null)")
+        self.db.commit()
+
+    @staticmethod
+    def _key(content_hash: str) -> str:
+        # a different signature layout must not reuse old signatures
+        return f"{NUM_BINS}:{SHINGLE_SIZE}:{content_hash}"
+
+    def get_many(self, content_hashes: list) -> dict:
+        out = {}
+        keys = {self._key(h): h for h in content_hashes}
+        items = list(keys)
+        with self.lock:
+            for i in range(0, len(items), 500):
+                part = items[i:i + 500]
+                rows = self.db.execute(
+                    f"select key, sig from signatures where key in ({','.join('?' * len(part))})", part)
+                for key, blob in rows:
+                    a = array("Q")
+                    a.frombytes(blob)
+                    out[keys[key]] = tuple(a)
+        return out
+
+    def put_many(self, signatures: dict):
+        if not signatures:
+            return
+        with self.lock:
+            self.db.executemany("insert or replace into signatures (key, sig) values (?, ?)",
+                                [(self._key(h), array("Q", sig).tobytes()) for h, sig in signatures.items()])
+            self.db.commit()
@@ -0,0 +1,179 @@
+"""
+Token-budgeted request packing for the embeddings API.
+
+- pack_batches(): groups inputs by estimated token count so each request stays under the
+  provider limits (tokens per input, tokens per request, inputs per request).
+- request_embeddings(): sends the packed requests; a request rejected as too large is
+  split in half and retried, and a single over-long input is truncated to fit.
+  Truncated inputs are counted (truncated_inputs(), shown in the cache's stats_line())
+  and the first one is logged, so shortened embeddings do not go unnoticed.
+- MicroBatcher: coalesces concurrent single-text calls from different threads into one
+  request (used for query embeddings).
+"""
+import os
+import math
+import time
+import threading
+from concurrent.futures import Future
+
+from openai import BadRequestError
+
+# text-embedding-3-* limits
+MAX_INPUT_TOKENS = 8191
+MAX_REQUEST_TOKENS = 300_000
+MAX_REQUEST_INPUTS = 2048
+
+# Estimates are conservative (3 bytes/token; JSON and code tokenize denser than prose),
+# and requests are packed to 80% of the limit to leave room for estimation error.
+BYTES_PER_TOKEN = 3
+REQUEST_TOKEN_BUDGET = int(MAX_REQUEST_TOKENS * 0.8)
+
+_truncated = 0
+_truncated_lock = threading.Lock()
+
+MICRO_BATCH_WAIT_S = 0.005
+# batches that may be waiting on the API at once; one slow request must not hold up other callers
+MICRO_BATCH_MAX_IN_FLIGHT = int(os.getenv("MICRO_BATCH_MAX_IN_FLIGHT", "4"))
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, math.ceil(len((text or "").encode("utf-8")) / BYTES_PER_TOKEN))
+
+
+def truncate_to_tokens(text: str, max_tokens: int = MAX_INPUT_TOKENS) -> str:
+    global _truncated
+    max_bytes = max_tokens * BYTES_PER_TOKEN
+    data = text.encode("utf-8")
+    if len(data) <= max_bytes:
+        return text
+    with _truncated_lock:
+        _truncated += 1
+        first = _truncated == 1
+    if first:
+        print(f"⚠️ Embedding input of {len(data)} bytes truncated to {max_bytes} "
+              f"(~{max_tokens} tokens); further truncations are only counted")
+    return data[:max_bytes].decode("utf-8", errors="ignore")
+
+
+def truncated_inputs() -> int:
+    """Inputs shortened by truncate_to_tokens() in this process."""
+    return _truncated
+
+
+def pack_batches(texts: list, token_budget: int = REQUEST_TOKEN_BUDGET,
+                 max_inputs: int = MAX_REQUEST_INPUTS) -> list:
+    """Returns lists of indexes into texts; each list is one request."""
+    batches, current, current_tokens = [], [], 0
+    for i, text in enumerate(texts):
+        t = min(estimate_tokens(text), MAX_INPUT_TOKENS)
+        if current and (current_tokens + t > token_budget or len(current) >= max_inputs):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += t
+    if current:
+        batches.append(current)
+    return batches
+
+
+def is_too_large(exc: BadRequestError) -> bool:
+    msg = str(exc).lower()
+    return "token" in msg or "too large" in msg or "too long" in msg or "maximum" in msg
+
+
+def _create(client, texts: list, model: str, dimensions) -> list:
+    kwargs = {"model": model, "input": texts}
+    if dimensions:
+        kwargs["dimensions"] = dimensions
+    return [d.embedding for d in client.embeddings.create(**kwargs).data]
+
+
+def shorten_input(text: str):
+    """A single input the estimate let through but the API rejected: 75% of it, or None if it cannot shrink."""
+    shorter = text[:int(len(text) * 0.75)]
+    return shorter if shorter and shorter != text else None
+
+
+def _send(client, texts: list, model: str, dimensions) -> list:
+    try:
+        return _create(client, texts, model, dimensions)
+    except BadRequestError as e:
+        if not is_too_large(e):
+            raise
+        if len(texts) > 1:
+            mid = len(texts) // 2
+            return _send(client, texts[:mid], model, dimensions) + _send(client, texts[mid:], model, dimensions)
+        # A single input the estimate let through: cut it further until it fits.
+        shorter = shorten_input(texts[0])
+        if shorter is None:
+            raise
+        return _send(client, [shorter], model, dimensions)
+
+
+def request_embeddings(client, texts: list, model: str, dimensions=None) -> list:
+    """
+    One vector per text, using as few requests as the token limits allow.
+    `client` is an OpenAI client, or an AsyncEmbeddingClient (rate-limited, retrying),
+    which does its own packing.
+    """
+    if hasattr(client, "embed_sync"):
+        if (client.model, client.dimensions) != (model, dimensions):
+            raise ValueError(f"AsyncEmbeddingClient is configured for {client.model}/{client.dimensions}")
+        return client.embed_sync(texts)
+    texts = [truncate_to_tokens(t) for t in texts]
+    out = [None] * len(texts)
+    for idx in pack_batches(texts):
+        vectors = _send(client, [texts[i] for i in idx], model, dimensions)
+        for i, v in zip(idx, vectors):
+            out[i] = v
+    return out
+
+
+class MicroBatcher:
+    """
+    Collects embed requests submitted from many threads for up to MICRO_BATCH_WAIT_S and
+    sends them as one request. submit() returns a Future with the vector.
+    Up to max_in_flight batches are sent concurrently: while one request is slow, the next
+    batch goes out on another worker instead of queueing behind it.
+    """
+
+    def __init__(self, client, model: str, dimensions=None, wait_s: float = MICRO_BATCH_WAIT_S,
+                 max_in_flight: int = MICRO_BATCH_MAX_IN_FLIGHT):
+        self.client = client
+        self.model = model
+        self.dimensions = dimensions
+        self.wait_s = wait_s
+        self.cond = threading.Condition()
+        self.pending = []   # (text, Future)
+        self.requests = 0
+        self.items = 0
+        for _ in range(max(1, max_in_flight)):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, text: str) -> Future:
+        fut = Future()
+        with self.cond:
+            self.pending.append((text, fut))
+            self.cond.notify()
+        return fut
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            time.sleep(self.wait_s)   # let concurrent callers join this batch
+            with self.cond:
+                batch, self.pending = self.pending, []
+            if not batch:
+                continue   # another worker woke for the same requests and took them
+            try:
+                vectors = request_embeddings(self.client, [t for t, _ in batch], self.model, self.dimensions)
+                for (_, fut), vec in zip(batch, vectors):
+                    fut.set_result(vec)
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+            with self.cond:
+                self.requests += 1
+                self.items += len(batch)
@@ -0,0 +1,252 @@
+"""
+Persistent, content-addressed embedding cache shared by all scripts.
+
+Key: (model, dimensions, sha256(text)). Vectors are stored as packed float32 blobs in a
+local SQLite file, so re-embedding text we have seen before costs no API call.
+The cache is size-bounded: least-recently-used entries are evicted past the limit.
+Hits only record their last-used time in memory; the times are written in one batch
+(every TOUCH_FLUSH_ROWS hits or TOUCH_FLUSH_S, before eviction, and at exit), so a hit
+does not cost a write transaction.
+
+Usage:
+    from embedding_cache import embed_with_cache, embed_one
+    vectors = embed_with_cache(client, ["text a", "text b"])
+    vector = embed_one(client, "a single query")
+
+Cache misses are sent through embedding_batcher (token-budgeted requests).
+"""
+import os
+import time
+import atexit
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+from embedding_batcher import request_embeddings, truncated_inputs, MicroBatcher
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(".cache", "embeddings.sqlite"))
+CACHE_MAX_MB = float(os.getenv("EMBEDDING_CACHE_MAX_MB", "512"))
+CACHE_DISABLED = os.getenv("EMBEDDING_CACHE_DISABLED", "").lower() in ("1", "true", "yes")
+TOUCH_FLUSH_ROWS = 500
+TOUCH_FLUSH_S = 5.0
+
+
+def cache_key(model: str, dimensions, text: str) -> str:
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{model}:{dimensions or 'default'}:{digest}"
+
+
+def pack_vector(vec) -> bytes:
+    return array("f", vec).tobytes()
+
+
+def unpack_vector(blob: bytes) -> list:
+    a = array("f")
+    a.frombytes(blob)
+    return a.tolist()
+
+
+class EmbeddingCache:
+    """SQLite-backed LRU cache of float32 vectors. Safe to share between threads."""
+
+    def __init__(self, path: str = CACHE_PATH, max_mb: float = CACHE_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self._touched = {}   # key -> last_used, not yet written
+        self._touched_at = time.monotonic()
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("""
+            create table if not exists embeddings (
+              key text primary key,
+              vec blob not null,
+              size int not null,
+              last_used real not null
+            )
+        """)
+        self.db.execute("create index if not exists idx_embeddings_last_used on embeddings (last_used)")
+        self.db.commit()
+        self.total_bytes = self.db.execute("select coalesce(sum(size), 0) from embeddings").fetchone()[0]
+        atexit.register(self.flush)
+
+    def get_many(self, keys: list) -> dict:
+        """Returns {key: vector} for the keys that are cached."""
+        found = {}
+        if not keys:
+            return found
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                marks = ",".join("?" * len(part))
+                for key, blob in self.db.execute(
+                        f"select key, vec from embeddings where key in ({marks})", part):
+                    found[key] = unpack_vector(blob)
+            now = time.time()
+            self._touched.update((k, now) for k in found)
+            if (len(self._touched) >= TOUCH_FLUSH_ROWS
+                    or time.monotonic() - self._touched_at >= TOUCH_FLUSH_S):
+                self._write_touches()
+                self.db.commit()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, items: dict):
+        """items: {key: vector}"""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, vec in items.items():
+            blob = pack_vector(vec)
+            rows.append((key, blob, len(blob), now))
+        with self.lock:
+            # a replaced row (e.g. two threads missing on the same text) frees its old size
+            replaced = 0
+            keys = list(items)
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                marks = ",".join("?" * len(part))
+                replaced += self.db.execute(
+                    f"select coalesce(sum(size), 0) from embeddings where key in ({marks})", part).fetchone()[0]
+            self.db.executemany(
+                "insert or replace into embeddings (key, vec, size, last_used) values (?, ?, ?, ?)", rows)
+            self.total_bytes += sum(r[2] for r in rows) - replaced
+            if self.total_bytes > self.max_bytes:
+                self._write_touches()   # evict by up-to-date recency
+                self._evict()
+            self.db.commit()
+
+    def flush(self):
+        """Writes pending last-used times (called at exit)."""
+        with self.lock:
+            if self._touched:
+                self._write_touches()
+                self.db.commit()
+
+    def _write_touches(self):
+        if self._touched:
+            self.db.executemany("update embeddings set last_used = ? where key = ?",
+                                [(t, k) for k, t in self._touched.items()])
+            self._touched = {}
+        self._touched_at = time.monotonic()
+
+    def _evict(self):
+        # Drop least-recently-used rows until we are back under 90% of the limit.
+        target = int(self.max_bytes * 0.9)
+        while self.total_bytes > target:
+            rows = self.db.execute(
+                "select key, size from embeddings order by last_used asc limit 1000").fetchall()
+            if not rows:
+                self.total_bytes = 0
+                return
+            freed = 0
+            keys = []
+            for key, size in rows:
+                keys.append((key,))
+                freed += size
+                if self.total_bytes - freed <= target:
+                    break
+            self.db.executemany("delete from embeddings where key = ?", keys)
+            self.total_bytes -= freed
+            self.evictions += len(keys)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions,
+            "size_mb": round(self.total_bytes / (1024 * 1024), 1),
+            "truncated": truncated_inputs(),
+        }
+
+    def stats_line(self) -> str:
+        s = self.stats()
+        return (f"Embedding cache: {s['hits']} hits, {s['misses']} misses "
+                f"(hit rate {s['hit_rate']}), {s['evictions']} evicted, {s['size_mb']} MB on disk, "
+                f"{s['truncated']} over-long input(s) truncated")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> EmbeddingCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
+
+
+def embed_with_cache(client, texts: list, model: str = EMBEDDING_MODEL, dimensions=None) -> list:
+    """
+    Drop-in replacement for client.embeddings.create(...).data, returning one vector per
+    input text. Only texts missing from the cache are sent to the API (packed into as few
+    requests as the token limits allow), and duplicates within the call are embedded once.
+    """
+    if not texts:
+        return []
+
+    def call_api(batch):
+        return request_embeddings(client, batch, model, dimensions)
+
+    if CACHE_DISABLED:
+        return call_api(list(texts))
+
+    cache = get_cache()
+    keys = [cache_key(model, dimensions, t) for t in texts]
+    found = cache.get_many(keys)
+
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in missing:
+            missing[key] = text
+
+    if missing:
+        vectors = call_api(list(missing.values()))
+        fresh = dict(zip(missing.keys(), vectors))
+        cache.put_many(fresh)
+        found.update(fresh)
+
+    return [found[k] for k in keys]
+
+
+_micro_batchers = {}
+
+
+def embed_one(client, text: str, model: str = EMBEDDING_MODEL, dimensions=None) -> list:
+    """
+    Single-text embedding for request paths (queries). A cache miss is handed to a shared
+    MicroBatcher, so concurrent callers in this process share one API request.
+    """
+    if not CACHE_DISABLED:
+        cache = get_cache()
+        key = cache_key(model, dimensions, text)
+        hit = cache.get_many([key])
+        if key in hit:
+            return hit[key]
+
+    with _cache_lock:
+        mb_key = (id(client), model, dimensions)
+        batcher = _micro_batchers.get(mb_key)
+        if batcher is None:
+            batcher = _micro_batchers[mb_key] = MicroBatcher(client, model, dimensions)
+    vec = batcher.submit(text).result()
+
+    if not CACHE_DISABLED:
+        cache.put_many({key: vec})
+    return vec
@@ -0,0 +1,257 @@
+"""
+Adaptive, rate-limited asyncio client for the embeddings API.
+
+- Token buckets for requests/minute and tokens/minute (OPENAI_EMBED_RPM / OPENAI_EMBED_TPM)
+  so we stay inside the quota instead of discovering it through 429s.
+- Retries 429 / 5xx / timeouts / connection errors with jittered exponential backoff and
+  honours Retry-After when the API sends it.
+- AIMD concurrency: +1 in-flight request after a window of healthy responses, halved on
+  throttling, -1 when latency per token climbs well above the best observed (so a large
+  batch is not mistaken for a slow API).
+- A request rejected as too large is split in half; a single over-long input is cut
+  further, exactly like the sync path in embedding_batcher.
+
+Batch scripts use it through embed_sync() from worker threads; the event loop runs in a
+background thread owned by the client.
+
+Usage:
+    embedder = AsyncEmbeddingClient(api_key=OPENAI_API_KEY)
+    vectors = embed_with_cache(embedder, texts)      # or embedder.embed_sync(texts)
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+
+import httpx
+from openai import (
+    AsyncOpenAI,
+    BadRequestError,
+    RateLimitError,
+    APIStatusError,
+    APITimeoutError,
+    APIConnectionError,
+)
+
+from embedding_batcher import (
+    pack_batches,
+    estimate_tokens,
+    truncate_to_tokens,
+    shorten_input,
+    is_too_large,
+    MAX_INPUT_TOKENS,
+)
+
+EMBED_RPM = int(os.getenv("OPENAI_EMBED_RPM", "3000"))
+EMBED_TPM = int(os.getenv("OPENAI_EMBED_TPM", "1000000"))
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "16"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "8"))
+BACKOFF_BASE_S = 0.5
+BACKOFF_MAX_S = 60.0
+# fixed per-request cost, in tokens, added before comparing latency per token: without it a
+# one-line request would look slow next to the per-token best of a full batch
+LATENCY_OVERHEAD_TOKENS = 500
+
+
+class TokenBucket:
+    """Refills `per_minute` units spread evenly over a minute; acquire() waits for capacity."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                await asyncio.sleep((amount - self.level) / self.rate)
+
+    def drain(self):
+        """After a 429 the server disagrees with our count: start from empty."""
+        self._refill()
+        self.level = 0.0
+
+
+class AdaptiveLimit:
+    """Resizable concurrency limit (asyncio.Semaphore cannot change its size)."""
+
+    def __init__(self, initial: int, maximum: int):
+        self.limit = initial
+        self.maximum = maximum
+        self.in_flight = 0
+        self.cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.cond:
+            while self.in_flight >= self.limit:
+                await self.cond.wait()
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc):
+        async with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    async def resize(self, new_limit: int):
+        async with self.cond:
+            self.limit = max(1, min(self.maximum, new_limit))
+            self.cond.notify_all()
+
+
+def _retry_after(exc) -> float:
+    response = getattr(exc, "response", None)
+    if response is None:
+        return 0.0
+    value = response.headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    try:
+        return float(value) if value else 0.0
+    except ValueError:
+        return 0.0
+
+
+def _is_retryable(exc) -> bool:
+    if isinstance(exc, (RateLimitError, APITimeoutError, APIConnectionError)):
+        return True
+    return isinstance(exc, APIStatusError) and exc.status_code >= 500
+
+
+class AsyncEmbeddingClient:
+    def __init__(self, api_key: str, model: str = "text-embedding-3-small", dimensions=None,
+                 rpm: int = EMBED_RPM, tpm: int = EMBED_TPM,
+                 max_concurrency: int = EMBED_MAX_CONCURRENCY, max_retries: int = EMBED_MAX_RETRIES):
+        self.api_key = api_key
+        self.model = model
+        self.dimensions = dimensions
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.best_latency = None
+        self.healthy_streak = 0
+
+        # The loop (and everything bound to it) lives in a daemon thread.
+        self.loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        threading.Thread(target=self._run_loop, daemon=True).start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        # Corporate SSL workaround, same as the sync clients. SDK retries are off: we retry here.
+        self.client = AsyncOpenAI(api_key=self.api_key, max_retries=0,
+                                  http_client=httpx.AsyncClient(verify=False, timeout=60.0))
+        self.rpm_bucket = TokenBucket(self.rpm)
+        self.tpm_bucket = TokenBucket(self.tpm)
+        self.limit = AdaptiveLimit(min(4, self.max_concurrency), self.max_concurrency)
+        self._ready.set()
+        self.loop.run_forever()
+
+    async def _adapt(self, latency: float = None, tokens: int = 0, throttled: bool = False):
+        if throttled:
+            self.throttled += 1
+            self.healthy_streak = 0
+            await self.limit.resize(self.limit.limit // 2)
+            return
+        if latency is None:
+            # failed without throttling (5xx / timeout): don't grow, don't shrink
+            self.healthy_streak = 0
+            return
+        latency /= tokens + LATENCY_OVERHEAD_TOKENS   # seconds per token
+        self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+        if latency > 3 * self.best_latency and self.limit.limit > 1:
+            self.healthy_streak = 0
+            await self.limit.resize(self.limit.limit - 1)
+            return
+        self.healthy_streak += 1
+        if self.healthy_streak >= self.limit.limit:
+            self.healthy_streak = 0
+            await self.limit.resize(self.limit.limit + 1)
+
+    async def _request(self, texts: list) -> list:
+        tokens = sum(min(estimate_tokens(t), MAX_INPUT_TOKENS) for t in texts)
+        kwargs = {"model": self.model, "input": texts}
+        if self.dimensions:
+            kwargs["dimensions"] = self.dimensions
+
+        for attempt in range(self.max_retries + 1):
+            await self.rpm_bucket.acquire(1)
+            await self.tpm_bucket.acquire(tokens)
+            async with self.limit:
+                t0 = time.monotonic()
+                try:
+                    resp = await self.client.embeddings.create(**kwargs)
+                except Exception as e:
+                    if attempt >= self.max_retries or not _is_retryable(e):
+                        raise
+                    error = e
+                else:
+                    self.requests += 1
+                    await self._adapt(latency=time.monotonic() - t0, tokens=tokens)
+                    return [d.embedding for d in resp.data]
+
+            self.retries += 1
+            throttled = isinstance(error, RateLimitError)
+            if throttled:
+                self.rpm_bucket.drain()
+                self.tpm_bucket.drain()
+            await self._adapt(throttled=throttled)
+            backoff = min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt)
+            await asyncio.sleep(max(_retry_after(error), random.uniform(0, backoff)))
+
+    async def _request_or_split(self, texts: list) -> list:
+        try:
+            return await self._request(texts)
+        except BadRequestError as e:
+            if not is_too_large(e):
+                raise
+            if len(texts) == 1:
+                shorter = shorten_input(texts[0])
+                if shorter is None:
+                    raise
+                return await self._request_or_split([shorter])
+            mid = len(texts) // 2
+            return (await self._request_or_split(texts[:mid])) + (await self._request_or_split(texts[mid:]))
+
+    async def embed(self, texts: list) -> list:
+        """All batches of one call run concurrently, bounded by the adaptive limit."""
+        texts = [truncate_to_tokens(t) for t in texts]
+        batches = pack_batches(texts)
+        results = await asyncio.gather(*[self._request_or_split([texts[i] for i in idx]) for idx in batches])
+        out = [None] * len(texts)
+        for idx, vectors in zip(batches, results):
+            for i, v in zip(idx, vectors):
+                out[i] = v
+        return out
+
+    def embed_sync(self, texts: list) -> list:
+        """Thread-safe blocking wrapper; many threads can share one client."""
+        if not texts:
+            return []
+        return asyncio.run_coroutine_threadsafe(self.embed(list(texts)), self.loop).result()
+
+    def stats_line(self) -> str:
+        return (f"Embedding client: {self.requests} requests, {self.retries} retries, "
+                f"{self.throttled} throttled, concurrency now {self.limit.limit}/{self.max_concurrency}")
@@ -0,0 +1,458 @@
+"""
+Local, in-process mirror of public.knowledge_chunks for offline / sub-millisecond retrieval.
+
+Snapshot layout (LOCAL_INDEX_DIR, default .cache/local_index/):
+    current.json            -> {"dir": "v000003"}, swapped atomically after every sync
+    v000003/vectors.npy     float32 [N, 1536], L2-normalised (dot product = cosine)
+    v000003/ids.npy, document_ids.npy, chunk_index.npy, created_at.npy   columnar metadata
+    v000003/doc_type.npy, sheet_name.npy, tenant.npy                     partition filters
+    v000003/contents.bin + content_offsets.npy                           UTF-8 text blob
+    v000003/terms.npy + term_offsets.npy, term_rows.npy, term_counts.npy  keyword postings
+    v000003/manifest.json   count, dims, sync cursor, optional IVF parameters
+Everything is opened with mmap, so a cold start maps the files instead of reading them.
+
+Sync is incremental: new chunks are fetched by (created_at, id) keyset after the last
+cursor; chunks deleted or renumbered by incremental ingestion are detected from a cheap
+id/chunk_index/content_hash listing (no embeddings), so only changed rows move.
+
+search() is exact (one matrix-vector product + argpartition); with ann=True an IVF index
+(k-means lists) is built at sync time and queries probe the nearest lists only.
+rpc() answers search_knowledge_chunks / _hybrid / _keyword payloads with the
+same rows as the Supabase RPCs (including the doc_types / sheet_names / document_ids /
+tenant_id filters), so scripts switch backends with RETRIEVAL_BACKEND=local.
+
+Usage:
+    python local_index.py sync [--ann]      # build / refresh the snapshot
+    index = get_local_index()               # in a script: open (and sync) once
+    rows = index.rpc("search_knowledge_chunks", {"query_embedding": q, "match_count": 5})
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import threading
+import requests
+from collections import Counter
+
+import numpy as np
+
+from supabase_client import SupabaseClient
+
+INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", os.path.join(".cache", "local_index"))
+DIMS = 1536
+PAGE_SIZE = 500
+TAG_COLUMNS = ("doc_type", "sheet_name", "tenant")
+FULL_ROW_SELECT = ("id,document_id,chunk_index,content,created_at,embedding,"
+                   "content_hash:metadata->>content_hash," + ",".join(TAG_COLUMNS))
+ANN_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", "8"))
+KMEANS_ITERATIONS = 8
+MAX_TERM_LENGTH = 64   # longer "words" (ids, base64) are not worth indexing
+TERM_RE = re.compile(r"[a-z0-9]+")
+
+
+def _normalise(m: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(m, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return m / norms
+
+
+def _parse_vector(value) -> list:
+    # PostgREST returns vector columns as text: "[0.1,0.2,...]"
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+def build_postings(texts) -> dict:
+    """
+    Term index over texts: sorted vocabulary, and per term the rows containing it with
+    the number of occurrences. Postings are stored in vocabulary order, so all terms
+    sharing a prefix are one contiguous slice.
+    """
+    postings = {}
+    for row, text in enumerate(texts):
+        for term, n in Counter(TERM_RE.findall(text.lower())).items():
+            if len(term) <= MAX_TERM_LENGTH:
+                postings.setdefault(term, []).append((row, n))
+    vocab = sorted(postings)
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(postings[t]) for t in vocab])
+    pairs = [p for t in vocab for p in postings[t]]
+    return {
+        "terms": np.asarray(vocab, dtype=f"<U{MAX_TERM_LENGTH}"),
+        "term_offsets": offsets,
+        "term_rows": np.asarray([r for r, _ in pairs], dtype=np.int32),
+        "term_counts": np.asarray([n for _, n in pairs], dtype=np.int32),
+    }
+
+
+def kmeans(vectors: np.ndarray, n_lists: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on a sample; returns normalised centroids [n_lists, dims]."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(vectors.shape[0], n_lists * 64)
+    sample = np.asarray(vectors[np.sort(rng.choice(vectors.shape[0], sample_size, replace=False))])
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(n_lists):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = _normalise(centroids)
+    return centroids.astype(np.float32)
+
+
+class LocalIndex:
+    def __init__(self, path: str = INDEX_DIR):
+        self.path = path
+        self.count = 0
+        self.manifest = {}
+        self.vectors = np.zeros((0, DIMS), dtype=np.float32)
+        self.ids = np.zeros(0, dtype="<U36")
+        self.document_ids = np.zeros(0, dtype="<U36")
+        self.chunk_index = np.zeros(0, dtype=np.int32)
+        self.created_at = np.zeros(0, dtype="<U40")
+        self.content_hash = np.zeros(0, dtype="<U64")
+        self.tags = {c: np.zeros(0, dtype="<U64") for c in TAG_COLUMNS}
+        self.contents = np.zeros(0, dtype=np.uint8)
+        self.content_offsets = np.zeros(1, dtype=np.int64)
+        self.centroids = None
+        self.list_order = None
+        self.list_offsets = None
+        self.postings = build_postings([])
+        self.load()
+
+    # --- snapshot files ---
+    def _current_dir(self):
+        pointer = os.path.join(self.path, "current.json")
+        if not os.path.exists(pointer):
+            return None
+        with open(pointer, "r", encoding="utf-8") as f:
+            return os.path.join(self.path, json.load(f)["dir"])
+
+    def load(self):
+        folder = self._current_dir()
+        if not folder or not os.path.isdir(folder):
+            return
+
+        def mapped(name):
+            return np.load(os.path.join(folder, name), mmap_mode="r")
+
+        with open(os.path.join(folder, "manifest.json"), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.count = self.manifest["count"]
+        self.vectors = mapped("vectors.npy")
+        self.ids = mapped("ids.npy")
+        self.document_ids = mapped("document_ids.npy")
+        self.chunk_index = mapped("chunk_index.npy")
+        self.created_at = mapped("created_at.npy")
+        self.content_hash = mapped("content_hash.npy")
+        # snapshots written before the partition columns existed: treat as untagged
+        self.tags = {c: mapped(f"{c}.npy") if os.path.exists(os.path.join(folder, f"{c}.npy"))
+                     else np.full(self.count, "", dtype="<U64") for c in TAG_COLUMNS}
+        self.content_offsets = mapped("content_offsets.npy")
+        self.contents = (np.memmap(os.path.join(folder, "contents.bin"), dtype=np.uint8, mode="r")
+                         if self.content_offsets[-1] else np.zeros(0, dtype=np.uint8))
+        if self.manifest.get("ann"):
+            self.centroids = mapped("centroids.npy")
+            self.list_order = mapped("list_order.npy")
+            self.list_offsets = mapped("list_offsets.npy")
+        else:
+            self.centroids = self.list_order = self.list_offsets = None
+        if os.path.exists(os.path.join(folder, "terms.npy")):
+            self.postings = {k: mapped(f"{k}.npy") for k in ("terms", "term_offsets", "term_rows", "term_counts")}
+        else:
+            # snapshot written before the term index existed: build it in memory once
+            self.postings = build_postings(self.content(i) for i in range(self.count))
+
+    def _save(self, columns: dict, texts: list, manifest: dict):
+        version = self.manifest.get("version", 0) + 1
+        name = f"v{version:06d}"
+        folder = os.path.join(self.path, name)
+        os.makedirs(folder, exist_ok=True)
+
+        for key, arr in {**columns, **build_postings(texts)}.items():
+            np.save(os.path.join(folder, f"{key}.npy"), arr)
+        blobs = [t.encode("utf-8") for t in texts]
+        offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+        if blobs:
+            offsets[1:] = np.cumsum([len(b) for b in blobs])
+        np.save(os.path.join(folder, "content_offsets.npy"), offsets)
+        with open(os.path.join(folder, "contents.bin"), "wb") as f:
+            for b in blobs:
+                f.write(b)
+        manifest = {**manifest, "version": version, "count": len(texts), "dims": DIMS, "synced_at": time.time()}
+        with open(os.path.join(folder, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+        pointer = os.path.join(self.path, "current.json")
+        with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"dir": name}, f)
+        os.replace(pointer + ".tmp", pointer)   # readers see the old or the new snapshot, never half
+
+        old = [d for d in os.listdir(self.path) if d.startswith("v") and d != name]
+        self.load()
+        for d in old:
+            # a file still mapped by another process cannot be removed on Windows; retried next sync
+            shutil.rmtree(os.path.join(self.path, d), ignore_errors=True)
+
+    def content(self, i: int) -> str:
+        start, end = int(self.content_offsets[i]), int(self.content_offsets[i + 1])
+        return bytes(self.contents[start:end]).decode("utf-8")
+
+    # --- sync from Supabase ---
+    def sync(self, supabase_url: str, service_key: str, ann: bool = None) -> dict:
+        """Brings the snapshot up to date; returns counts of added / removed / renumbered rows."""
+        db = SupabaseClient(supabase_url, service_key)
+
+        def get(params):
+            return db.select("knowledge_chunks", params, timeout=120)
+
+        # 1) cheap listing of what exists now (no embeddings, no content)
+        listing, last_id = {}, None
+        while True:
+            params = {"select": "id,chunk_index,content_hash:metadata->>content_hash," + ",".join(TAG_COLUMNS),
+                      "embedding": "not.is.null", "order": "id.asc", "limit": 5000}
+            if last_id:
+                params["id"] = f"gt.{last_id}"
+            page = get(params)
+            for row in page:
+                listing[row["id"]] = row
+            if len(page) < 5000:
+                break
+            last_id = page[-1]["id"]
+
+        local = {str(i): n for n, i in enumerate(self.ids)}
+        keep = [n for i, n in local.items() if i in listing
+                and listing[i].get("content_hash") == str(self.content_hash[n])]
+        keep.sort()
+        removed = len(local) - len(keep)
+        missing = [i for i in listing if i not in local
+                   or listing[i].get("content_hash") != str(self.content_hash[local[i]])]
+
+        # 2) full rows for everything we do not have: new since the cursor, plus any gaps
+        fetched = []
+        cursor = self.manifest.get("cursor")
+        if missing:
+            want = set(missing)
+            while True:
+                params = {"select": FULL_ROW_SELECT,
+                          "embedding": "not.is.null", "order": "created_at.asc,id.asc", "limit": PAGE_SIZE}
+                if cursor:
+                    params["or"] = f'(created_at.gt."{cursor[0]}",and(created_at.eq."{cursor[0]}",id.gt.{cursor[1]}))'
+                page = get(params)
+                fetched.extend(r for r in page if r["id"] in want)
+                if page:
+                    cursor = [page[-1]["created_at"], page[-1]["id"]]
+                if len(page) < PAGE_SIZE:
+                    break
+            # rows older than the cursor that we still lack (e.g. first sync after a wipe)
+            got = {r["id"] for r in fetched}
+            stragglers = [i for i in missing if i not in got]
+            for n in range(0, len(stragglers), 100):
+                ids = ",".join(stragglers[n:n + 100])
+                fetched.extend(get({"select": FULL_ROW_SELECT,
+                                    "id": f"in.({ids})"}))
+
+        renumbered = sum(1 for n in keep if int(self.chunk_index[n]) != int(listing[str(self.ids[n])]["chunk_index"]))
+        retagged = sum(1 for n in keep if any(str(self.tags[c][n]) != (listing[str(self.ids[n])].get(c) or "")
+                                              for c in TAG_COLUMNS))
+        ann = self.manifest.get("ann", False) if ann is None else ann
+        if not fetched and not removed and not renumbered and not retagged and ann == bool(self.manifest.get("ann")):
+            return {"added": 0, "removed": 0, "renumbered": 0, "retagged": 0, "count": self.count}
+
+        keep_idx = np.asarray(keep, dtype=np.int64)
+        new_vectors = (_normalise(np.asarray([_parse_vector(r["embedding"]) for r in fetched], dtype=np.float32))
+                       if fetched else np.zeros((0, DIMS), dtype=np.float32))
+        columns = {
+            "vectors": np.concatenate([np.asarray(self.vectors[keep_idx]), new_vectors]).astype(np.float32),
+            "ids": np.concatenate([np.asarray(self.ids[keep_idx]),
+                                   np.asarray([r["id"] for r in fetched], dtype="<U36")]),
+            "document_ids": np.concatenate([np.asarray(self.document_ids[keep_idx]),
+                                            np.asarray([r["document_id"] for r in fetched], dtype="<U36")]),
+            "chunk_index": np.concatenate([
+                np.asarray([listing[str(self.ids[n])]["chunk_index"] for n in keep], dtype=np.int32),
+                np.asarray([r["chunk_index"] for r in fetched], dtype=np.int32)]),
+            "created_at": np.concatenate([np.asarray(self.created_at[keep_idx]),
+                                          np.asarray([r["created_at"] for r in fetched], dtype="<U40")]),
+            "content_hash": np.concatenate([np.asarray(self.content_hash[keep_idx]),
+                                            np.asarray([r.get("content_hash") or "" for r in fetched], dtype="<U64")]),
+        }
+        for c in TAG_COLUMNS:
+            columns[c] = np.asarray([listing[str(self.ids[n])].get(c) or "" for n in keep] +
+                                    [r.get(c) or "" for r in fetched], dtype="<U64")
+        texts = [self.content(n) for n in keep] + [r["content"] for r in fetched]
+
+        manifest = {"cursor": cursor, "ann": bool(ann)}
+        if ann and len(texts):
+            n_lists = int(max(1, min(4096, np.sqrt(len(texts)))))
+            centroids = kmeans(columns["vectors"], n_lists)
+            assign = np.argmax(columns["vectors"] @ centroids.T, axis=1)
+            order = np.argsort(assign, kind="stable").astype(np.int64)
+            offsets = np.zeros(n_lists + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(np.bincount(assign, minlength=n_lists))
+            columns.update({"centroids": centroids, "list_order": order, "list_offsets": offsets})
+            manifest["n_lists"] = n_lists
+        elif ann:
+            manifest["ann"] = False
+
+        self._save(columns, texts, manifest)
+        return {"added": len(fetched), "removed": removed, "renumbered": renumbered, "retagged": retagged,
+                "count": self.count}
+
+    # --- search ---
+    def _filter_rows(self, doc_types=None, sheet_names=None, document_ids=None, tenant_id=None):
+        """Row numbers matching the filters (same semantics as knowledge_chunk_filter_sql), or None."""
+        if doc_types is None and sheet_names is None and document_ids is None and tenant_id is None:
+            return None
+        mask = np.ones(self.count, dtype=bool)
+        if doc_types is not None:
+            mask &= np.isin(self.tags["doc_type"], doc_types)
+        if sheet_names is not None:
+            mask &= np.isin(self.tags["sheet_name"], sheet_names)
+        if document_ids is not None:
+            mask &= np.isin(self.document_ids, document_ids)
+        if tenant_id is not None:
+            tenant = np.asarray(self.tags["tenant"])
+            mask &= (tenant == tenant_id) | (tenant == "")
+        return np.flatnonzero(mask)
+
+    def _candidates(self, q: np.ndarray, nprobe: int):
+        if self.centroids is None:
+            return None
+        lists = _top_k(np.asarray(self.centroids) @ q, nprobe)
+        parts = [self.list_order[self.list_offsets[c]:self.list_offsets[c + 1]] for c in lists]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def search(self, query_embedding, match_count: int = 5, ann: bool = None, nprobe: int = ANN_NPROBE,
+               **filters) -> list:
+        """Same rows as search_knowledge_chunks: id, document_id, chunk_index, content, score."""
+        if not self.count:
+            return []
+        q = _normalise(np.asarray(_parse_vector(query_embedding), dtype=np.float32))
+        allowed = self._filter_rows(**filters)
+        use_ann = self.centroids is not None if ann is None else (ann and self.centroids is not None)
+        if allowed is not None:
+            # a filtered slice is scanned exactly, like the small partitions in Postgres
+            scores = np.asarray(self.vectors[allowed]) @ q
+            pick = _top_k(scores, match_count)
+            top, top_scores = allowed[pick], scores[pick]
+        elif use_ann:
+            rows = self._candidates(q, nprobe)
+            scores = np.asarray(self.vectors[rows]) @ q
+            top = rows[_top_k(scores, match_count)]
+            top_scores = np.asarray(self.vectors[top]) @ q
+        else:
+            scores = self.vectors @ q
+            top = _top_k(scores, match_count)
+            top_scores = scores[top]
+        return [self._row(int(i), float(s)) for i, s in zip(top, top_scores)]
+
+    def keyword_search(self, keywords: list, match_count: int = 10, **filters) -> list:
+        """
+        Case-insensitive matching of words starting with each keyword (so "connector" also
+        finds "connectors"), ranked by number of hits: a local stand-in for ts_rank, answered
+        from the term index instead of scanning every chunk.
+        """
+        terms = [t for k in keywords or [] for t in TERM_RE.findall((k or "").lower()) if len(t) >= 2]
+        if not terms or not self.count:
+            return []
+        vocab, offsets = self.postings["terms"], self.postings["term_offsets"]
+        hits = np.zeros(self.count, dtype=np.int64)
+        for t in terms:
+            lo = int(np.searchsorted(vocab, t, side="left"))
+            hi = int(np.searchsorted(vocab, t[:-1] + chr(ord(t[-1]) + 1), side="left"))
+            if lo < hi:
+                a, b = int(offsets[lo]), int(offsets[hi])
+                np.add.at(hits, self.postings["term_rows"][a:b], self.postings["term_counts"][a:b])
+        allowed = self._filter_rows(**filters)
+        if allowed is not None:
+            hits[np.setdiff1d(np.arange(self.count), allowed, assume_unique=True)] = 0
+        rows = np.flatnonzero(hits)
+        rows = rows[np.argsort(-hits[rows], kind="stable")][:match_count]
+        return [self._row(int(i), None) for i in rows]
+
+    def search_hybrid(self, query_embedding, keywords=None, match_count: int = 10,
+                      vector_count: int = 12, keyword_count: int = 12, rrf_k: int = 60, **filters) -> list:
+        """Same rows and reciprocal rank fusion as search_knowledge_chunks_hybrid."""
+        fused = {}
+        for rank, row in enumerate(self.search(query_embedding, vector_count, **filters), start=1):
+            fused[row["id"]] = {**row, "rrf_score": 1.0 / (rrf_k + rank), "vector_rank": rank, "keyword_rank": None}
+        for rank, row in enumerate(self.keyword_search(keywords, keyword_count, **filters), start=1):
+            entry = fused.setdefault(row["id"], {**row, "rrf_score": 0.0, "vector_rank": None})
+            entry["rrf_score"] += 1.0 / (rrf_k + rank)
+            entry["keyword_rank"] = rank
+        rows = sorted(fused.values(), key=lambda r: (-r["rrf_score"], -(r["score"] or -1)))
+        return rows[:match_count]
+
+    def rpc(self, fn_name: str, payload: dict):
+        """Drop-in for the Supabase rpc() helper for the retrieval functions."""
+        filters = {k: payload.get(k) for k in ("doc_types", "sheet_names", "document_ids", "tenant_id")}
+        if fn_name == "search_knowledge_chunks":
+            return self.search(payload["query_embedding"], payload.get("match_count", 5), **filters)
+        if fn_name == "search_knowledge_chunks_hybrid":
+            return self.search_hybrid(payload["query_embedding"], payload.get("keywords"),
+                                      payload.get("match_count", 10), payload.get("vector_count", 12),
+                                      payload.get("keyword_count", 12), payload.get("rrf_k", 60), **filters)
+        if fn_name == "search_knowledge_chunks_keyword":
+            return self.keyword_search(payload.get("keywords"), payload.get("match_count", 10), **filters)
+        raise ValueError(f"Local index does not implement {fn_name}")
+
+    def _row(self, i: int, score) -> dict:
+        return {
+            "id": str(self.ids[i]),
+            "document_id": str(self.document_ids[i]),
+            "chunk_index": int(self.chunk_index[i]),
+            "content": self.content(i),
+            "score": score,
+        }
+
+    def stats_line(self) -> str:
+        mode = f"IVF {self.manifest.get('n_lists')} lists" if self.centroids is not None else "exact"
+        return f"Local index: {self.count} chunks ({mode}) in {self.path}"
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_local_index(sync: bool = True) -> LocalIndex:
+    """Opens the snapshot once per process; by default refreshes it from Supabase first."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            index = LocalIndex()
+            if sync:
+                url, key = os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+                try:
+                    print(f"Local index sync: {index.sync(url, key)}")
+                except requests.RequestException as e:
+                    if not index.count:
+                        raise
+                    print(f"⚠️ Local index sync failed, using snapshot as is: {e}")
+            _index = index   # published only once ready
+        return _index
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    args = sys.argv[1:]
+    if not args or args[0] not in ("sync", "stats"):
+        raise SystemExit("Usage: python local_index.py sync [--ann | --exact] | stats")
+    index = LocalIndex()
+    if args[0] == "sync":
+        ann = True if "--ann" in args else False if "--exact" in args else None
+        t0 = time.perf_counter()
+        print(index.sync(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"), ann=ann))
+        print(f"Synced in {time.perf_counter() - t0:.1f}s")
+    print(index.stats_line())
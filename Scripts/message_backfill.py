@@ -0,0 +1,156 @@
+"""
+Full-drain embedding backfill for public.messages.
+
+- Walks every message not yet handled (embedding_status IS NULL) in (created_at, id)
+  keyset order, so each page is an index range scan of the backlog only.
+- Embeds each page through the shared cache + rate-limited client; long messages are
+  segmented and pooled (message_embedding.py) instead of skipped.
+- Rows deliberately left unembedded (secrets, empty) are marked 'skipped', so they drop out
+  of the backlog instead of being fetched again by every run.
+- Writes a page back with ONE call to the set_message_embeddings RPC (not one PATCH per row),
+  overlapping that write with embedding the next page.
+- Checkpoints the last written (created_at, id) to .cache/, so a restart resumes there.
+  A completed drain clears the checkpoint: the next run starts from the beginning of the
+  (now small) backlog, so rows that became unhandled behind the cursor are not missed.
+
+Used by the 01_embed_* scripts; see "Supabase DB/Message Embedding Backfill.sql".
+"""
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from embedding_cache import get_cache
+from message_embedding import embed_messages
+from supabase_client import SupabaseClient
+
+CHECKPOINT_DIR = os.path.join(".cache", "backfill")
+PAGE_SIZE = int(os.getenv("BACKFILL_PAGE_SIZE", "500"))
+
+
+class BackfillWorker:
+    def __init__(self, supabase_url: str, service_key: str, embedder, user_id: str = None,
+                 should_skip=None, page_size: int = PAGE_SIZE, name: str = "messages"):
+        """
+        should_skip(row) -> str | None: a reason to leave the row unembedded (e.g. secrets).
+        user_id: restrict to one user's messages (None = all users).
+        """
+        self.db = SupabaseClient(supabase_url, service_key)
+        self.embedder = embedder
+        self.user_id = user_id
+        self.should_skip = should_skip or (lambda row: None)
+        self.page_size = page_size
+        scope = user_id or "all"
+        self.checkpoint_path = os.path.join(CHECKPOINT_DIR, f"{name}_{scope}.json")
+        self.embedded = 0
+        self.pooled = 0
+        self.skipped = 0
+
+    # --- checkpoint ---
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return (data["created_at"], data["id"]) if data.get("id") else None
+
+    def save_checkpoint(self, cursor):
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"created_at": cursor[0], "id": cursor[1], "saved_at": time.time()}, f)
+        os.replace(tmp, self.checkpoint_path)   # atomic: never a half-written checkpoint
+
+    def reset_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    # --- Supabase ---
+    def fetch_page(self, cursor) -> list:
+        params = {
+            "select": "id,content,created_at",
+            "embedding_status": "is.null",
+            "order": "created_at.asc,id.asc",
+            "limit": self.page_size,
+        }
+        if self.user_id:
+            params["user_id"] = f"eq.{self.user_id}"
+        if cursor:
+            created_at, last_id = cursor
+            params["or"] = f'(created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt.{last_id}))'
+        return self.db.select("messages", params)
+
+    def write_page(self, updates: list):
+        if not updates:
+            return
+        # sets embedding + status by id: replaying a page is harmless, so it may retry
+        self.db.rpc("set_message_embeddings", {"updates": updates}, timeout=120,
+                    retries=self.db.max_retries)
+
+    # --- main loop ---
+    def embed_page(self, rows: list) -> list:
+        updates, todo = [], []
+        for r in rows:
+            reason = None if (r.get("content") or "").strip() else "empty"
+            reason = reason or self.should_skip(r)
+            if reason:
+                print(f"⚠️ Skipping embedding ({reason}) for: {r['id']}")
+                updates.append({"id": r["id"], "embedding": None, "status": "skipped"})
+                continue
+            todo.append(r)
+        for r, record in zip(todo, embed_messages(self.embedder, [r["content"] for r in todo])):
+            if record["status"] == "skipped":
+                print(f"⚠️ Skipping embedding (too many segments) for: {r['id']}")
+            updates.append({"id": r["id"], **record})
+        return updates
+
+    def run(self, reset: bool = False):
+        if reset:
+            self.reset_checkpoint()
+        cursor = self.load_checkpoint()
+        if cursor:
+            print(f"Resuming after checkpoint {cursor}")
+
+        started = time.time()
+        pages = 0
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending = None   # (future, cursor after that page, rows embedded)
+            while True:
+                rows = self.fetch_page(cursor)
+                if not rows:
+                    break
+                updates = self.embed_page(rows)
+                cursor = (rows[-1]["created_at"], rows[-1]["id"])
+                counts = {s: sum(1 for u in updates if u["status"] == s) for s in ("embedded", "pooled", "skipped")}
+
+                # Checkpoint only once the previous page is durably written.
+                if pending:
+                    self._finish(pending)
+                pending = (writer.submit(self.write_page, updates), cursor, counts)
+                pages += 1
+
+                rate = (self.embedded + self.pooled + self.skipped + len(updates)) / max(time.time() - started, 1e-6)
+                print(f"Page {pages}: {counts['embedded']} embedded, {counts['pooled']} pooled, "
+                      f"{counts['skipped']} skipped ({rate:.0f} msg/s)")
+                if len(rows) < self.page_size:
+                    break
+            if pending:
+                self._finish(pending)
+        self.reset_checkpoint()   # drained: nothing left behind the cursor to resume from
+
+        print(f"✅ Backfill done: {self.embedded} embedded, {self.pooled} pooled (long), {self.skipped} skipped, "
+              f"{pages} pages in {time.time() - started:.1f}s")
+        print(get_cache().stats_line())
+        if hasattr(self.embedder, "stats_line"):
+            print(self.embedder.stats_line())
+        print(self.db.stats_line())
+        for line in self.db.report():
+            print(f"  {line}")
+
+    def _finish(self, pending):
+        future, cursor, counts = pending
+        future.result()
+        self.embedded += counts["embedded"]
+        self.pooled += counts["pooled"]
+        self.skipped += counts["skipped"]
+        self.save_checkpoint(cursor)
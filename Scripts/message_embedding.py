@@ -0,0 +1,95 @@
+"""
+Message embeddings, including messages too long for one embedding request.
+
+Short messages get one embedding. Long ones (flow exports, pasted logs) are split into
+token-bounded segments, all segments of a page are embedded together, and the message
+vector is the length-weighted mean of its segment vectors, L2-normalised. Segment vectors
+can be kept in public.message_embedding_segments for fine-grained recall.
+
+embed_messages() returns one write-back record per message, in the format the
+set_message_embeddings RPC takes (see "Supabase DB/Message Embedding Backfill.sql"):
+    {"embedding": "[...]" | None, "status": "embedded" | "pooled" | "skipped", "segments": [...]}
+"""
+import os
+import math
+
+from embedding_cache import embed_with_cache
+from embedding_batcher import estimate_tokens, BYTES_PER_TOKEN
+
+SEGMENT_MAX_TOKENS = int(os.getenv("MESSAGE_SEGMENT_TOKENS", "1000"))
+MAX_SEGMENTS = int(os.getenv("MESSAGE_MAX_SEGMENTS", "256"))
+STORE_SEGMENTS = os.getenv("MESSAGE_STORE_SEGMENTS", "1").lower() in ("1", "true", "yes")
+
+# Preferred cut points, best first; minified JSON has no whitespace, so fall back to
+# JSON punctuation before cutting mid-token.
+_BREAKS = ("\n\n", "\n", ". ", " ", "},", ",", "}")
+
+
+def to_pgvector(vec):
+    # 9 significant digits round-trip float32 exactly (pgvector stores float4); str() of a
+    # cached float32 widened to double prints ~20 digits for nothing.
+    return "[" + ",".join(f"{x:.9g}" for x in vec) + "]"
+
+
+def segment_bounds(text: str, max_tokens: int = SEGMENT_MAX_TOKENS) -> list:
+    """(start, end) character offsets of consecutive segments that each fit max_tokens."""
+    bounds = []
+    start, n = 0, len(text)
+    while start < n:
+        end = min(n, start + max_tokens * BYTES_PER_TOKEN)
+        while end - start > 1 and estimate_tokens(text[start:end]) > max_tokens:
+            end = start + (end - start) * 9 // 10     # multi-byte text: shrink until it fits
+        if end < n:
+            window = text[start:end]
+            floor = len(window) // 2                  # never cut a segment below half size
+            for sep in _BREAKS:
+                cut = window.rfind(sep, floor)
+                if cut != -1:
+                    end = start + cut + len(sep)
+                    break
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def pool_vectors(vectors: list, weights: list) -> list:
+    total = float(sum(weights)) or 1.0
+    pooled = [0.0] * len(vectors[0])
+    for vec, w in zip(vectors, weights):
+        share = w / total
+        for i, x in enumerate(vec):
+            pooled[i] += x * share
+    norm = math.sqrt(sum(x * x for x in pooled)) or 1.0
+    return [x / norm for x in pooled]
+
+
+def embed_messages(embedder, texts: list) -> list:
+    """One write-back record per text; every segment of every text goes out in one embed call."""
+    plans, inputs = [], []
+    for text in texts:
+        bounds = segment_bounds(text)
+        if len(bounds) > MAX_SEGMENTS:
+            plans.append(None)
+            continue
+        plans.append((bounds, len(inputs)))
+        inputs.extend(text[s:e] for s, e in bounds)
+
+    vectors = embed_with_cache(embedder, inputs)
+
+    records = []
+    for plan in plans:
+        if plan is None:
+            records.append({"embedding": None, "status": "skipped", "segments": []})
+            continue
+        bounds, first = plan
+        seg_vectors = vectors[first:first + len(bounds)]
+        if len(bounds) == 1:
+            records.append({"embedding": to_pgvector(seg_vectors[0]), "status": "embedded", "segments": []})
+            continue
+        pooled = pool_vectors(seg_vectors, [e - s for s, e in bounds])
+        segments = [
+            {"index": i, "start": s, "end": e, "embedding": to_pgvector(v)}
+            for i, ((s, e), v) in enumerate(zip(bounds, seg_vectors))
+        ] if STORE_SEGMENTS else []
+        records.append({"embedding": to_pgvector(pooled), "status": "pooled", "segments": segments})
+    return records
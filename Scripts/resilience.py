@@ -0,0 +1,212 @@
+"""
+Tail-latency protection for calls to remote dependencies (Supabase, OpenAI).
+
+A Dependency wraps every call to one service with:
+- a circuit breaker: after BREAKER_FAILURES consecutive transient failures (timeouts,
+  connection errors, 429/5xx) calls fail fast with CircuitOpenError for BREAKER_RESET_S,
+  then one trial call decides whether it closes again. Callers catch the error and fall
+  back to a degraded mode (e.g. keyword-only retrieval) instead of waiting on a timeout;
+- bounded retries with exponential backoff + jitter, never past the call's deadline;
+- hedging for idempotent reads (hedge=True): if the first attempt is still running after
+  the operation's recent p95 latency, a duplicate is sent and whichever answers first wins.
+  Only the slowest ~5% of calls are duplicated, and never more than HEDGE_MAX_FRACTION of
+  all calls, so the median cost stays the same while one slow response no longer sets p95.
+
+Usage:
+    supabase_dep = Dependency("supabase")
+    hits = supabase_dep.call("search", db.rpc, "search_knowledge_chunks", payload, hedge=True)
+"""
+import os
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import openai
+
+from supabase_client import is_retryable as is_retryable_http
+
+RESILIENCE_MAX_RETRIES = int(os.getenv("RESILIENCE_MAX_RETRIES", "1"))
+BACKOFF_BASE_S = 0.2
+BACKOFF_MAX_S = 2.0
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_S = float(os.getenv("BREAKER_RESET_S", "30"))
+# hedge after the operation's p95; until enough samples exist, after HEDGE_DEFAULT_DELAY_S
+HEDGE_DEFAULT_DELAY_S = float(os.getenv("HEDGE_DEFAULT_DELAY_S", "1.0"))
+HEDGE_MIN_DELAY_S = 0.05
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_FRACTION = float(os.getenv("HEDGE_MAX_FRACTION", "0.1"))
+LATENCY_WINDOW = 200
+
+# attempts run here so the caller can wait on the first of two; sized for hedged pairs
+_pool = ThreadPoolExecutor(max_workers=int(os.getenv("HEDGE_WORKERS", "32")), thread_name_prefix="hedge")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_transient(exc: Exception) -> bool:
+    """Worth a retry and counts against the breaker: the service was slow or down, not the request wrong."""
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code >= 500
+    return is_retryable_http(exc)
+
+
+class CircuitBreaker:
+    """closed -> open after `failures` consecutive failures -> half_open after reset_s -> one trial."""
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset_s: float = BREAKER_RESET_S):
+        self.name = name
+        self.failures = failures
+        self.reset_s = reset_s
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_s:
+                self.state = "half_open"
+                self._trial = False
+            if self.state == "half_open" and not self._trial:
+                self._trial = True   # exactly one trial call; the rest keep failing fast
+                return True
+            return False
+
+    def record(self, ok: bool):
+        with self._lock:
+            if ok:
+                self.state, self.consecutive = "closed", 0
+                return
+            self.consecutive += 1
+            if self.state == "half_open" or self.consecutive >= self.failures:
+                if self.state != "open":
+                    self.opens += 1
+                self.state, self.opened_at = "open", time.monotonic()
+
+
+class LatencyTracker:
+    """Recent successful call latencies of one operation (seconds)."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def hedge_delay(self) -> float:
+        with self._lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return HEDGE_DEFAULT_DELAY_S
+            ordered = sorted(self.samples)
+        return max(HEDGE_MIN_DELAY_S, ordered[int(0.95 * (len(ordered) - 1))])
+
+
+class Dependency:
+    """One remote service: circuit breaker, bounded retries and optional hedging per call."""
+
+    def __init__(self, name: str, retries: int = RESILIENCE_MAX_RETRIES, failures: int = BREAKER_FAILURES,
+                 reset_s: float = BREAKER_RESET_S):
+        self.name = name
+        self.retries = retries
+        self.breaker = CircuitBreaker(name, failures, reset_s)
+        self.latency = {}
+        self.stats = {"calls": 0, "failed": 0, "fast_failed": 0, "retries": 0, "hedged": 0, "hedge_wins": 0}
+        self._lock = threading.Lock()
+
+    def call(self, op: str, fn, *args, hedge: bool = False, backup=None, retries: int = None,
+             deadline_s: float = None, **kwargs):
+        """
+        fn(*args, **kwargs) under the breaker. hedge=True only for idempotent reads.
+        backup: what the hedge calls instead of fn (same arguments), for an fn that queues
+        behind shared work (e.g. a micro-batcher) where a duplicate would wait behind the primary.
+        deadline_s bounds retries (a retry that could not finish in time is not started).
+        """
+        self._count("calls")
+        if not self.breaker.allow():
+            self._count("fast_failed")
+            raise CircuitOpenError(f"{self.name} circuit open (fast fail for {op})")
+        retries = self.retries if retries is None else retries
+        started = time.monotonic()
+        for attempt in range(retries + 1):
+            try:
+                result = self._hedged(op, fn, backup or fn, args, kwargs) if hedge else self._timed(op, fn, args, kwargs)
+                self.breaker.record(True)
+                return result
+            except Exception as e:
+                transient = is_transient(e)
+                if transient and attempt < retries:
+                    pause = min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt) * random.uniform(0.5, 1.0)
+                    if deadline_s is None or time.monotonic() - started + pause < deadline_s:
+                        self._count("retries")
+                        time.sleep(pause)
+                        continue
+                # a non-transient error (e.g. 400) means the service answered: not a breaker failure
+                self.breaker.record(not transient)
+                self._count("failed")
+                raise
+
+    def is_open(self) -> bool:
+        """True while calls would fail fast (lets a caller skip work that only feeds this call)."""
+        b = self.breaker
+        return b.state == "open" and time.monotonic() - b.opened_at < b.reset_s
+
+    def _timed(self, op: str, fn, args, kwargs):
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self._tracker(op).add(time.perf_counter() - t0)
+        return result
+
+    def _hedged(self, op: str, fn, backup_fn, args, kwargs):
+        primary = _pool.submit(self._timed, op, fn, args, kwargs)
+        if wait([primary], timeout=self._tracker(op).hedge_delay()).done:
+            return primary.result()
+        with self._lock:
+            if self.stats["hedged"] >= HEDGE_MAX_FRACTION * self.stats["calls"]:
+                budget_left = False
+            else:
+                budget_left = True
+                self.stats["hedged"] += 1
+        if not budget_left:
+            return primary.result()
+        backup = _pool.submit(self._timed, op, backup_fn, args, kwargs)
+        pending, error = {primary, backup}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    if f is backup:
+                        self._count("hedge_wins")
+                    return f.result()   # the loser finishes in the background and is dropped
+                error = f.exception()
+        raise error
+
+    def _tracker(self, op: str) -> LatencyTracker:
+        with self._lock:
+            if op not in self.latency:
+                self.latency[op] = LatencyTracker()
+            return self.latency[op]
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def status(self) -> dict:
+        return {"state": self.breaker.state, "opens": self.breaker.opens, **self.stats}
+
+    def stats_line(self) -> str:
+        s = self.status()
+        return (f"{self.name}: circuit {s['state']} (opened {s['opens']}x), {s['calls']} calls, "
+                f"{s['failed']} failed, {s['fast_failed']} fast-failed, {s['retries']} retries, "
+                f"{s['hedged']} hedged ({s['hedge_wins']} won by the hedge)")
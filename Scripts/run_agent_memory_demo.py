@@ -2,14 +2,25 @@ import os
 import re
 import json
 import time
+import argparse
+import hmac
+import functools
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dotenv import load_dotenv
 
 import httpx
 from openai import OpenAI
 
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from embedding_cache import embed_one, embed_with_cache
+from secret_patterns import contains_secret
+from streaming_chat import stream_chat
+from audit_log import AuditLog
+from supabase_client import SupabaseClient
+from resilience import Dependency, CircuitOpenError
+import connector_index
 
 load_dotenv()
 
@@ -22,16 +33,39 @@ if not all([SUPABASE_URL, SERVICE_KEY, USER_ID, OPENAI_API_KEY]):
     raise SystemExit("Missing env vars: SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, USER_ID, OPENAI_API_KEY")
 
 # --- Network safety: timeouts + corporate SSL workaround ---
+# Clients are created once per process and keep connections alive, so in the REPL / HTTP
+# service only the first question pays for TCP + TLS setup.
 HTTP_TIMEOUT = 60.0
-http_client = httpx.Client(verify=False, timeout=HTTP_TIMEOUT)
+MAX_CONNECTIONS = int(os.getenv("AGENT_MAX_CONNECTIONS", "32"))
+http_client = httpx.Client(verify=False, timeout=HTTP_TIMEOUT,
+                           limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                               max_keepalive_connections=MAX_CONNECTIONS))
 client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
 
-headers = {
-    "apikey": SERVICE_KEY,
-    "Authorization": f"Bearer {SERVICE_KEY}",
-    "Content-Type": "application/json",
-    "Prefer": "return=representation",
-}
+supabase = SupabaseClient(SUPABASE_URL, SERVICE_KEY, timeout=HTTP_TIMEOUT, max_connections=MAX_CONNECTIONS)
+
+# HTTP service (python run_agent_memory_demo.py --serve). Callers send "Authorization:
+# Bearer <key>"; each key belongs to one user, whose memory and audit rows the turn uses:
+#   AGENT_API_KEYS="<key>:<user uuid>,<key>:<user uuid>"   (one entry per user)
+#   AGENT_API_KEY="<key>"                                   (single user: USER_ID)
+# At least one key is required.
+AGENT_HOST = os.getenv("AGENT_HOST", "127.0.0.1")
+AGENT_PORT = int(os.getenv("AGENT_PORT", "8080"))
+AGENT_API_KEY = os.getenv("AGENT_API_KEY")
+
+def parse_api_keys(spec: str) -> dict:
+    """Parses "key:user,key:user" into {key: user_id}."""
+    keys = {}
+    for entry in filter(None, (e.strip() for e in (spec or "").split(","))):
+        key, sep, user = entry.rpartition(":")
+        if not sep or not key or not user:
+            raise SystemExit(f"AGENT_API_KEYS entries must look like <key>:<user uuid>, got {entry!r}")
+        keys[key] = user
+    return keys
+
+API_KEY_USERS = parse_api_keys(os.getenv("AGENT_API_KEYS"))
+if AGENT_API_KEY:
+    API_KEY_USERS.setdefault(AGENT_API_KEY, USER_ID)
 
 # Debug retrieval output (keep False in normal use)
 DEBUG_RAG = False
@@ -40,15 +74,42 @@ DEBUG_RAG = False
 GOVERNANCE_MIN_TOP_SCORE = 0.60  # strict for policy answers
 HOWTO_MIN_TOP_SCORE = 0.35       # not strict (how-to can work without docs)
 
-# --- Security patterns ---
-SECRET_PATTERNS = [
-    r"sk-[A-Za-z0-9]{10,}",
-    r"Authorization:\s*Bearer\s+\S+",
-    r"client_secret\s*[:=]\s*\S+",
-    r"password\s*[:=]\s*\S+",
-    r"api[_-]?key\s*[:=]\s*\S+",
-]
+# Vector index recall/latency knob (HNSW ef_search); pick it with 06_vector_index_benchmark.py
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH", "40"))
 
+# Retrieval backend: "supabase" (RPC over the network) or "local" (mmap snapshot, see local_index.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "supabase").lower()
+
+# Retrieval partitions searched per intent (doc_type set by 02_ingest_rag_data_to_supabase.py);
+# None = whole corpus. A filtered search that finds nothing is retried on the whole corpus.
+MODE_FILTERS = {
+    "GOVERNANCE_QNA": {"doc_types": ["connectors", "governance"]},
+    "HOWTO_QNA": None,
+    "FLOW_REVIEW": None,
+}
+TENANT_ID = os.getenv("TENANT_ID") or None
+
+# Retrieval fan-out: user memory, query embedding -> hybrid search, and a keyword-only
+# search run concurrently. Every call has its own timeout; at the deadline whatever came
+# back is used (keyword hits stand in when the embedding / hybrid search is late or failed).
+RETRIEVAL_TIMEOUT_S = float(os.getenv("RETRIEVAL_TIMEOUT_S", "5"))
+RETRIEVAL_DEADLINE_S = float(os.getenv("RETRIEVAL_DEADLINE_S", "10"))
+# three calls per question; sized for several concurrent users of the HTTP service
+retrieval_pool = ThreadPoolExecutor(max_workers=int(os.getenv("RETRIEVAL_WORKERS", "24")),
+                                    thread_name_prefix="retrieval")
+# one derived client (the embedding micro-batcher is per client object); retries are
+# done by openai_dep below, so the SDK does not retry on its own
+embed_client = client.with_options(timeout=RETRIEVAL_TIMEOUT_S, max_retries=0)
+
+# Per-dependency circuit breakers, bounded retries and hedged reads (see resilience.py).
+# The vector (hybrid) search has its own breaker: when it keeps timing out, questions go
+# straight to keyword-only retrieval without paying for the embedding or the timeout.
+supabase_dep = Dependency("supabase")
+vector_dep = Dependency("supabase-vector")
+openai_dep = Dependency("openai")
+DEPENDENCIES = [supabase_dep, vector_dep, openai_dep]
+
+# --- Security patterns ---
 INJECTION_PATTERNS = [
     r"ignore (all|these) instructions",
     r"reveal (the )?system prompt",
@@ -59,9 +120,6 @@ INJECTION_PATTERNS = [
     r"repeat the full document",
 ]
 
-def contains_secret(text: str) -> bool:
-    return any(re.search(p, text or "", re.IGNORECASE) for p in SECRET_PATTERNS)
-
 def looks_like_injection(text: str) -> bool:
     return any(re.search(p, text or "", re.IGNORECASE) for p in INJECTION_PATTERNS)
 
@@ -76,32 +134,37 @@ def looks_like_json(text: str) -> bool:
         return False
 
 # --- Supabase helpers ---
-def rpc(fn_name: str, payload: dict):
-    url = f"{SUPABASE_URL}/rest/v1/rpc/{fn_name}"
-    r = requests.post(url, headers=headers, json=payload, timeout=60, verify=False)
-    r.raise_for_status()
-    return r.json()
-
-def insert_row(table: str, row: dict) -> dict:
-    url = f"{SUPABASE_URL}/rest/v1/{table}"
-    r = requests.post(url, headers=headers, json=[row], timeout=60, verify=False)
-    r.raise_for_status()
-    return r.json()[0]
-
-# --- Load system prompt from docs ---
+def rpc(fn_name: str, payload: dict, timeout: float = 60, dependency: Dependency = None):
+    """Read-only RPCs: hedged, retried within the retrieval deadline, behind a circuit breaker."""
+    return (dependency or supabase_dep).call(fn_name, supabase.rpc, fn_name, payload, timeout=timeout,
+                                             hedge=True, deadline_s=RETRIEVAL_DEADLINE_S)
+
+def search_rpc(fn_name: str, payload: dict, timeout: float = 60, dependency: Dependency = None):
+    """Retrieval RPCs go to the local snapshot when RETRIEVAL_BACKEND=local."""
+    if RETRIEVAL_BACKEND == "local":
+        from local_index import get_local_index   # numpy only needed in local mode
+        return get_local_index().rpc(fn_name, payload)
+    return rpc(fn_name, payload, timeout=timeout, dependency=dependency)
+
+# Sessions and messages are written behind the request path (batched, journaled when
+# Supabase is unreachable; see audit_log.py): the answer never waits on logging.
+audit = AuditLog(supabase)
+
+# --- Load system prompt from docs (read once per process) ---
+@functools.lru_cache(maxsize=1)
 def load_system_prompt() -> str:
     path = os.path.join("docs", "04-agent-prompt.md")
     with open(path, "r", encoding="utf-8") as f:
         return f.read()
 
 # --- Memory retrieval (user history) ---
-def build_user_memory(query: str) -> str:
+def build_user_memory(query: str, user_id: str = USER_ID) -> str:
     try:
         memories = rpc("search_user_messages", {
             "search_query": query,
-            "user_uuid": USER_ID,
+            "user_uuid": user_id,
             "max_results": 6
-        })
+        }, timeout=RETRIEVAL_TIMEOUT_S)
     except Exception:
         return "(memory search failed)"
 
@@ -114,69 +177,153 @@ def build_user_memory(query: str) -> str:
         lines.append("- " + c)
     return "\n".join(lines)
 
+# --- Structured connector lookup (no embedding / LLM call) ---
+# reloaded when ingestion rewrites it or the workbook changes (long-running service)
+_connector_index = connector_index.IndexCache()
+
+def answer_from_connector_index(question: str):
+    """Simple connector questions answered from the Approved Connectors index built at ingestion."""
+    index = _connector_index.get()
+    return connector_index.answer_lookup(index, question) if index else None
+
 # --- Doc RAG (hybrid) ---
+def embed_direct(client, text: str):
+    """Own API request, outside the shared micro-batcher (the hedge must not queue behind the primary)."""
+    return embed_with_cache(client, [text])[0]
+
 def embed_query(text: str):
-    emb = client.embeddings.create(model="text-embedding-3-small", input=[text])
-    return emb.data[0].embedding
+    return openai_dep.call("embed", embed_one, embed_client, text, hedge=True, backup=embed_direct,
+                           deadline_s=RETRIEVAL_DEADLINE_S)
 
 def extract_keywords(query: str):
     words = re.findall(r"[A-Za-z0-9]+", query)
     candidates = [w for w in words if len(w) >= 4]
     return candidates[:6]
 
-def search_docs_hybrid(query: str):
-    debug_lines = []
-    merged = []
-    seen = set()
-    top_score = None
-
-    # Vector search
+def timed(timings: dict, stage: str, fn, *args):
+    """Runs fn(*args) and records its wall time in timings[stage] (ms), even if it fails."""
+    t0 = time.perf_counter()
     try:
-        q_emb = embed_query(query)
-        vect = rpc("search_knowledge_chunks", {
-            "query_embedding": q_emb,
-            "match_count": 12
-        })
-        if vect:
-            top_score = float(vect[0].get("score") or 0)
-
-        for c in (vect or []):
-            txt = (c.get("content") or "").strip()
-            if not txt:
-                continue
-            key = txt[:200]
-            if key not in seen:
-                seen.add(key)
-                merged.append(txt)
-                debug_lines.append(f"[VECTOR score={c.get('score')}] {txt[:220].replace(chr(10),' ')}")
-    except Exception as e:
-        debug_lines.append(f"(vector search failed: {e})")
+        return fn(*args)
+    finally:
+        timings[stage] = round((time.perf_counter() - t0) * 1000, 1)
 
-    # Keyword search (optional RPC)
-    for kw in extract_keywords(query):
-        try:
-            hits = rpc("search_knowledge_chunks_keyword", {
-                "keyword": kw,
-                "match_count": 6
-            })
-            for h in hits:
-                txt = (h.get("content") or "").strip()
-                if not txt:
-                    continue
-                key = txt[:200]
-                if key not in seen:
-                    seen.add(key)
-                    merged.append(txt)
-                    debug_lines.append(f"[KEYWORD kw={kw}] {txt[:220].replace(chr(10),' ')}")
-        except Exception:
-            pass
+def search_docs_hybrid(query: str, mode: str = None, timings: dict = None):
+    """
+    One RPC: vector + keyword retrieval fused server-side (reciprocal rank fusion),
+    unique by chunk id. See search_knowledge_chunks_hybrid in
+    "Supabase DB/Keyword Search for Knowledge Chunks.sql".
+    The mode's partition filters (MODE_FILTERS) narrow the search.
+    Returns (hits, debug_lines); errors propagate to the caller.
+    """
+    if RETRIEVAL_BACKEND != "local" and vector_dep.is_open():
+        raise CircuitOpenError("vector search circuit open: keyword-only retrieval")
+    timings = {} if timings is None else timings
+    debug_lines = []
+    payload = {
+        "query_embedding": timed(timings, "embed_ms", embed_query, query),
+        "keywords": extract_keywords(query),
+        "match_count": 10,
+        "vector_count": 12,
+        "keyword_count": 12,
+        "ef_search": VECTOR_EF_SEARCH,
+        "tenant_id": TENANT_ID,
+    }
+    filters = MODE_FILTERS.get(mode)
+    hits = timed(timings, "hybrid_ms", search_rpc, "search_knowledge_chunks_hybrid",
+                 {**payload, **(filters or {})}, RETRIEVAL_TIMEOUT_S, vector_dep)
+    if filters and not hits:
+        debug_lines.append(f"(no hits in {filters}; searching the whole corpus)")
+        hits = timed(timings, "hybrid_unfiltered_ms", search_rpc, "search_knowledge_chunks_hybrid",
+                     payload, RETRIEVAL_TIMEOUT_S, vector_dep)
+    return hits, debug_lines
+
+def search_docs_keyword(query: str, mode: str = None):
+    """Keyword-only retrieval (no embedding needed): the fallback when hybrid search is late."""
+    keywords = extract_keywords(query)
+    if not keywords:
+        return []
+    return search_rpc("search_knowledge_chunks_keyword", {
+        "keywords": keywords,
+        "match_count": 10,
+        "tenant_id": TENANT_ID,
+        **(MODE_FILTERS.get(mode) or {}),
+    }, RETRIEVAL_TIMEOUT_S)
+
+def format_doc_context(hits: list, debug_lines: list, label: str = "HYBRID"):
+    """Returns (context_text, top_score) and appends one debug line per hit."""
+    merged = []
+    # confidence gating uses the best vector similarity, as before
+    scores = [float(h["score"]) for h in hits if h.get("score") is not None]
+    top_score = max(scores) if scores else None
+
+    for h in hits:
+        txt = (h.get("content") or "").strip()
+        if not txt:
+            continue
+        merged.append(txt)
+        if label == "HYBRID":
+            debug_lines.append(
+                f"[HYBRID rrf={h.get('rrf_score'):.4f} score={h.get('score')} "
+                f"vec_rank={h.get('vector_rank')} kw_rank={h.get('keyword_rank')}] "
+                f"{txt[:220].replace(chr(10),' ')}"
+            )
+        else:
+            debug_lines.append(f"[{label} rank={h.get('rank')}] {txt[:220].replace(chr(10),' ')}")
 
     if not merged:
-        return "(no relevant docs found)", debug_lines, top_score
+        return "(no relevant docs found)", top_score
 
-    merged = merged[:10]
     context_text = "\n".join([f"- {m[:650].replace(chr(10),' ')}" for m in merged])
-    return context_text, debug_lines, top_score
+    return context_text, top_score
+
+def retrieve_context(user_input: str, mode: str, user_id: str = USER_ID) -> dict:
+    """
+    Fan-out of the retrieval stage: pre-LLM latency is the slowest branch, not the sum.
+    Returns {user_memory, doc_context, rag_debug, top_score, timings_ms, degraded}.
+    """
+    t0 = time.perf_counter()
+    timings, degraded = {}, []
+    memory_f = retrieval_pool.submit(timed, timings, "memory_ms", build_user_memory, user_input, user_id)
+    hybrid_f = retrieval_pool.submit(search_docs_hybrid, user_input, mode, timings)
+
+    def outcome(name, fut, default):
+        if not fut.done():
+            degraded.append(f"{name}: timed out")
+            return default
+        try:
+            return fut.result()
+        except Exception as e:
+            degraded.append(f"{name}: {e}")
+            return default
+
+    wait([hybrid_f], timeout=RETRIEVAL_DEADLINE_S)
+    hits, debug_lines = outcome("hybrid", hybrid_f, (None, []))
+    keyword_f = None
+    if hits is None:
+        # the keyword RPC is only a fallback: started once hybrid failed or ran out of time,
+        # with its own call timeout on top of the deadline
+        keyword_f = retrieval_pool.submit(timed, timings, "keyword_ms", search_docs_keyword, user_input, mode)
+    wait([memory_f], timeout=max(0.0, RETRIEVAL_DEADLINE_S - (time.perf_counter() - t0)))
+    user_memory = outcome("memory", memory_f, "(memory search timed out)")
+    if keyword_f is not None:
+        wait([keyword_f], timeout=RETRIEVAL_TIMEOUT_S)
+        keyword_hits = outcome("keyword", keyword_f, [])
+        debug_lines.append(f"(hybrid search unavailable; {len(keyword_hits)} keyword-only hits)")
+        doc_context, top_score = format_doc_context(keyword_hits, debug_lines, label="KEYWORD")
+    else:
+        doc_context, top_score = format_doc_context(hits, debug_lines)
+    debug_lines.extend(f"(degraded: {d})" for d in degraded)
+
+    timings["retrieval_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return {
+        "user_memory": user_memory,
+        "doc_context": doc_context,
+        "rag_debug": debug_lines,
+        "top_score": top_score,
+        "timings_ms": dict(timings),
+        "degraded": degraded,
+    }
 
 # --- Intent detection (wider scope, not strict keywords) ---
 def detect_intent(user_input: str) -> str:
@@ -246,71 +393,99 @@ Confidence 0-100
 Do NOT use academic A/B/C sections. Keep it actionable.
 """
 
-# --- Main ---
-def main():
-    print("=== Power Automate Helper Agent (OpenAI + Supabase + Hybrid RAG) ===")
-    user_input = input("Paste flow JSON or ask a question: ").strip()
+# --- One conversation turn ---
+def _quiet(*args, **kwargs):
+    pass
 
-    # Create a session
-    session = insert_row("sessions", {"user_id": USER_ID, "metadata": {"channel": "cli"}})
-    session_id = session["id"]
+def create_session(user_id: str = USER_ID, channel: str = "cli") -> str:
+    return audit.log("sessions", {"user_id": user_id, "metadata": {"channel": channel}})
 
-    # Security checks
-    if contains_secret(user_input):
-        print("\n⚠️ Input looks like it contains a secret (token/password/key). Please redact it and try again.\n")
-        insert_row("messages", {
-            "user_id": USER_ID,
+def handle_turn(user_input: str, session_id: str, user_id: str = USER_ID, progress=print,
+                on_token=None, cancel=None) -> dict:
+    """
+    Answers one message in an existing session and logs it.
+    Returns {"answer", "mode", "event_type", "timings_ms", "streamed"}; progress(...) gets
+    status lines. The LLM answer is streamed: on_token(text) gets every delta as it arrives
+    and "streamed" is True when it did; setting the cancel event stops generation.
+    """
+    turn_started = time.perf_counter()
+
+    def log_message(role: str, content: str, metadata: dict):
+        audit.log("messages", {
+            "user_id": user_id,
             "session_id": session_id,
-            "role": "user",
-            "content": "[REDACTED: secret detected]",
-            "metadata": {"event_type": "secret_detected", "secret_detected": True}
+            "role": role,
+            "content": content,
+            "metadata": metadata
         })
-        return
+
+    def result(answer: str, mode: str = None, event_type: str = None, timings: dict = None,
+               streamed: bool = False) -> dict:
+        timings = dict(timings or {})
+        timings["turn_ms"] = round((time.perf_counter() - turn_started) * 1000, 1)
+        return {"answer": answer, "mode": mode, "event_type": event_type, "timings_ms": timings,
+                "streamed": streamed}
+
+    # Security checks
+    if contains_secret(user_input):
+        log_message("user", "[REDACTED: secret detected]",
+                    {"event_type": "secret_detected", "secret_detected": True})
+        return result("⚠️ Input looks like it contains a secret (token/password/key). "
+                      "Please redact it and try again.", event_type="secret_detected")
 
     if looks_like_injection(user_input):
-        print("\n⚠️ That request looks like a prompt-injection / data-exfiltration attempt. I can’t help with that.\n")
-        insert_row("messages", {
-            "user_id": USER_ID,
-            "session_id": session_id,
-            "role": "user",
-            "content": user_input,
-            "metadata": {"event_type": "prompt_injection_attempt"}
-        })
-        return
+        log_message("user", user_input, {"event_type": "prompt_injection_attempt"})
+        return result("⚠️ That request looks like a prompt-injection / data-exfiltration attempt. "
+                      "I can’t help with that.", event_type="prompt_injection_attempt")
 
     mode = detect_intent(user_input)
 
+    # Fast path: "Is X allowed?", "Is ARB required for X?", "Who publishes X?" come straight
+    # from the connector index, cited by row. Anything it cannot answer goes the normal way.
+    # OUT_OF_SCOPE stays out of scope even if a connector name appears in the question.
+    lookup = None
+    if mode in ("GOVERNANCE_QNA", "HOWTO_QNA"):
+        t0 = time.perf_counter()
+        lookup = answer_from_connector_index(user_input)
+        lookup_ms = round((time.perf_counter() - t0) * 1000, 2)
+        if lookup:
+            mode = "GOVERNANCE_QNA"
+
     if mode == "OUT_OF_SCOPE":
-        print("\nI can help with Power Automate flow building/review and tenant governance (connectors/DLP/environments). Please rephrase your question in that area.\n")
-        insert_row("messages", {
-            "user_id": USER_ID,
-            "session_id": session_id,
-            "role": "user",
-            "content": user_input,
-            "metadata": {"event_type": "out_of_scope"}
-        })
-        return
+        log_message("user", user_input, {"event_type": "out_of_scope"})
+        return result("I can help with Power Automate flow building/review and tenant governance "
+                      "(connectors/DLP/environments). Please rephrase your question in that area.",
+                      event_type="out_of_scope")
 
     # Log user message
-    insert_row("messages", {
-        "user_id": USER_ID,
-        "session_id": session_id,
-        "role": "user",
-        "content": user_input,
-        "metadata": {"type": "agent_input", "mode": mode}
-    })
+    log_message("user", user_input, {"type": "agent_input", "mode": mode})
 
-    print("...retrieving memory")
-    user_memory = build_user_memory(user_input)
+    if lookup:
+        log_message("assistant", lookup["answer"], {
+            "type": "agent_output",
+            "mode": mode,
+            "answer_source": "connector_index",
+            "citation": lookup["citation"],
+            "connector": lookup["connector"],
+            "attribute": lookup["attribute"],
+            "match_score": lookup["match_score"],
+            "used_user_memory": False,
+            "used_doc_rag": False,
+            "latency_ms": lookup_ms
+        })
+        return result(lookup["answer"], mode, timings={"lookup_ms": lookup_ms})
 
-    print("...retrieving documents (RAG)")
-    doc_context, rag_debug, top_score = search_docs_hybrid(user_input)
+    progress("...retrieving memory + documents (RAG)")
+    retrieval = retrieve_context(user_input, mode, user_id)
+    user_memory = retrieval["user_memory"]
+    doc_context, rag_debug, top_score = retrieval["doc_context"], retrieval["rag_debug"], retrieval["top_score"]
+    timings = retrieval["timings_ms"]
 
     if DEBUG_RAG:
-        print("\n--- RAG DEBUG (first 20) ---")
+        progress("\n--- RAG DEBUG (first 20) ---")
         for line in rag_debug[:20]:
-            print(line)
-        print("--- END RAG DEBUG ---\n")
+            progress(line)
+        progress("--- END RAG DEBUG ---\n")
 
     # Confidence handling (IMPORTANT FIX)
     # - For FLOW_REVIEW: do NOT block if docs are weak (flow JSON is the main source)
@@ -321,7 +496,7 @@ def main():
         if top_score is None or top_score < GOVERNANCE_MIN_TOP_SCORE:
             event_type = "low_confidence_abstain"
 
-    print("...building prompt")
+    progress("...building prompt")
 
     system_prompt = load_system_prompt()
     style = FLOW_REVIEW_STYLE if mode == "FLOW_REVIEW" else (QNA_GOV_STYLE if mode == "GOVERNANCE_QNA" else QNA_HOWTO_STYLE)
@@ -351,49 +526,250 @@ User input:
 """}
     ]
 
-    print("...calling OpenAI (this may take a few seconds)")
+    progress("...calling OpenAI (streaming)")
     try:
-        t0 = time.time()
-        resp = client.chat.completions.create(
-            model="gpt-5-nano",
-            messages=messages
-        )
-        latency = round(time.time() - t0, 2)
+        # no retry / hedge: tokens may already be on their way to the user; an open
+        # circuit fails fast instead of making the user wait for the timeout
+        gen = openai_dep.call("chat", stream_chat, client, "gpt-5-nano", messages,
+                              on_token=on_token, cancel=cancel, retries=0)
     except Exception as e:
-        print("\n❌ OpenAI request failed:", str(e))
-        insert_row("messages", {
-            "user_id": USER_ID,
-            "session_id": session_id,
-            "role": "assistant",
-            "content": f"[ERROR] OpenAI request failed: {e}",
-            "metadata": {"event_type": "openai_error", "mode": mode}
-        })
-        return
-
-    answer = resp.choices[0].message.content
-
-    print("\n--- ANSWER ---\n")
-    print(answer)
+        log_message("assistant", f"[ERROR] OpenAI request failed: {e}",
+                    {"event_type": "openai_error", "mode": mode, "timings_ms": timings})
+        return result(f"❌ OpenAI request failed: {e}", mode, "openai_error", timings)
+
+    answer = gen["text"]
+    latency = round(gen["total_ms"] / 1000, 2)
+    timings["llm_ttft_ms"] = gen["ttft_ms"]
+    timings["llm_ms"] = gen["total_ms"]
+    if gen["cancelled"]:
+        # user aborted: keep what was generated for the audit trail
+        event_type = "generation_cancelled"
+        answer = answer + "\n[cancelled by user]"
 
     # Log assistant answer + audit metadata
-    insert_row("messages", {
-        "user_id": USER_ID,
-        "session_id": session_id,
-        "role": "assistant",
-        "content": answer,
-        "metadata": {
-            "type": "agent_output",
-            "mode": mode,
-            "model": "gpt-5-nano",
-            "used_user_memory": True,
-            "used_doc_rag": True,
-            "rag_mode": "hybrid",
-            "debug_rag": DEBUG_RAG,
-            "top_score": top_score,
-            "event_type": event_type,
-            "latency_s": latency
-        }
+    log_message("assistant", answer, {
+        "type": "agent_output",
+        "mode": mode,
+        "model": "gpt-5-nano",
+        "used_user_memory": True,
+        "used_doc_rag": True,
+        "rag_mode": "hybrid",
+        "debug_rag": DEBUG_RAG,
+        "top_score": top_score,
+        "event_type": event_type,
+        "latency_s": latency,
+        "ttft_s": None if gen["ttft_ms"] is None else round(gen["ttft_ms"] / 1000, 2),
+        "streamed": True,
+        "timings_ms": timings,
+        "retrieval_degraded": retrieval["degraded"]
     })
+    return result(answer, mode, event_type, timings, streamed=True)
+
+# --- Long-running runtime: warm-up, REPL, HTTP service ---
+def warm_up():
+    """Pays the one-time costs up front: prompt + connector index from disk, TLS to both APIs."""
+    t0 = time.perf_counter()
+    load_system_prompt()
+    answer_from_connector_index("")
+    try:
+        supabase.ping(timeout=10)
+    except requests.RequestException as e:
+        print(f"⚠️ Supabase warm-up failed: {e}")
+    try:
+        client.models.retrieve("gpt-5-nano")
+    except Exception as e:
+        print(f"⚠️ OpenAI warm-up failed: {e}")
+    print(f"Warm-up done in {time.perf_counter() - t0:.2f}s")
+
+def repl():
+    print("=== Power Automate Helper Agent (OpenAI + Supabase + Hybrid RAG) ===")
+    warm_up()
+    session_id = None
+    while True:
+        try:
+            user_input = input("\nPaste flow JSON or ask a question (empty line or 'exit' to quit): ").strip()
+        except EOFError:
+            break
+        if not user_input or user_input.lower() in ("exit", "quit"):
+            break
+        if session_id is None:
+            session_id = create_session()   # one session for the whole conversation
+        print("(Ctrl+C stops the answer)")
+        started = [False]
+
+        def show(token):
+            if not started[0]:
+                print("\n--- ANSWER ---\n")
+                started[0] = True
+            print(token, end="", flush=True)
+
+        try:
+            out = handle_turn(user_input, session_id, on_token=show)
+        except KeyboardInterrupt:
+            print("\n[cancelled]")
+            continue
+        if not out["streamed"]:
+            print("\n--- ANSWER ---\n")
+            print(out["answer"])
+        elif out["event_type"] == "generation_cancelled":
+            print("\n[cancelled]")
+        t = out["timings_ms"]
+        print(f"\n\n(first token {t.get('llm_ttft_ms')} ms, total {t.get('turn_ms')} ms)"
+              if out["streamed"] else f"\n({t.get('turn_ms')} ms)")
+    audit.close()
+    print(audit.stats_line())
+    print(supabase.stats_line())
+    for dep in DEPENDENCIES:
+        print(dep.stats_line())
+
+def user_for_request(authorization: str):
+    """The user id of the caller's API key, or None (compared in constant time)."""
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+    token = authorization[len("Bearer "):].encode("utf-8")
+    user_id = None
+    for key, user in API_KEY_USERS.items():
+        if hmac.compare_digest(token, key.encode("utf-8")):
+            user_id = user
+    return user_id
+
+# sessions started over HTTP -> owning user; a caller may only continue its own sessions
+_session_users = {}
+_session_users_lock = threading.Lock()
+
+class AgentHandler(BaseHTTPRequestHandler):
+    """
+    POST /chat {"message": "...", "session_id"?: "...", "stream"?: true}
+      -> {"session_id", "answer", "mode", "event_type", "timings_ms", "streamed"}
+    The user is the one the API key belongs to (AGENT_API_KEYS); a body "user_id" for anyone
+    else is refused, and so is a session_id this service did not start for that user.
+    With "stream": true the response is NDJSON (chunked): {"token": "..."} lines as the
+    answer is generated, then the result object above with "done": true (or
+    {"error": "...", "done": true} if the turn failed). Closing the connection cancels
+    generation. A failed non-streamed turn answers 500.
+    GET /health -> {"status": "ok" | "degraded", "dependencies": {name: circuit state + counters}}
+    Reuse the returned session_id for the next turn of the same conversation.
+    """
+    protocol_version = "HTTP/1.1"   # keep-alive for clients as well
+
+    def _send(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            deps = {d.name: d.status() for d in DEPENDENCIES}
+            status = "ok" if all(d["state"] == "closed" for d in deps.values()) else "degraded"
+            return self._send(200, {"status": status, "dependencies": deps})
+        self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/chat":
+            return self._send(404, {"error": "not found"})
+        user_id = user_for_request(self.headers.get("Authorization"))
+        if user_id is None:
+            return self._send(401, {"error": "unauthorized"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            message = (body.get("message") or "").strip()
+        except (ValueError, AttributeError):
+            return self._send(400, {"error": "body must be JSON with a 'message' field"})
+        if not message:
+            return self._send(400, {"error": "'message' is required"})
+
+        if body.get("user_id") not in (None, user_id):
+            return self._send(403, {"error": "user_id does not match the API key"})
+        session_id = body.get("session_id")
+        if session_id:
+            with _session_users_lock:
+                owner = _session_users.get(session_id)
+            if owner != user_id:
+                return self._send(404, {"error": "unknown session_id; omit it to start a new session"})
+        else:
+            session_id = create_session(user_id, channel="http")
+            with _session_users_lock:
+                _session_users[session_id] = user_id
+        if body.get("stream"):
+            return self._stream_turn(message, session_id, user_id)
+        try:
+            out = handle_turn(message, session_id, user_id, progress=_quiet)
+        except Exception as e:
+            print(f"❌ Turn failed: {type(e).__name__}: {e}")
+            return self._send(500, {"session_id": session_id, "error": "internal error"})
+        self._send(200, {"session_id": session_id, **out})
+
+    def _chunk(self, obj: dict):
+        data = (json.dumps(obj) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream_turn(self, message: str, session_id: str, user_id: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        cancel = threading.Event()
+
+        def send_token(token):
+            if cancel.is_set():
+                return
+            try:
+                self._chunk({"token": token})
+            except OSError:      # client disconnected: stop generating
+                cancel.set()
+
+        try:
+            out = handle_turn(message, session_id, user_id, progress=_quiet, on_token=send_token, cancel=cancel)
+            result = {"session_id": session_id, "done": True, **out}
+        except Exception as e:
+            print(f"❌ Turn failed: {type(e).__name__}: {e}")
+            result = {"session_id": session_id, "done": True, "error": "internal error"}
+        if cancel.is_set():
+            self.close_connection = True
+            return
+        try:
+            self._chunk(result)
+            self.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            self.close_connection = True
+
+def serve(host: str = AGENT_HOST, port: int = AGENT_PORT):
+    if not API_KEY_USERS:
+        raise SystemExit("Missing env var: AGENT_API_KEYS or AGENT_API_KEY (required for --serve)")
+    warm_up()
+    server = ThreadingHTTPServer((host, port), AgentHandler)
+    server.daemon_threads = True
+    print(f"✅ Agent listening on http://{host}:{port} (POST /chat, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        audit.close()
+        print(audit.stats_line())
+        print(supabase.stats_line())
+        for line in supabase.report():
+            print(f"  {line}")
+        for dep in DEPENDENCIES:
+            print(dep.stats_line())
+
+# --- Main ---
+def main():
+    parser = argparse.ArgumentParser(description="Power Automate Helper Agent")
+    parser.add_argument("--serve", action="store_true", help="run the HTTP service instead of the REPL")
+    parser.add_argument("--host", default=AGENT_HOST)
+    parser.add_argument("--port", type=int, default=AGENT_PORT)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.host, args.port)
+    else:
+        repl()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,25 @@
+"""
+Patterns for credentials that must never be embedded or sent to the model.
+
+Shared by the agent (refuses such input), the backfill scripts and the embedding queue
+worker (leave such messages unembedded), so all of them agree on what counts as a secret.
+
+Usage:
+    from secret_patterns import contains_secret
+    if contains_secret(text): ...
+"""
+import re
+
+SECRET_PATTERNS = [
+    r"sk-[A-Za-z0-9]{10,}",
+    r"Authorization:\s*Bearer\s+\S+",
+    r"client_secret\s*[:=]\s*\S+",
+    r"password\s*[:=]\s*\S+",
+    r"api[_-]?key\s*[:=]\s*\S+",
+]
+
+_SECRET_RE = re.compile("|".join(f"(?:{p})" for p in SECRET_PATTERNS), re.IGNORECASE)
+
+
+def contains_secret(text: str) -> bool:
+    return _SECRET_RE.search(text or "") is not None
@@ -0,0 +1,48 @@
+"""
+Streamed chat completions with time-to-first-token instrumentation.
+
+stream_chat() consumes a streamed chat.completions response, hands every text delta to
+on_token as it arrives and returns timings that separate time-to-first-token (what the
+user perceives) from total generation time:
+    {"text": str, "ttft_ms": float | None, "total_ms": float, "cancelled": bool}
+
+Cancellation: set the `cancel` event (e.g. the HTTP client went away) or press Ctrl+C in
+the CLI; the HTTP stream to OpenAI is closed at once, so generation stops there too, and
+the partial text is returned with cancelled=True.
+"""
+import time
+
+
+def stream_chat(client, model: str, messages: list, on_token=None, cancel=None) -> dict:
+    t0 = time.perf_counter()
+    ttft_ms = None
+    parts = []
+    cancelled = False
+
+    stream = client.chat.completions.create(model=model, messages=messages, stream=True)
+    try:
+        for chunk in stream:
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if ttft_ms is None:
+                ttft_ms = round((time.perf_counter() - t0) * 1000, 1)
+            parts.append(delta)
+            if on_token is not None:
+                on_token(delta)
+    except KeyboardInterrupt:
+        cancelled = True
+    finally:
+        stream.close()   # drops the connection: no further tokens are generated for us
+
+    return {
+        "text": "".join(parts),
+        "ttft_ms": ttft_ms,
+        "total_ms": round((time.perf_counter() - t0) * 1000, 1),
+        "cancelled": cancelled,
+    }
@@ -0,0 +1,264 @@
+"""
+Shared, connection-pooled Supabase (PostgREST) client used by all scripts.
+
+One requests.Session per process with a keep-alive connection pool, so a run of
+hundreds of calls pays for TCP + TLS once per pooled connection instead of once per call.
+Every call has a timeout, transient failures (connection errors, timeouts, 408/425/429/5xx)
+are retried with exponential backoff where that is safe, and each endpoint gets a latency
+histogram for the end-of-run report.
+
+Usage:
+    from supabase_client import get_client
+    db = get_client()                          # SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY
+    rows = db.select("knowledge_documents", {"select": "id,source"})
+    db.bulk_insert("knowledge_chunks", rows)   # client ids + ignore-duplicates: safe to retry
+    hits = db.rpc("search_knowledge_chunks", {...}, timeout=10)
+    print(db.stats_line())
+
+Errors are raised as requests exceptions (HTTPError carries .response), so existing
+`except requests.RequestException` handling keeps working.
+
+Retries: select / delete / upsert / bulk_insert (idempotent) retry by default; insert,
+update and rpc only when the caller passes retries=, since a replay could apply twice.
+"""
+import os
+import time
+import uuid
+import bisect
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import urllib3
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+SUPABASE_HTTP_TIMEOUT_S = float(os.getenv("SUPABASE_HTTP_TIMEOUT_S", "60"))
+SUPABASE_MAX_RETRIES = int(os.getenv("SUPABASE_MAX_RETRIES", "3"))
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "32"))
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+BACKOFF_BASE_S = 0.5
+BACKOFF_MAX_S = 10.0
+
+# histogram bucket upper bounds in ms (last bucket is open-ended)
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+def is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code in RETRYABLE_STATUS
+    return False
+
+
+def _retry_after(exc: Exception) -> float:
+    response = getattr(exc, "response", None)
+    if response is None:
+        return 0.0
+    try:
+        return float(response.headers.get("Retry-After") or 0)
+    except ValueError:
+        return 0.0
+
+
+class LatencyHistogram:
+    """Bucketed call latencies for one endpoint; percentiles are bucket upper bounds."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms: float, error: bool = False):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.calls += 1
+        self.errors += int(error)
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p: float) -> float:
+        if not self.calls:
+            return 0.0
+        rank = p * self.calls
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def summary(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_ms": round(self.total_ms / self.calls, 1) if self.calls else 0.0,
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "max_ms": round(self.max_ms, 1),
+        }
+
+
+class SupabaseClient:
+    """PostgREST table + RPC access over one pooled session. Safe to share between threads."""
+
+    def __init__(self, url: str, service_key: str, timeout: float = SUPABASE_HTTP_TIMEOUT_S,
+                 max_retries: int = SUPABASE_MAX_RETRIES, max_connections: int = SUPABASE_MAX_CONNECTIONS):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers.update({
+            "apikey": service_key,
+            "Authorization": f"Bearer {service_key}",
+            "Content-Type": "application/json",
+        })
+        self.session.verify = False   # corporate SSL workaround
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.histograms = {}
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    # --- transport ---
+    def request(self, method: str, path: str, *, params=None, json=None, headers: dict = None,
+                timeout: float = None, retries: int = 0) -> requests.Response:
+        """One PostgREST call; raises requests.HTTPError on a non-2xx answer."""
+        label = f"{method} {path.split('?', 1)[0]}"
+        for attempt in range(retries + 1):
+            t0 = time.perf_counter()
+            try:
+                r = self.session.request(method, f"{self.url}/rest/v1/{path}", params=params, json=json,
+                                         headers=headers, timeout=timeout or self.timeout)
+                r.raise_for_status()
+                self._record(label, t0)
+                return r
+            except requests.RequestException as e:
+                self._record(label, t0, error=True)
+                if attempt < retries and is_retryable(e):
+                    with self._lock:
+                        self.retries += 1
+                    time.sleep(max(_retry_after(e), min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt)))
+                    continue
+                raise
+
+    def _record(self, label: str, t0: float, error: bool = False):
+        ms = (time.perf_counter() - t0) * 1000
+        with self._lock:
+            hist = self.histograms.get(label)
+            if hist is None:
+                hist = self.histograms[label] = LatencyHistogram()
+            hist.add(ms, error)
+
+    def _retries(self, retries):
+        return self.max_retries if retries is None else retries
+
+    # --- typed helpers ---
+    def select(self, table: str, params: dict = None, *, timeout: float = None,
+               retries: int = None) -> list:
+        """GET rows; params are PostgREST query params (select, filters, order, limit, ...)."""
+        return self.request("GET", table, params=params, timeout=timeout,
+                            retries=self._retries(retries)).json()
+
+    def select_pages(self, table: str, params: dict, page_size: int = 1000, key: str = "id"):
+        """Yields every matching row, paging by `key` ascending (keyset, no OFFSET scans)."""
+        last = None
+        while True:
+            page_params = {**params, "order": f"{key}.asc", "limit": page_size}
+            if last is not None:
+                page_params[key] = f"gt.{last}"
+            page = self.select(table, page_params)
+            yield from page
+            if len(page) < page_size:
+                return
+            last = page[-1][key]
+
+    def insert(self, table: str, rows: list, *, returning: bool = True, timeout: float = None,
+               retries: int = 0) -> list:
+        """Plain insert; returns the stored rows when returning=True."""
+        prefer = "return=representation" if returning else "return=minimal"
+        r = self.request("POST", table, json=rows, headers={"Prefer": prefer},
+                         timeout=timeout, retries=retries)
+        return r.json() if returning else []
+
+    def bulk_insert(self, table: str, rows: list, *, timeout: float = None, retries: int = None) -> list:
+        """
+        One POST for all rows. Rows without an id get a client-side one and duplicates are
+        ignored, so a retried request whose response was lost never inserts twice.
+        Returns the rows as sent (with their ids).
+        """
+        rows = [row if "id" in row else {"id": str(uuid.uuid4()), **row} for row in rows]
+        self.request("POST", table, params={"on_conflict": "id"}, json=rows,
+                     headers={"Prefer": "return=minimal,resolution=ignore-duplicates"},
+                     timeout=timeout, retries=self._retries(retries))
+        return rows
+
+    def upsert(self, table: str, rows: list, on_conflict: str = "id", *, timeout: float = None,
+               retries: int = None):
+        self.request("POST", table, params={"on_conflict": on_conflict}, json=rows,
+                     headers={"Prefer": "return=minimal,resolution=merge-duplicates"},
+                     timeout=timeout, retries=self._retries(retries))
+
+    def update(self, table: str, where: dict, values: dict, *, timeout: float = None,
+               retries: int = 0):
+        """where: PostgREST filters, e.g. {"id": "eq.<uuid>"}."""
+        self.request("PATCH", table, params=where, json=values, headers={"Prefer": "return=minimal"},
+                     timeout=timeout, retries=retries)
+
+    def delete(self, table: str, where: dict, *, timeout: float = None, retries: int = None):
+        """where: PostgREST filters, e.g. {"document_id": "eq.<uuid>"}."""
+        self.request("DELETE", table, params=where, headers={"Prefer": "return=minimal"},
+                     timeout=timeout, retries=self._retries(retries))
+
+    def rpc(self, fn_name: str, payload: dict = None, *, timeout: float = None, retries: int = 0):
+        r = self.request("POST", f"rpc/{fn_name}", json=payload or {}, timeout=timeout, retries=retries)
+        return r.json() if r.content else None
+
+    def ping(self, timeout: float = 10):
+        """Opens a pooled connection (TLS handshake) ahead of the first real call."""
+        self.request("GET", "", timeout=timeout)
+
+    # --- stats ---
+    def stats(self) -> dict:
+        with self._lock:
+            return {label: h.summary() for label, h in sorted(self.histograms.items())}
+
+    def stats_line(self) -> str:
+        stats = self.stats()
+        calls = sum(s["calls"] for s in stats.values())
+        errors = sum(s["errors"] for s in stats.values())
+        return f"Supabase client: {calls} calls, {errors} errors, {self.retries} retries, {len(stats)} endpoints"
+
+    def report(self) -> list:
+        """One latency line per endpoint, slowest total first."""
+        lines = []
+        with self._lock:
+            items = sorted(self.histograms.items(), key=lambda kv: -kv[1].total_ms)
+        for label, h in items:
+            s = h.summary()
+            lines.append(f"{label}: {s['calls']} calls, avg {s['avg_ms']} ms, p50 ≤{s['p50_ms']:g} ms, "
+                         f"p95 ≤{s['p95_ms']:g} ms, max {s['max_ms']} ms"
+                         + (f", {s['errors']} errors" if s["errors"] else ""))
+        return lines
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> SupabaseClient:
+    """Process-wide client for SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            url, key = os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+            if not url or not key:
+                raise SystemExit("Missing env vars: SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY")
+            _client = SupabaseClient(url, key)
+        return _client
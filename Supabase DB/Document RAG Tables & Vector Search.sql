@@ -33,15 +33,58 @@ create table if not exists public.knowledge_chunks (
 create index if not exists idx_knowledge_chunks_doc_chunk
   on public.knowledge_chunks (document_id, chunk_index);
 
--- Optional: vector index (recommended once you have enough chunks)
--- Choose ivfflat lists by dataset size (example 100)
-create index if not exists idx_knowledge_chunks_embedding
-  on public.knowledge_chunks using ivfflat (embedding vector_cosine_ops) with (lists = 100);
+-- Retrieval partitions: filter columns, set by ingestion (Scripts/02_ingest_rag_data_to_supabase.py)
+-- - doc_type:   document family, e.g. 'connectors' | 'governance' | 'general'
+-- - sheet_name: worksheet of spreadsheet row chunks (null for documents)
+-- - tenant:     owning tenant; null = shared knowledge, visible to every tenant
+-- Plain columns rather than metadata keys, so the planner has statistics for them and
+-- the partial indexes below (and the per-doc_type ANN indexes of section 8) can prune.
+alter table public.knowledge_chunks
+  add column if not exists doc_type text not null default 'general',
+  add column if not exists sheet_name text,
+  add column if not exists tenant text;
+
+update public.knowledge_chunks
+set sheet_name = metadata ->> 'sheet'
+where sheet_name is null and metadata ? 'sheet';
+
+create index if not exists idx_knowledge_chunks_doc_type
+  on public.knowledge_chunks (doc_type, sheet_name)
+  where embedding is not null;
+
+create index if not exists idx_knowledge_chunks_sheet_name
+  on public.knowledge_chunks (sheet_name)
+  where embedding is not null and sheet_name is not null;
+
+create index if not exists idx_knowledge_chunks_tenant
+  on public.knowledge_chunks (tenant, doc_type)
+  where embedding is not null and tenant is not null;
+
+-- Vector index (idx_knowledge_chunks_embedding) is not created here: an ivfflat index built
+-- on an empty table has useless centroids. maintain_knowledge_chunk_index() (section 8)
+-- creates / re-sizes it from the row count; ingestion calls it at the end of every run.
 
 -- 5) Vector search RPC for docs
+-- Two steps: knowledge_chunk_candidates() (section 8) pulls match_count * rerank_factor
+-- candidates through the (possibly compact) ANN index, then they are re-ranked by the
+-- full-precision embedding. ef_search (HNSW) / probes (IVFFlat) trade latency for recall
+-- per call; pick them with benchmark_vector_search() (section 9).
+-- Optional filters (null = no filter): doc_types, sheet_names, document_ids, tenant_id
+-- (tenant_id also matches shared chunks, tenant is null).
+drop function if exists public.search_knowledge_chunks(vector, int);
+drop function if exists public.search_knowledge_chunks(vector, int, int, int);
+drop function if exists public.search_knowledge_chunks(vector, int, int, int, int);
+
 create or replace function public.search_knowledge_chunks (
   query_embedding vector(1536),
-  match_count int default 5
+  match_count int default 5,
+  ef_search int default 40,
+  probes int default 10,
+  rerank_factor int default null,
+  doc_types text[] default null,
+  sheet_names text[] default null,
+  document_ids uuid[] default null,
+  tenant_id text default null
 )
 returns table (
   id uuid,
@@ -50,16 +93,509 @@ returns table (
   content text,
   score float
 )
-language sql stable
+language plpgsql
 as $$
+#variable_conflict use_column
+begin
+  return query
   select
     kc.id,
     kc.document_id,
     kc.chunk_index,
     kc.content,
     1 - (kc.embedding <=> query_embedding) as score
-  from public.knowledge_chunks kc
-  where kc.embedding is not null
+  from public.knowledge_chunk_candidates(query_embedding, match_count, ef_search, probes, rerank_factor,
+                                         doc_types, sheet_names, document_ids, tenant_id) c
+  join public.knowledge_chunks kc on kc.id = c.id
   order by kc.embedding <=> query_embedding
   limit match_count;
+end;
+$$;
+
+-- 6) Bulk re-numbering for incremental ingestion
+-- updates: [{"id": "<uuid>", "chunk_index": 3}, ...]
+create or replace function public.renumber_knowledge_chunks (
+  updates jsonb
+)
+returns int
+language sql
+as $$
+  with upd as (
+    update public.knowledge_chunks kc
+    set chunk_index = u.chunk_index
+    from jsonb_to_recordset(updates) as u(id uuid, chunk_index int)
+    where kc.id = u.id
+    returning 1
+  )
+  select count(*)::int from upd;
+$$;
+
+-- 7) Deduplicated chunks
+-- Ingestion embeds only one canonical copy of duplicate / near-duplicate text. The other
+-- copies are stored with embedding = null (so search never returns them) and
+-- metadata.duplicate_of = {content_hash, filename, chunk_index, similarity} of the canonical.
+create index if not exists idx_knowledge_chunks_duplicate_of
+  on public.knowledge_chunks ((metadata -> 'duplicate_of' ->> 'content_hash'))
+  where metadata ? 'duplicate_of';
+
+-- Back-references: every source location of a canonical chunk (itself + its duplicates)
+create or replace view public.knowledge_chunk_sources as
+  select
+    kc.id as chunk_id,
+    kc.id as source_chunk_id,
+    kc.document_id,
+    kc.chunk_index,
+    1.0::float as similarity
+  from public.knowledge_chunks kc
+  where kc.embedding is not null
+  union all
+  select
+    canon.id as chunk_id,
+    dup.id as source_chunk_id,
+    dup.document_id,
+    dup.chunk_index,
+    (dup.metadata -> 'duplicate_of' ->> 'similarity')::float as similarity
+  from public.knowledge_chunks dup
+  join public.knowledge_chunks canon
+    on canon.metadata ->> 'content_hash' = dup.metadata -> 'duplicate_of' ->> 'content_hash'
+   and canon.embedding is not null
+  where dup.metadata ? 'duplicate_of';
+
+-- 8) Vector index: compact search vectors + maintenance
+-- The table keeps the full-precision float32 embedding; the ANN index is built on a
+-- compact expression of it and only used to find candidates:
+-- - none:    vector(1536)                                   (6 KB/row in the index)
+-- - halfvec: embedding::halfvec(1536)                       (2x smaller)
+-- - reduced: first reduced_dims dims, re-normalised         (1536/reduced_dims x smaller;
+--            text-embedding-3 vectors are Matryoshka-trained, so a prefix is a valid embedding)
+-- - binary:  binary_quantize(embedding)::bit(1536)         (32x smaller, needs the most re-ranking)
+-- The current setup is recorded in vector_index_config so the search RPCs order by the
+-- same expression the index was built on (otherwise Postgres cannot use the index).
+create table if not exists public.vector_index_config (
+  table_name text primary key,
+  method text not null,              -- exact | hnsw | ivfflat
+  quantization text not null,        -- none | halfvec | reduced | binary
+  dims int not null,
+  rerank_factor int not null,        -- candidates fetched per requested result
+  rows bigint not null,
+  params jsonb not null default '{}'::jsonb,
+  built_at timestamptz not null default now()
+);
+
+alter table public.vector_index_config enable row level security;
+
+create or replace function public.vector_index_expression (
+  quantization text,
+  dims int,
+  col text
+)
+returns text[]   -- {index expression, operator class, distance operator}
+language sql
+immutable
+as $$
+  select case quantization
+    when 'none'    then array[col, 'vector_cosine_ops', '<=>']
+    when 'halfvec' then array[format('(%s::halfvec(1536))', col), 'halfvec_cosine_ops', '<=>']
+    when 'reduced' then array[format('(l2_normalize(subvector(%s, 1, %s))::vector(%s))', col, dims, dims),
+                              'vector_cosine_ops', '<=>']
+    when 'binary'  then array[format('(binary_quantize(%s)::bit(1536))', col), 'bit_hamming_ops', '<~>']
+  end;
+$$;
+
+-- Filter predicates as SQL text with literal values (format %L): a literal
+-- "kc.doc_type = 'connectors'" lets the planner match the partial indexes, a parameter does not.
+create or replace function public.knowledge_chunk_filter_sql (
+  doc_types text[] default null,
+  sheet_names text[] default null,
+  document_ids uuid[] default null,
+  tenant_id text default null
+)
+returns text
+language sql
+immutable
+as $$
+  select concat(
+    case when doc_types is not null then format(' and kc.doc_type = any(%L::text[])', doc_types) end,
+    case when sheet_names is not null then format(' and kc.sheet_name = any(%L::text[])', sheet_names) end,
+    case when document_ids is not null then format(' and kc.document_id = any(%L::uuid[])', document_ids) end,
+    case when tenant_id is not null then format(' and (kc.tenant = %L or kc.tenant is null)', tenant_id) end);
+$$;
+
+-- Candidate ids for a query, through whatever index maintain_knowledge_chunk_index built.
+-- Filtered calls are planned per doc_type partition (see vector_index_config.params.partitions):
+-- - 'index':  the partition has its own partial ANN index (a selective slice of a big corpus)
+-- - 'exact':  the partition is small: filtered exact scan through the btree partial indexes
+-- - 'global': the partition is most of the corpus: the global ANN index, filtered
+-- Sheet / document filters are always selective enough for an exact filtered scan.
+drop function if exists public.knowledge_chunk_candidates(vector, int, int, int, int);
+
+create or replace function public.knowledge_chunk_candidates (
+  query_embedding vector(1536),
+  match_count int,
+  ef_search int default 40,
+  probes int default 10,
+  rerank_factor int default null,
+  doc_types text[] default null,
+  sheet_names text[] default null,
+  document_ids uuid[] default null,
+  tenant_id text default null
+)
+returns table (id uuid)
+language plpgsql
+as $$
+declare
+  cfg public.vector_index_config;
+  n int;
+  expr text[];
+  exact_sql text;
+  ann_sql text;
+  filters text;
+  parts text[] := '{}';
+  t text;
+  part_mode text;
+begin
+  select * into cfg from public.vector_index_config where table_name = 'knowledge_chunks';
+
+  exact_sql := 'select kc.id from public.knowledge_chunks kc
+                where kc.embedding is not null %s
+                order by kc.embedding <=> $1
+                limit $2';
+  filters := public.knowledge_chunk_filter_sql(null, sheet_names, document_ids, tenant_id);
+
+  if cfg is null or cfg.method = 'exact' or sheet_names is not null or document_ids is not null then
+    return query execute format(exact_sql, public.knowledge_chunk_filter_sql(doc_types) || filters)
+    using query_embedding, match_count;
+    return;
+  end if;
+
+  n := match_count * greatest(1, coalesce(rerank_factor, cfg.rerank_factor));
+  -- transaction-local: only affects this call; a filtered scan of the global index
+  -- discards non-matching neighbours, so it gets a deeper search
+  perform set_config('hnsw.ef_search',
+                     greatest(ef_search, case when filters = '' and doc_types is null then n else n * 2 end)::text,
+                     true);
+  perform set_config('ivfflat.probes', probes::text, true);
+
+  expr := public.vector_index_expression(cfg.quantization, cfg.dims, 'kc.embedding');
+  ann_sql := format(
+    'select kc.id from public.knowledge_chunks kc
+     where kc.embedding is not null %%s
+     order by %s %s %s
+     limit $2',
+    expr[1], expr[3], (public.vector_index_expression(cfg.quantization, cfg.dims, '$1'))[1]);
+
+  if doc_types is null then
+    return query execute format(ann_sql, filters) using query_embedding, n;
+    return;
+  end if;
+
+  foreach t in array doc_types loop
+    part_mode := coalesce(cfg.params -> 'partitions' -> t ->> 'mode', 'exact');
+    parts := parts || format('(%s)',
+      format(case when part_mode = 'exact' then exact_sql else ann_sql end,
+             format(' and kc.doc_type = %L', t) || filters));
+  end loop;
+  return query execute array_to_string(parts, ' union all ') using query_embedding, n;
+end;
+$$;
+
+-- Maintenance (called by Scripts/02_ingest_rag_data_to_supabase.py)
+-- Sizes the ANN index from the number of embedded chunks and rebuilds it only when the
+-- sizing or quantization changed, then refreshes planner statistics:
+-- - below min_rows: no ANN index (exact search is fast and has 100% recall)
+-- - hnsw:    m / ef_construction grow with the corpus; inserts keep the graph current
+-- - ivfflat: lists = rows / 1000 (sqrt(rows) above 1M); rebuilt when that drifts > 25%,
+--            so centroids are trained on the data actually stored
+drop function if exists public.maintain_knowledge_chunk_index(text, int);
+
+create or replace function public.maintain_knowledge_chunk_index (
+  method text default 'hnsw',
+  min_rows int default 10000,
+  quantization text default 'halfvec',
+  reduced_dims int default 512
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+set statement_timeout = 0
+set maintenance_work_mem = '256MB'
+as $$
+declare
+  n bigint;
+  cfg public.vector_index_config;
+  cur_method text;
+  cur_opts text[];
+  want_opts text[];
+  params jsonb;
+  dims int;
+  factor int;
+  m int;
+  ef_construction int;
+  lists int;
+  cur_lists int;
+  expr text[];
+  rebuilt boolean := false;
+  partitions jsonb;
+  part record;
+  part_index text;
+  part_mode text;
+  prev_rows bigint;
+begin
+  if method not in ('hnsw', 'ivfflat') then
+    raise exception 'method must be hnsw or ivfflat, got %', method;
+  end if;
+  if quantization not in ('none', 'halfvec', 'reduced', 'binary') then
+    raise exception 'quantization must be none, halfvec, reduced or binary, got %', quantization;
+  end if;
+
+  select count(*) into n from public.knowledge_chunks where embedding is not null;
+  select * into cfg from public.vector_index_config where table_name = 'knowledge_chunks';
+
+  select am.amname, c.reloptions into cur_method, cur_opts
+  from pg_class c
+  join pg_am am on am.oid = c.relam
+  where c.relname = 'idx_knowledge_chunks_embedding'
+    and c.relnamespace = 'public'::regnamespace;
+
+  if n < min_rows then
+    if cur_method is not null then
+      drop index public.idx_knowledge_chunks_embedding;
+      rebuilt := true;
+    end if;
+    method := 'exact';
+    quantization := 'none';
+    dims := 1536;
+    factor := 1;
+    params := '{}'::jsonb;
+  else
+    dims := case when quantization = 'reduced' then reduced_dims else 1536 end;
+    -- re-ranking makes up for quantization error; measure with benchmark_vector_search()
+    factor := case quantization when 'none' then 1 when 'halfvec' then 2 when 'reduced' then 4 else 10 end;
+    expr := public.vector_index_expression(quantization, dims, 'embedding');
+
+    if method = 'hnsw' then
+      m := case when n <= 1000000 then 16 else 24 end;
+      ef_construction := case when n <= 100000 then 64 when n <= 1000000 then 128 else 200 end;
+      want_opts := array['m=' || m, 'ef_construction=' || ef_construction];
+      params := jsonb_build_object('m', m, 'ef_construction', ef_construction);
+      rebuilt := cur_method is distinct from 'hnsw' or cur_opts is distinct from want_opts;
+    else
+      lists := greatest(1, case when n <= 1000000 then n / 1000 else floor(sqrt(n)) end)::int;
+      if cur_method = 'ivfflat' then
+        select split_part(o, '=', 2)::int into cur_lists from unnest(cur_opts) o where o like 'lists=%';
+      end if;
+      rebuilt := cur_method is distinct from 'ivfflat' or cur_lists is null
+                 or abs(cur_lists - lists) > lists * 0.25;
+      if not rebuilt then
+        lists := cur_lists;
+      end if;
+      params := jsonb_build_object('lists', lists);
+    end if;
+
+    rebuilt := rebuilt or cfg is null
+               or cfg.quantization is distinct from quantization or cfg.dims is distinct from dims;
+    if rebuilt then
+      drop index if exists public.idx_knowledge_chunks_embedding;
+      execute format(
+        'create index idx_knowledge_chunks_embedding on public.knowledge_chunks using %s (%s %s) with (%s)',
+        method, expr[1], expr[2],
+        case when method = 'hnsw' then format('m = %s, ef_construction = %s', m, ef_construction)
+             else format('lists = %s', lists) end);
+    end if;
+  end if;
+
+  -- Per-doc_type partitions for filtered search (see knowledge_chunk_candidates): a
+  -- doc_type with at least min_rows chunks and at most half of the corpus gets its own
+  -- partial ANN index; bigger ones filter the global index, smaller ones are scanned exactly.
+  partitions := '{}'::jsonb;
+  for part in
+    select kc.doc_type, count(*) as rows
+    from public.knowledge_chunks kc
+    where kc.embedding is not null
+    group by kc.doc_type
+  loop
+    part_index := 'idx_knowledge_chunks_embedding_p_' || left(md5(part.doc_type), 12);
+    part_mode := case when method = 'exact' or part.rows < min_rows then 'exact'
+                      when part.rows * 2 > n then 'global'
+                      else 'index' end;
+    if part_mode = 'index' then
+      prev_rows := (cfg.params -> 'partitions' -> part.doc_type ->> 'rows')::bigint;
+      if rebuilt or to_regclass('public.' || part_index) is null
+         or (method = 'ivfflat' and abs(coalesce(prev_rows, 0) - part.rows) > part.rows * 0.25) then
+        execute format('drop index if exists public.%I', part_index);
+        execute format(
+          'create index %I on public.knowledge_chunks using %s (%s %s) with (%s)
+           where embedding is not null and doc_type = %L',
+          part_index, method, expr[1], expr[2],
+          case when method = 'hnsw' then format('m = %s, ef_construction = %s', m, ef_construction)
+               else format('lists = %s', greatest(1, part.rows / 1000)) end,
+          part.doc_type);
+      end if;
+    end if;
+    partitions := partitions || jsonb_build_object(part.doc_type, jsonb_build_object(
+      'rows', part.rows, 'mode', part_mode, 'index', case when part_mode = 'index' then part_index end));
+  end loop;
+
+  for part_index in
+    select indexname from pg_indexes
+    where schemaname = 'public' and tablename = 'knowledge_chunks'
+      and indexname like 'idx\_knowledge\_chunks\_embedding\_p\_%'
+  loop
+    if not exists (select 1 from jsonb_each(partitions) p where p.value ->> 'index' = part_index) then
+      execute format('drop index public.%I', part_index);
+    end if;
+  end loop;
+  params := params || jsonb_build_object('partitions', partitions);
+
+  insert into public.vector_index_config
+    (table_name, method, quantization, dims, rerank_factor, rows, params, built_at)
+  values ('knowledge_chunks', method, quantization, dims, factor, n, params, now())
+  on conflict (table_name) do update
+  set method = excluded.method,
+      quantization = excluded.quantization,
+      dims = excluded.dims,
+      rerank_factor = excluded.rerank_factor,
+      rows = excluded.rows,
+      params = excluded.params,
+      built_at = case when rebuilt then excluded.built_at else vector_index_config.built_at end;
+
+  analyze public.knowledge_chunks;
+  return jsonb_build_object(
+    'rows', n, 'method', method, 'quantization', quantization, 'dims', dims,
+    'rerank_factor', factor, 'params', params, 'rebuilt', rebuilt,
+    'index_mb', round(coalesce(pg_relation_size(to_regclass('public.idx_knowledge_chunks_embedding')), 0) / 1048576.0, 1));
+end;
+$$;
+
+revoke execute on function public.maintain_knowledge_chunk_index(text, int, text, int) from public, anon, authenticated;
+
+-- 9) Recall vs latency benchmark against exact search (Scripts/06_vector_index_benchmark.py)
+-- Each query is the sum of two random stored chunk embeddings (cosine: the midpoint of
+-- the two directions), so it is not itself in the index; both source chunks are left out
+-- of the exact and the ANN top-k, otherwise every query would find itself at rank 1 and
+-- inflate recall. Ground truth is the exact full-precision top-k (index scans disabled); each ef_search (HNSW) or probes (IVFFlat)
+-- setting then runs the real search path (compact index candidates + full-precision
+-- re-rank) and is scored as recall@k = |top-k ∩ exact top-k| / k.
+drop function if exists public.benchmark_vector_search(int, int, int[]);
+
+create or replace function public.benchmark_vector_search (
+  sample_size int default 50,
+  k int default 10,
+  settings int[] default array[10, 20, 40, 80, 160, 320],
+  rerank_factor int default null
+)
+returns table (
+  method text,
+  setting int,
+  recall numeric,
+  avg_ms numeric,
+  p95_ms numeric,
+  index_mb numeric
+)
+language plpgsql
+set statement_timeout = 0
+as $$
+#variable_conflict use_column
+declare
+  queries vector(1536)[];
+  sources uuid[][];
+  truth uuid[][];
+  ids uuid[];
+  timings numeric[];
+  recalls numeric[];
+  cfg public.vector_index_config;
+  size_mb numeric;
+  s int;
+  i int;
+  t0 timestamptz;
+begin
+  with picks as (
+    select r.id, r.embedding, row_number() over () as n
+    from (
+      select kc.id, kc.embedding from public.knowledge_chunks kc
+      where kc.embedding is not null
+      order by random()
+      limit sample_size * 2
+    ) r
+  )
+  select array_agg(a.embedding + b.embedding order by a.n), array_agg(array[a.id, b.id] order by a.n)
+    into queries, sources
+  from picks a
+  join picks b on b.n = a.n + 1
+  where a.n % 2 = 1;
+  if queries is null then
+    return;
+  end if;
+
+  select * into cfg from public.vector_index_config where table_name = 'knowledge_chunks';
+  size_mb := round(coalesce(pg_relation_size(to_regclass('public.idx_knowledge_chunks_embedding')), 0) / 1048576.0, 1);
+
+  -- exact top-k: sequential scan, full distance computation
+  perform set_config('enable_indexscan', 'off', true);
+  timings := '{}';
+  truth := array_fill(null::uuid, array[array_length(queries, 1), k]);
+  for i in 1..array_length(queries, 1) loop
+    t0 := clock_timestamp();
+    select array_agg(e.id) into ids
+    from (
+      select kc.id from public.knowledge_chunks kc
+      where kc.embedding is not null
+        and kc.id <> all(sources[i:i][1:2])
+      order by kc.embedding <=> queries[i]
+      limit k
+    ) e;
+    timings := timings || (extract(epoch from clock_timestamp() - t0) * 1000)::numeric;
+    for s in 1..coalesce(array_length(ids, 1), 0) loop
+      truth[i][s] := ids[s];
+    end loop;
+  end loop;
+  perform set_config('enable_indexscan', 'on', true);
+
+  method := 'exact';
+  setting := null;
+  recall := 1;
+  avg_ms := round((select avg(x) from unnest(timings) x), 2);
+  p95_ms := round((select percentile_cont(0.95) within group (order by x) from unnest(timings) x)::numeric, 2);
+  index_mb := pg_relation_size('public.knowledge_chunks') / 1048576.0;   -- heap scanned instead
+  index_mb := round(index_mb, 1);
+  return next;
+
+  if cfg is null or cfg.method = 'exact' then
+    return;   -- no ANN index yet (see maintain_knowledge_chunk_index)
+  end if;
+
+  foreach s in array settings loop
+    timings := '{}';
+    recalls := '{}';
+    for i in 1..array_length(queries, 1) loop
+      t0 := clock_timestamp();
+      select array_agg(a.id) into ids
+      from (
+        select kc.id
+        from public.knowledge_chunk_candidates(queries[i], k + 2, s, s, rerank_factor) c
+        join public.knowledge_chunks kc on kc.id = c.id
+        where kc.id <> all(sources[i:i][1:2])
+        order by kc.embedding <=> queries[i]
+        limit k
+      ) a;
+      timings := timings || (extract(epoch from clock_timestamp() - t0) * 1000)::numeric;
+      recalls := recalls || (
+        select count(*)::numeric / k
+        from unnest(ids) got
+        where got = any(truth[i:i][1:k])
+      );
+    end loop;
+
+    method := cfg.method || '+' || cfg.quantization;
+    setting := s;
+    recall := round((select avg(x) from unnest(recalls) x), 4);
+    avg_ms := round((select avg(x) from unnest(timings) x), 2);
+    p95_ms := round((select percentile_cont(0.95) within group (order by x) from unnest(timings) x)::numeric, 2);
+    index_mb := size_mb;
+    return next;
+  end loop;
+end;
 $$;
+
+revoke execute on function public.benchmark_vector_search(int, int, int[], int) from public, anon, authenticated;
@@ -0,0 +1,135 @@
+-- Keyword search benchmark: old ILIKE scan vs full-text (GIN tsvector) vs trigram (GIN pg_trgm)
+-- at 10k -> 10M chunks. Runs on a synthetic corpus in a separate "bench" schema; it never
+-- touches public.knowledge_chunks.
+--
+-- Run on a local Postgres or a Supabase branch, not production: the 10M corpus is several GB
+-- and takes a while to build. Smaller sizes alone:
+--   select * from bench.run_keyword_benchmark(array[10000, 100000]);
+-- Full run:
+--   select * from bench.run_keyword_benchmark();
+-- Clean up:
+--   drop schema bench cascade;
+
+create extension if not exists pg_trgm;
+create schema if not exists bench;
+
+-- 1) Synthetic corpus: ~60 words per chunk; a few domain terms (connector names, policy words)
+-- mixed with a long tail of rare tokens, so selective and common terms both get measured.
+create or replace function bench.build_keyword_corpus(n_rows int)
+returns void
+language plpgsql
+as $$
+declare
+  vocab text[] := array[
+    'sharepoint', 'outlook', 'office365', 'teams', 'excel', 'onedrive', 'dataverse', 'sql',
+    'approved', 'blocked', 'connector', 'policy', 'environment', 'governance', 'arb', 'review',
+    'dlp', 'tenant', 'flow', 'trigger', 'action', 'attachment', 'email', 'pagination',
+    'concurrency', 'retry', 'scope', 'publisher', 'microsoft', 'premium', 'custom', 'http'
+  ];
+begin
+  drop table if exists bench.chunks;
+  create table bench.chunks (
+    id bigint generated always as identity primary key,
+    content text not null,
+    content_tsv tsvector generated always as (to_tsvector('english', content)) stored,
+    created_at timestamptz not null default now()
+  );
+
+  insert into bench.chunks (content, created_at)
+  select
+    (select string_agg(
+        case when random() < 0.3
+             then vocab[1 + floor(random() * array_length(vocab, 1))::int]
+             else 'w' || floor(random() * 200000)::int
+        end, ' ')
+     from generate_series(1, 60) w
+     where g > 0),          -- correlate, so every row gets its own words
+    now() - (g || ' seconds')::interval
+  from generate_series(1, n_rows) g;
+
+  create index on bench.chunks using gin (content_tsv);
+  create index on bench.chunks using gin (content gin_trgm_ops);
+  analyze bench.chunks;
+end;
+$$;
+
+-- 2) Time each method for a set of terms; every query is run `runs` times after one warm-up.
+create or replace function bench.time_keyword_search(
+  terms text[],
+  runs int default 20,
+  match_count int default 10
+)
+returns table (
+  method text,
+  avg_ms numeric,
+  p95_ms numeric
+)
+language plpgsql
+as $$
+declare
+  queries text[][] := array[
+    -- before: one ILIKE query per term, newest first (sequential scan)
+    array['ilike_scan',
+          'select id from bench.chunks where content ilike (''%%'' || %L || ''%%'') order by created_at desc limit %s'],
+    -- after: one full-text query for all terms, ranked by ts_rank
+    array['fts_gin',
+          'select id from bench.chunks where content_tsv @@ websearch_to_tsquery(''english'', %L) order by ts_rank(content_tsv, websearch_to_tsquery(''english'', %1$L)) desc limit %s'],
+    -- after: trigram substring match per term (index-backed ILIKE)
+    array['trigram_gin',
+          'select id from bench.chunks where content ilike (''%%'' || %L || ''%%'') order by word_similarity(%1$L, content) desc limit %s']
+  ];
+  q text[];
+  term text;
+  t0 timestamptz;
+  timings numeric[];
+  i int;
+begin
+  foreach q slice 1 in array queries loop
+    timings := '{}';
+    for i in 0..runs loop
+      t0 := clock_timestamp();
+      if q[1] = 'fts_gin' then
+        execute format(q[2], array_to_string(terms, ' or '), match_count);
+      else
+        foreach term in array terms loop
+          execute format(q[2], term, match_count);
+        end loop;
+      end if;
+      if i > 0 then   -- run 0 is the warm-up
+        timings := timings || (extract(epoch from clock_timestamp() - t0) * 1000)::numeric;
+      end if;
+    end loop;
+
+    method := q[1];
+    avg_ms := round((select avg(x) from unnest(timings) x), 2);
+    p95_ms := round((select percentile_cont(0.95) within group (order by x) from unnest(timings) x)::numeric, 2);
+    return next;
+  end loop;
+end;
+$$;
+
+-- 3) Full sweep: build each corpus size, then time all methods on it.
+create or replace function bench.run_keyword_benchmark(
+  sizes int[] default array[10000, 100000, 1000000, 10000000],
+  terms text[] default array['sharepoint', 'approved', 'w4242'],
+  runs int default 20
+)
+returns table (
+  n_rows int,
+  method text,
+  avg_ms numeric,
+  p95_ms numeric
+)
+language plpgsql
+as $$
+declare
+  n int;
+begin
+  foreach n in array sizes loop
+    perform bench.build_keyword_corpus(n);
+    return query
+      select n, t.method, t.avg_ms, t.p95_ms
+      from bench.time_keyword_search(terms, runs) t;
+  end loop;
+end;
+$$;
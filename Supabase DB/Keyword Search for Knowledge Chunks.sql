@@ -1,22 +1,198 @@
+-- Keyword (lexical) search over knowledge chunks
+-- Safe to run multiple times (IF NOT EXISTS / CREATE OR REPLACE)
+-- Benchmark: "Keyword Search Benchmark.sql"
+
+-- 1) Indexes instead of ILIKE '%kw%' sequential scans
+create extension if not exists pg_trgm;
+
+-- Full-text: generated tsvector, kept in sync by Postgres on insert/update
+alter table public.knowledge_chunks
+  add column if not exists content_tsv tsvector
+  generated always as (to_tsvector('english', content)) stored;
+
+create index if not exists idx_knowledge_chunks_content_tsv
+  on public.knowledge_chunks using gin (content_tsv);
+
+-- Trigram: substring and fuzzy matches the English parser misses
+-- (connector ids like "shared_office365", partial names, typos)
+create index if not exists idx_knowledge_chunks_content_trgm
+  on public.knowledge_chunks using gin (content gin_trgm_ops);
+
+-- 2) Keyword RPC: many terms in one call, ranked by relevance.
+-- Full-text matches (any term) rank by ts_rank; chunks found only through trigram
+-- matching follow, by word similarity. The trigram path runs only for terms full-text
+-- search found nothing for (ids like "shared_office365", partial names, typos), and only
+-- rows with word_similarity >= min_similarity are sorted. Only canonical chunks
+-- (embedding not null) are searched, so deduplicated copies never repeat the same text.
+-- Optional filters as in search_knowledge_chunks (null = no filter); Postgres combines
+-- the text indexes with the doc_type / sheet_name / tenant partial indexes (BitmapAnd).
+drop function if exists public.search_knowledge_chunks_keyword(text, int);
+drop function if exists public.search_knowledge_chunks_keyword(text[], int);
+drop function if exists public.search_knowledge_chunks_keyword(text[], int, text[], text[], uuid[], text);
+
 create or replace function public.search_knowledge_chunks_keyword(
-  keyword text,
-  match_count int default 10
+  keywords text[],
+  match_count int default 10,
+  doc_types text[] default null,
+  sheet_names text[] default null,
+  document_ids uuid[] default null,
+  tenant_id text default null,
+  min_similarity float default 0.3
 )
 returns table (
   id uuid,
   document_id uuid,
   chunk_index int,
-  content text
+  content text,
+  rank float,
+  similarity float
 )
 language sql stable
 as $$
+  with q as (
+    select websearch_to_tsquery('english', array_to_string(keywords, ' or ')) as tsq
+  ),
+  fts as (
+    select kc.id, ts_rank(kc.content_tsv, q.tsq) as rank
+    from public.knowledge_chunks kc, q
+    where kc.content_tsv @@ q.tsq
+      and kc.embedding is not null
+      and (doc_types is null or kc.doc_type = any(doc_types))
+      and (sheet_names is null or kc.sheet_name = any(sheet_names))
+      and (document_ids is null or kc.document_id = any(document_ids))
+      and (tenant_id is null or kc.tenant = tenant_id or kc.tenant is null)
+    order by rank desc, kc.id
+    limit match_count
+  ),
+  -- terms without any full-text hit: stopwords, ids the English parser splits, typos
+  missed as (
+    select k.term
+    from unnest(keywords) as k(term)
+    cross join lateral (select plainto_tsquery('english', k.term) as tsq) t
+    where length(k.term) >= 3     -- shorter terms cannot use the trigram index
+      and (numnode(t.tsq) = 0 or not exists (
+        select 1
+        from public.knowledge_chunks kc
+        where kc.content_tsv @@ t.tsq
+          and kc.embedding is not null
+          and (doc_types is null or kc.doc_type = any(doc_types))
+          and (sheet_names is null or kc.sheet_name = any(sheet_names))
+          and (document_ids is null or kc.document_id = any(document_ids))
+          and (tenant_id is null or kc.tenant = tenant_id or kc.tenant is null)
+      ))
+  ),
+  trgm as (
+    select hit.id, max(hit.sim) as sim
+    from missed k
+    cross join lateral (
+      select kc.id, word_similarity(k.term, kc.content) as sim
+      from public.knowledge_chunks kc
+      where (kc.content ilike ('%' || k.term || '%') or k.term <% kc.content)
+        and word_similarity(k.term, kc.content) >= min_similarity
+        and kc.embedding is not null
+        and (doc_types is null or kc.doc_type = any(doc_types))
+        and (sheet_names is null or kc.sheet_name = any(sheet_names))
+        and (document_ids is null or kc.document_id = any(document_ids))
+        and (tenant_id is null or kc.tenant = tenant_id or kc.tenant is null)
+      order by sim desc, kc.id
+      limit match_count
+    ) hit
+    group by hit.id
+  )
   select
     kc.id,
     kc.document_id,
     kc.chunk_index,
-    kc.content
-  from public.knowledge_chunks kc
-  where kc.content ilike ('%' || keyword || '%')
-  order by kc.created_at desc
+    kc.content,
+    coalesce(fts.rank, 0)::float as rank,
+    coalesce(trgm.sim, 0)::float as similarity
+  from fts
+  full outer join trgm on trgm.id = fts.id
+  join public.knowledge_chunks kc on kc.id = coalesce(fts.id, trgm.id)
+  order by fts.rank desc nulls last, trgm.sim desc nulls last, kc.id
   limit match_count;
 $$;
+
+-- 3) Hybrid search in one round-trip: vector + keyword retrieval fused with
+-- reciprocal rank fusion (RRF). Each ranked list (vector, keyword) adds
+-- 1 / (rrf_k + rank) to a chunk's fused score; chunks are unique by id.
+-- score = cosine similarity when the chunk was in the vector list (null otherwise), for
+-- confidence gating on the client. Vector candidates come through the same compact index
+-- + full-precision re-rank as search_knowledge_chunks (ef_search / probes: see there).
+-- The filters (doc_types, sheet_names, document_ids, tenant_id) apply to both lists.
+drop function if exists public.search_knowledge_chunks_hybrid(vector, text[], int, int, int, int);
+drop function if exists public.search_knowledge_chunks_hybrid(vector, text[], int, int, int, int, int, int);
+
+create or replace function public.search_knowledge_chunks_hybrid(
+  query_embedding vector(1536),
+  keywords text[] default '{}',
+  match_count int default 10,
+  vector_count int default 12,
+  keyword_count int default 12,
+  rrf_k int default 60,
+  ef_search int default 40,
+  probes int default 10,
+  doc_types text[] default null,
+  sheet_names text[] default null,
+  document_ids uuid[] default null,
+  tenant_id text default null
+)
+returns table (
+  id uuid,
+  document_id uuid,
+  chunk_index int,
+  content text,
+  score float,
+  rrf_score float,
+  vector_rank int,
+  keyword_rank int
+)
+language plpgsql
+as $$
+#variable_conflict use_column
+begin
+  return query
+  with vec as (
+    select
+      kc.id,
+      1 - (kc.embedding <=> query_embedding) as score,
+      row_number() over (order by kc.embedding <=> query_embedding)::int as rnk
+    from public.knowledge_chunk_candidates(query_embedding, vector_count, ef_search, probes, null,
+                                           doc_types, sheet_names, document_ids, tenant_id) c
+    join public.knowledge_chunks kc on kc.id = c.id
+    order by kc.embedding <=> query_embedding
+    limit vector_count
+  ),
+  kw as (
+    select
+      k.id,
+      row_number() over (order by k.rank desc, k.similarity desc, k.id)::int as rnk
+    from public.search_knowledge_chunks_keyword(keywords, keyword_count,
+                                                doc_types, sheet_names, document_ids, tenant_id) k
+    where cardinality(keywords) > 0
+  ),
+  fused as (
+    select
+      coalesce(vec.id, kw.id) as id,
+      vec.score,
+      coalesce(1.0 / (rrf_k + vec.rnk), 0) + coalesce(1.0 / (rrf_k + kw.rnk), 0) as rrf_score,
+      vec.rnk as vector_rank,
+      kw.rnk as keyword_rank
+    from vec
+    full outer join kw on kw.id = vec.id
+  )
+  select
+    kc.id,
+    kc.document_id,
+    kc.chunk_index,
+    kc.content,
+    f.score,
+    f.rrf_score::float,
+    f.vector_rank,
+    f.keyword_rank
+  from fused f
+  join public.knowledge_chunks kc on kc.id = f.id
+  order by f.rrf_score desc, f.score desc nulls last
+  limit match_count;
+end;
+$$;
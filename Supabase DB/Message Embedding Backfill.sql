@@ -0,0 +1,129 @@
+-- Message embedding backfill support (used by Scripts/message_backfill.py)
+-- Safe to run multiple times (IF NOT EXISTS / CREATE OR REPLACE)
+
+-- 0) Embedding status: null = not handled yet (the backlog).
+-- 'embedded' = one vector, 'pooled' = long message, mean of segment vectors,
+-- 'skipped' = deliberately not embedded (secret detected, empty, too many segments).
+alter table public.messages
+  add column if not exists embedding_status text
+  check (embedding_status in ('embedded', 'pooled', 'skipped'));
+
+comment on column public.messages.embedding_status is 'null = waiting for an embedding; embedded | pooled | skipped once handled.';
+
+-- Rows embedded before the status column existed are not backlog.
+update public.messages
+set embedding_status = 'embedded'
+where embedding is not null and embedding_status is null;
+
+-- 1) Keyset pagination over the backlog: (created_at, id) of rows not handled yet.
+-- Partial index, so it only holds the backlog and shrinks as the backfill progresses.
+-- (Replaces the earlier "embedding is null" indexes: skipped rows kept those from shrinking.)
+drop index if exists public.idx_messages_embedding_backlog;
+drop index if exists public.idx_messages_user_embedding_backlog;
+
+create index if not exists idx_messages_embedding_pending
+  on public.messages (created_at, id)
+  where embedding_status is null;
+
+create index if not exists idx_messages_user_embedding_pending
+  on public.messages (user_id, created_at, id)
+  where embedding_status is null;
+
+-- 2) Segment vectors of long messages (optional, for fine-grained recall).
+-- start_char/end_char are offsets into messages.content; the text itself is not copied.
+create table if not exists public.message_embedding_segments (
+  message_id uuid not null references public.messages(id) on delete cascade,
+  segment_index int not null,
+  start_char int not null,
+  end_char int not null,
+  embedding vector(1536) not null,
+  primary key (message_id, segment_index)
+);
+
+comment on table public.message_embedding_segments is 'Per-segment embeddings of messages too long for one embedding (messages.embedding holds the pooled vector).';
+
+alter table public.message_embedding_segments enable row level security;
+
+-- 3) Bulk write-back: one call per page instead of one PATCH per message
+-- updates: [{"id": "<uuid>", "embedding": "[0.1,...]" | null, "status": "embedded" | "pooled" | "skipped",
+--            "segments": [{"index": 0, "start": 0, "end": 3000, "embedding": "[...]"}, ...]}, ...]
+create or replace function public.set_message_embeddings (
+  updates jsonb
+)
+returns int
+language plpgsql
+as $$
+declare
+  n int;
+begin
+  update public.messages m
+  set embedding = u.embedding::vector(1536),
+      embedding_status = coalesce(u.status, 'embedded')
+  from jsonb_to_recordset(updates) as u(id uuid, embedding text, status text)
+  where m.id = u.id;
+  get diagnostics n = row_count;
+
+  -- segments are replaced as a whole for every message in the batch
+  delete from public.message_embedding_segments s
+  using jsonb_to_recordset(updates) as u(id uuid)
+  where s.message_id = u.id;
+
+  insert into public.message_embedding_segments (message_id, segment_index, start_char, end_char, embedding)
+  select u.id, (seg->>'index')::int, (seg->>'start')::int, (seg->>'end')::int, (seg->>'embedding')::vector(1536)
+  from jsonb_to_recordset(updates) as u(id uuid, segments jsonb)
+  cross join lateral jsonb_array_elements(coalesce(u.segments, '[]'::jsonb)) as seg;
+
+  return n;
+end;
+$$;
+
+-- Server-side only (service_role); not callable by end users.
+revoke execute on function public.set_message_embeddings(jsonb) from public, anon, authenticated;
+
+-- 4) Compact ANN index: half-precision (2x smaller) copy of the float32 segment vectors,
+-- so the index stays in RAM as history grows. search_message_segments orders by the same
+-- expression (embedding::halfvec(1536) <=> query::halfvec(1536)) for candidates, then
+-- re-ranks the few candidates with the full-precision embedding.
+-- No query searches public.messages by vector (user memory is text search), so that table
+-- gets no ANN index: it would only slow down every insert and embedding write-back.
+drop index if exists public.idx_messages_embedding_halfvec;
+
+create index if not exists idx_message_segments_embedding_halfvec
+  on public.message_embedding_segments using hnsw ((embedding::halfvec(1536)) halfvec_cosine_ops);
+
+-- 5) Fine-grained recall: best-matching segments of a user's long messages
+drop function if exists public.search_message_segments(vector, uuid, int);
+
+create or replace function public.search_message_segments (
+  query_embedding vector(1536),
+  user_uuid uuid,
+  match_count int default 5,
+  rerank_factor int default 4
+)
+returns table (
+  message_id uuid,
+  segment_index int,
+  content text,
+  similarity float
+)
+language sql
+stable
+as $$
+  with candidates as (
+    select s.message_id, s.segment_index, s.start_char, s.end_char, s.embedding
+    from public.message_embedding_segments s
+    join public.messages m on m.id = s.message_id
+    where m.user_id = user_uuid
+    order by s.embedding::halfvec(1536) <=> query_embedding::halfvec(1536)
+    limit match_count * rerank_factor
+  )
+  select
+    c.message_id,
+    c.segment_index,
+    substring(m.content from c.start_char + 1 for c.end_char - c.start_char) as content,
+    1 - (c.embedding <=> query_embedding) as similarity
+  from candidates c
+  join public.messages m on m.id = c.message_id
+  order by c.embedding <=> query_embedding
+  limit match_count;
+$$;
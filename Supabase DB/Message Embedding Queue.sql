@@ -0,0 +1,120 @@
+-- Near-real-time message embeddings: insert trigger -> job queue -> NOTIFY -> local worker
+-- (Scripts/05_embedding_queue_worker.py). Safe to run multiple times.
+-- Run after "Message Embedding Backfill.sql" (uses embedding_status and set_message_embeddings).
+
+-- 1) Queue table: one job per message that still needs an embedding
+create table if not exists public.message_embedding_jobs (
+  message_id uuid primary key references public.messages(id) on delete cascade,
+  enqueued_at timestamptz not null default now(),
+  claimed_at timestamptz,
+  attempts int not null default 0,
+  last_error text
+);
+
+comment on table public.message_embedding_jobs is 'Messages waiting for an embedding; claimed by workers with FOR UPDATE SKIP LOCKED.';
+
+create index if not exists idx_message_embedding_jobs_ready
+  on public.message_embedding_jobs (enqueued_at)
+  where claimed_at is null;
+
+-- Service role only (no policies = no access for anon/authenticated)
+alter table public.message_embedding_jobs enable row level security;
+
+-- 2) Trigger: enqueue new messages and wake up listening workers
+create or replace function public.enqueue_message_embedding()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  if new.embedding is null and new.embedding_status is null then
+    insert into public.message_embedding_jobs (message_id)
+    values (new.id)
+    on conflict (message_id) do nothing;
+    perform pg_notify('message_embedding_jobs', new.id::text);
+  end if;
+  return new;
+end;
+$$;
+
+drop trigger if exists trg_messages_enqueue_embedding on public.messages;
+
+create trigger trg_messages_enqueue_embedding
+after insert on public.messages
+for each row
+execute function public.enqueue_message_embedding();
+
+-- 3) Claim a batch. SKIP LOCKED lets several workers run without double-processing;
+-- jobs claimed longer than visibility_timeout ago (crashed worker) become claimable again.
+create or replace function public.claim_message_embedding_jobs (
+  batch_size int default 64,
+  visibility_timeout interval default interval '5 minutes',
+  max_attempts int default 5
+)
+returns table (
+  message_id uuid,
+  content text,
+  attempts int
+)
+language sql
+as $$
+  with picked as (
+    select j.message_id
+    from public.message_embedding_jobs j
+    where (j.claimed_at is null or j.claimed_at < now() - visibility_timeout)
+      and j.attempts < max_attempts
+    order by j.enqueued_at
+    for update skip locked
+    limit batch_size
+  ),
+  claimed as (
+    update public.message_embedding_jobs j
+    set claimed_at = now(), attempts = j.attempts + 1
+    from picked
+    where j.message_id = picked.message_id
+    returning j.message_id, j.attempts
+  )
+  select c.message_id, m.content, c.attempts
+  from claimed c
+  join public.messages m on m.id = c.message_id;
+$$;
+
+-- 4) Complete a batch: write embeddings (same records as set_message_embeddings, incl.
+-- status 'skipped' and long-message segments) and remove the jobs in one call.
+create or replace function public.complete_message_embedding_jobs (
+  results jsonb
+)
+returns int
+language plpgsql
+as $$
+declare
+  n int;
+begin
+  perform public.set_message_embeddings(results);
+
+  delete from public.message_embedding_jobs j
+  using jsonb_to_recordset(results) as r(id uuid)
+  where j.message_id = r.id;
+  get diagnostics n = row_count;
+
+  return n;
+end;
+$$;
+
+-- 5) Release failed jobs for a later retry (they stop after max_attempts)
+create or replace function public.fail_message_embedding_jobs (
+  message_ids uuid[],
+  error text
+)
+returns void
+language sql
+as $$
+  update public.message_embedding_jobs
+  set claimed_at = null, last_error = error
+  where message_id = any(message_ids);
+$$;
+
+revoke execute on function public.claim_message_embedding_jobs(int, interval, int) from public, anon, authenticated;
+revoke execute on function public.complete_message_embedding_jobs(jsonb) from public, anon, authenticated;
+revoke execute on function public.fail_message_embedding_jobs(uuid[], text) from public, anon, authenticated;